@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from collections import Counter
+from typing import Optional
+
+from config import (
+    PERMANENT_BASE_USER_FILES_DIR, PHOTO_SUBDIR_NAME, LOG_FORMAT, LOG_DATEFMT,
+    VERIFY_BATCH_SIZE, VERIFY_BATCH_CONCURRENCY, VERIFY_BATCH_TIMEOUT_SEC,
+)
+from face_index import read_user_identifier
+from worker_pool import VerificationPool, PoolSaturatedError, JobTimeoutError
+import verification_tasks
+
+# Повторна проверка на вече верифицираните потребители (напр. след смяна на MODEL_NAME или на прага).
+# Обхождат се PERMANENT_BASE_USER_FILES_DIR/<потребител>/photos, потребителите се групират в партиди и всяка
+# партида е една задача към worker процес. Резултатите се връщат като NDJSON – по един ред на потребител
+# в реда на завършване и накрая ред {"summary": ...}.
+#
+# POST /verify/batch ползва пула на сървъра; CLI-ят (python batch_verification.py) – собствен пул от процеси.
+
+logger = logging.getLogger(__name__)
+
+REVERIFY_FIELDS = ("idCardFront", "selfie")
+
+
+def iter_verified_users(base_dir: str = PERMANENT_BASE_USER_FILES_DIR, users: Optional[list] = None):
+    """По един запис на потребител с последните записани снимки за всяко поле (файловете са "<поле>_<timestamp>.<ext>").
+
+    users – незадължителен филтър по име на папка или по user_identifier.
+    """
+    wanted = set(map(str, users)) if users else None
+    for folder_name in sorted(os.listdir(base_dir)):
+        photo_dir = os.path.join(base_dir, folder_name, PHOTO_SUBDIR_NAME)
+        if not os.path.isdir(photo_dir): continue
+        user_identifier = read_user_identifier(base_dir, folder_name)
+        if wanted is not None and folder_name not in wanted and user_identifier not in wanted: continue
+        filenames = sorted(os.listdir(photo_dir))
+        photos = {}
+        for field in REVERIFY_FIELDS:
+            candidates = [name for name in filenames if name.startswith(f"{field}_")]
+            photos[field] = os.path.join(photo_dir, candidates[-1]) if candidates else None
+        yield {"user_folder": folder_name, "user_identifier": user_identifier, "photos": photos}
+
+
+def chunked(items: list, size: int):
+    size = max(1, size)
+    for start in range(0, len(items), size): yield items[start:start + size]
+
+
+def _failed_chunk(chunk: list, code: str) -> list:
+    return [{"user_folder": user["user_folder"], "user_identifier": user["user_identifier"], "status": "error", "error": code} for user in chunk]
+
+
+def summary_line(counts: Counter, started: float) -> dict:
+    return {"summary": {"users": sum(counts.values()), **dict(counts), "elapsed_sec": round(time.perf_counter() - started, 2)}}
+
+
+async def _run_chunk(pool: VerificationPool, chunk: list, threshold: Optional[float]) -> list:
+    while True:
+        try:
+            async with pool.admit(timeout=VERIFY_BATCH_TIMEOUT_SEC) as job:
+                try:
+                    return await job.run(verification_tasks.reverify_batch_task, chunk, threshold)
+                except JobTimeoutError as e_timeout:
+                    logger.error(f"Времето за обработка на партида изтече: {e_timeout}")
+                    return _failed_chunk(chunk, "BATCH_TIMEOUT")
+        except PoolSaturatedError as e_busy:
+            # Пулът е зает със синхронни /verify заявки – партидата изчаква, вместо да се проваля.
+            await asyncio.sleep(e_busy.retry_after)
+
+
+async def stream_reverification(pool: VerificationPool, users: list, threshold: Optional[float] = None,
+                                batch_size: int = VERIFY_BATCH_SIZE, concurrency: int = VERIFY_BATCH_CONCURRENCY):
+    """Async генератор на NDJSON редове (bytes) за POST /verify/batch.
+
+    Най-много concurrency партиди чакат или се изпълняват едновременно; при прекъсната връзка незавършените се отменят.
+    """
+    started = time.perf_counter()
+    counts = Counter()
+    chunks = chunked(users, batch_size)
+    running = {}
+
+    def _schedule():
+        for chunk in chunks:
+            running[asyncio.create_task(_run_chunk(pool, chunk, threshold))] = chunk
+            if len(running) >= max(1, concurrency): break
+
+    try:
+        _schedule()
+        while running:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                chunk = running.pop(task)
+                try: results = task.result()
+                except Exception as e_chunk:
+                    logger.error(f"Грешка при обработка на партида: {e_chunk}", exc_info=True)
+                    results = _failed_chunk(chunk, "BATCH_ERROR")
+                for result in results:
+                    counts[result["status"]] += 1
+                    yield (json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8")
+            _schedule()
+        yield (json.dumps(summary_line(counts, started)) + "\n").encode("utf-8")
+    finally:
+        for task in running: task.cancel()
+        if running: await asyncio.gather(*running, return_exceptions=True)
+
+
+def reverify_all(base_dir: str, users: Optional[list], threshold: Optional[float], batch_size: int, workers: Optional[int], out=sys.stdout):
+    """CLI вариантът: собствен пул от процеси, NDJSON към out. Връща броячите по статус."""
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import multiprocessing
+
+    started = time.perf_counter()
+    all_users = list(iter_verified_users(base_dir, users))
+    logger.info(f"Повторна проверка на {len(all_users)} потребители от {base_dir} (партиди по {batch_size}).")
+    counts = Counter()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=verification_tasks.init_worker) as executor:
+        futures = {executor.submit(verification_tasks.reverify_batch_task, chunk, threshold): chunk for chunk in chunked(all_users, batch_size)}
+        for future in as_completed(futures):
+            try: results = future.result()
+            except Exception as e_chunk:
+                logger.error(f"Грешка при обработка на партида: {e_chunk}", exc_info=True)
+                results = _failed_chunk(futures[future], "BATCH_ERROR")
+            for result in results:
+                counts[result["status"]] += 1
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+    out.write(json.dumps(summary_line(counts, started)) + "\n")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Повторна проверка на верифицираните потребители (NDJSON към stdout).")
+    parser.add_argument("--base-dir", default=PERMANENT_BASE_USER_FILES_DIR)
+    parser.add_argument("--user", dest="users", action="append", help="Име на папка или user_identifier (може да се повтаря).")
+    parser.add_argument("--threshold", type=float, default=None, help="Праг за косинусово разстояние (по подразбиране – прагът на модела).")
+    parser.add_argument("--batch-size", type=int, default=VERIFY_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    # Логовете отиват в stderr, за да остане stdout чист NDJSON
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, datefmt=LOG_DATEFMT, stream=sys.stderr)
+    reverify_all(args.base_dir, args.users, args.threshold, args.batch_size, args.workers)
@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+
+import config
+
+# Общи помощни функции за бенчмарковете: статистики, информация за средата и запис на резултатите.
+# Резултатите са JSON файлове в bench/results/ и се сравняват с python -m bench.compare.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+
+
+class SkipBench(Exception):
+    """Бенчмаркът не може да се изпълни в тази среда (липсва библиотека, модел или fixture)."""
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    # Линейна интерполация между най-близките рангове (като numpy.percentile по подразбиране)
+    if not sorted_values: return float("nan")
+    pos = (len(sorted_values) - 1) * q / 100.0
+    lower = int(pos); upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (pos - lower)
+
+
+def summarize(samples_sec: list) -> dict:
+    """Латентности в ms (p50/p95/p99, средна, min/max) за списък от времена в секунди."""
+    values = sorted(samples_sec)
+    if not values: return {"n": 0}
+    ms = lambda v: round(v * 1000.0, 4)
+    return {"n": len(values), "mean_ms": ms(sum(values) / len(values)), "min_ms": ms(values[0]), "max_ms": ms(values[-1]),
+            "p50_ms": ms(percentile(values, 50)), "p95_ms": ms(percentile(values, 95)), "p99_ms": ms(percentile(values, 99))}
+
+
+def time_call(fn, repeat: int, warmup: int = 1) -> list:
+    for _ in range(warmup): fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def environment() -> dict:
+    settings = {name: getattr(config, name) for name in dir(config) if name.isupper() and not name.startswith("LOG_")}
+    return {"python": sys.version.split()[0], "platform": platform.platform(), "cpu_count": os.cpu_count(),
+            "git_revision": git_revision(), "config": {k: v if isinstance(v, (int, float, str, bool, type(None))) else repr(v) for k, v in settings.items()}}
+
+
+def write_results(kind: str, payload: dict, out_path: str = None) -> str:
+    """Записва {"kind", "created_at", "environment", ...payload} и връща пътя до файла."""
+    if out_path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out_path = os.path.join(RESULTS_DIR, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    document = {"kind": kind, "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "environment": environment(), **payload}
+    with open(out_path, "w", encoding="utf-8") as f: json.dump(document, f, ensure_ascii=False, indent=2)
+    return out_path
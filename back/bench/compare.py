@@ -0,0 +1,52 @@
+import sys
+import json
+import argparse
+
+# Сравнение на два файла с резултати (micro или load) от bench/results/:
+#   cd back && python -m bench.compare results/micro-A.json results/micro-B.json [--max-regression 10]
+# Изходният код е 1, ако p95 на някой бенчмарк/ниво е по-лош с повече от --max-regression процента.
+
+PERCENTILES = ("p50_ms", "p95_ms", "p99_ms")
+
+
+def _load(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f: return json.load(f)
+
+
+def _entries(document: dict) -> dict:
+    """{име: латентности} за micro (по име на бенчмарк) и load (по ниво на едновременност)."""
+    if document["kind"] == "micro":
+        return {name: result for name, result in document["results"].items() if result.get("status") == "ok"}
+    return {f"concurrency={level['concurrency']}": {**level["latency"], "throughput_rps": level["throughput_rps"]} for level in document["levels"]}
+
+
+def _delta(old: float, new: float) -> float:
+    return (new - old) / old * 100.0 if old else 0.0
+
+
+def compare(baseline: dict, current: dict, max_regression: float) -> list:
+    if baseline["kind"] != current["kind"]: raise ValueError(f"Различни видове резултати: {baseline['kind']} и {current['kind']}")
+    old_entries, new_entries = _entries(baseline), _entries(current)
+    regressions = []
+    print(f"{'':<55}" + "".join(f"{p:>22}" for p in PERCENTILES))
+    for name in sorted(set(old_entries) & set(new_entries)):
+        old, new = old_entries[name], new_entries[name]
+        cells = "".join(f"{old[p]:>9.2f}->{new[p]:>8.2f} {_delta(old[p], new[p]):>+4.0f}%" for p in PERCENTILES)
+        p95_delta = _delta(old["p95_ms"], new["p95_ms"])
+        flag = "  REGRESSION" if p95_delta > max_regression else ""
+        if flag: regressions.append(name)
+        print(f"{name:<55}{cells}{flag}")
+    for name in sorted(set(old_entries) ^ set(new_entries)):
+        print(f"{name:<55} само в {'базовия' if name in old_entries else 'текущия'} файл")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сравнява два файла с резултати от бенчмарковете.")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--max-regression", type=float, default=10.0, help="Допустимо влошаване на p95 в проценти.")
+    args = parser.parse_args()
+    regressions = compare(_load(args.baseline), _load(args.current), args.max_regression)
+    if regressions: print(f"\nВлошаване на p95 над {args.max_regression}%: {', '.join(regressions)}")
+    sys.exit(1 if regressions else 0)
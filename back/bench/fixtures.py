@@ -0,0 +1,147 @@
+import os
+import json
+import math
+import logging
+import argparse
+
+import cv2
+import numpy as np
+
+import image_pipeline
+from bench.common import FIXTURES_DIR
+
+# Синтетични fixtures за бенчмарковете, генерирани локално (нищо не се сваля и не се пази в git):
+#  - снимки с нарисувано лице в няколко размера, "ЛК" с лице върху карта и снимка без лице;
+#  - кратки видеа с "скриптирани" мигания и движение на главата – с аудио (тон) и без аудио.
+# С --face-image снимките се правят от истинска снимка: рисуваните лица минават през целия код,
+# но детекторите (yunet/mtcnn) и FaceMesh невинаги ги разпознават като лица.
+
+logger = logging.getLogger(__name__)
+
+VIDEO_FPS = 30
+VIDEO_SECONDS = 3
+VIDEO_SIZE = (640, 480)
+# Кадри със затворени очи (начало, брой кадри) – две мигания по 3 кадъра при 30 fps
+BLINK_SCRIPT = ((25, 3), (60, 3))
+HEAD_SWAY_PX = 20
+AUDIO_RATE = 44100
+AUDIO_TONE_HZ = 440.0
+AUDIO_AMPLITUDE = 0.1
+
+try:
+    import av
+    PYAV_AVAILABLE = True
+except ImportError:
+    PYAV_AVAILABLE = False
+
+
+def eye_openness(frame_idx: int, blink_script=BLINK_SCRIPT) -> float:
+    for start, length in blink_script:
+        if start <= frame_idx < start + length: return 0.0
+    return 1.0
+
+
+def head_offset(frame_idx: int, n_frames: int, sway_px: float = HEAD_SWAY_PX):
+    phase = 2.0 * math.pi * frame_idx / max(1, n_frames)
+    return int(sway_px * math.sin(phase)), int(sway_px / 2 * math.sin(2 * phase))
+
+
+def scripted_frames(n_frames: int = VIDEO_FPS * VIDEO_SECONDS, size=VIDEO_SIZE, blink_script=BLINK_SCRIPT):
+    """BGR кадри (h, w, 3) с лице в центъра, мигания по blink_script и плавно движение на главата."""
+    width, height = size
+    face_size = min(width, height)
+    for frame_idx in range(n_frames):
+        frame = np.full((height, width, 3), 205, dtype=np.uint8)
+        face = image_pipeline.synthetic_face_image(face_size, eye_open=eye_openness(frame_idx, blink_script), offset=head_offset(frame_idx, n_frames))
+        x0 = (width - face_size) // 2; y0 = (height - face_size) // 2
+        frame[y0:y0 + face_size, x0:x0 + face_size] = face
+        yield frame
+
+
+def write_video(path: str, frames, fps: int = VIDEO_FPS, with_audio: bool = False) -> bool:
+    """Записва кадрите в mp4. С PyAV – H.264/MPEG-4 (+ AAC тон при with_audio); без PyAV – cv2 без аудио."""
+    frames = list(frames)
+    height, width = frames[0].shape[:2]
+    if not PYAV_AVAILABLE:
+        if with_audio: return False
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+        for frame in frames: writer.write(frame)
+        writer.release()
+        return True
+    with av.open(path, "w") as container:
+        codec = "libx264" if "libx264" in av.codecs_available else "mpeg4"
+        video = container.add_stream(codec, rate=fps)
+        video.width, video.height, video.pix_fmt = width, height, "yuv420p"
+        audio = container.add_stream("aac", rate=AUDIO_RATE) if with_audio else None
+        for frame in frames:
+            for packet in video.encode(av.VideoFrame.from_ndarray(frame, format="bgr24")): container.mux(packet)
+        for packet in video.encode(): container.mux(packet)
+        if audio is not None:
+            samples = int(AUDIO_RATE * len(frames) / fps)
+            t = np.arange(samples) / AUDIO_RATE
+            tone = (AUDIO_AMPLITUDE * np.sin(2 * math.pi * AUDIO_TONE_HZ * t)).astype(np.float32)
+            chunk = 1024
+            for start in range(0, samples, chunk):
+                frame = av.AudioFrame.from_ndarray(tone[None, start:start + chunk], format="fltp", layout="mono")
+                frame.sample_rate = AUDIO_RATE; frame.pts = start
+                for packet in audio.encode(frame): container.mux(packet)
+            for packet in audio.encode(): container.mux(packet)
+    return True
+
+
+def _id_card(face: np.ndarray) -> np.ndarray:
+    # Карта 85.6x54 mm в съотношение, лицето вляво, "текст" вдясно
+    card = np.full((540, 856, 3), (215, 225, 235), dtype=np.uint8)
+    photo = cv2.resize(face, (300, 380), interpolation=cv2.INTER_AREA)
+    card[80:460, 40:340] = photo
+    for i in range(6): cv2.rectangle(card, (380, 100 + i * 55), (380 + 380 - i * 30, 120 + i * 55), (90, 90, 90), -1)
+    return card
+
+
+def generate(out_dir: str = FIXTURES_DIR, face_image: str = None) -> dict:
+    """Генерира всички fixtures в out_dir и записва manifest.json. Връща манифеста."""
+    os.makedirs(out_dir, exist_ok=True)
+    base = None
+    if face_image:
+        with open(face_image, "rb") as f: base = image_pipeline.decode_image(f.read())
+        if base is None: raise ValueError(f"{face_image} не е валидно изображение")
+    manifest = {"images": {}, "videos": {}, "blink_script": [list(b) for b in BLINK_SCRIPT], "video_fps": VIDEO_FPS,
+                "real_face": bool(face_image)}
+
+    def save_image(name: str, img: np.ndarray):
+        path = os.path.join(out_dir, f"{name}.jpg")
+        cv2.imwrite(path, img, [int(cv2.IMWRITE_JPEG_QUALITY), 92])
+        manifest["images"][name] = path
+
+    for size in (640, 1280, 3000):
+        face = cv2.resize(base, (size, int(size * base.shape[0] / base.shape[1])), interpolation=cv2.INTER_CUBIC) if base is not None else image_pipeline.synthetic_face_image(size)
+        save_image(f"face_{size}", face)
+    save_image("id_card_front", _id_card(base if base is not None else image_pipeline.synthetic_face_image(640)))
+    rng = np.random.default_rng(0)
+    save_image("no_face", cv2.GaussianBlur(rng.integers(0, 255, (720, 960, 3), dtype=np.uint8), (31, 31), 0))
+
+    for name, with_audio in (("blinks_no_audio", False), ("blinks_audio", True)):
+        path = os.path.join(out_dir, f"{name}.mp4")
+        if write_video(path, scripted_frames(), with_audio=with_audio): manifest["videos"][name] = path
+        else: logger.warning(f"Видеото '{name}' е пропуснато: за аудио е нужен PyAV.")
+    path = os.path.join(out_dir, "no_blinks_no_audio.mp4")
+    if write_video(path, scripted_frames(blink_script=())): manifest["videos"]["no_blinks_no_audio"] = path
+
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f: json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_manifest(out_dir: str = FIXTURES_DIR) -> dict:
+    """Манифестът на вече генерираните fixtures; генерира ги, ако липсват."""
+    path = os.path.join(out_dir, "manifest.json")
+    if not os.path.exists(path): return generate(out_dir)
+    with open(path, "r", encoding="utf-8") as f: return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Генерира синтетични снимки и видеа за бенчмарковете.")
+    parser.add_argument("--out", default=FIXTURES_DIR)
+    parser.add_argument("--face-image", default=None, help="Истинска снимка на лице като основа за снимките.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps(generate(args.out, args.face_image), indent=2))
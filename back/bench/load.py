@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import shutil
+import struct
+import argparse
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.common import BENCH_DIR, summarize, write_results
+from bench import fixtures
+
+# End-to-end натоварване на POST /verify (или /verify/jobs) срещу локално стартиран сървър:
+#   cd back && python -m bench.load --concurrency 1,4,8 --requests 50 [--with-video] [--url http://host:8000]
+# Без --url скриптът стартира uvicorn server:app с временни директории за записаните потребители, индекса
+# и кеша, изчаква /health/ready и го спира накрая. Резултатите (пропускателна способност, p50/p95/p99,
+# статуси и кодове на изхода, средно време по етап от /metrics, дял попадения в кеша за embeddings) се записват
+# в bench/results/load-*.json. Снимките на всяка заявка се различават с по един байт метаданни, за да минава
+# всяка заявка през декодиране, детекция и embedding (--repeat-images изпраща едни и същи байтове – пътят на кеша).
+
+BACK_DIR = os.path.dirname(BENCH_DIR)
+
+
+def _multipart(fields: dict, files: dict):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data, content_type) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: {content_type}\r\n\r\n'.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f: return f.read()
+
+
+def _image_file(name: str, path: str):
+    data = _read(path)
+    kind = "png" if data.startswith(b"\x89PNG") else "jpeg"
+    return (f"{name}.{'png' if kind == 'png' else 'jpg'}", data, f"image/{kind}")
+
+
+def tag_image(data: bytes, tag: str) -> bytes:
+    """Същата снимка с различни байтове: JPEG COM сегмент след SOI или PNG tEXt chunk след IHDR."""
+    payload = tag.encode()
+    if data.startswith(b"\x89PNG"):
+        chunk = b"tEXt" + b"bench\x00" + payload
+        ihdr_end = 8 + 8 + 13 + 4
+        return data[:ihdr_end] + struct.pack(">I", len(chunk) - 4) + chunk + struct.pack(">I", zlib.crc32(chunk)) + data[ihdr_end:]
+    return data[:2] + b"\xff\xfe" + struct.pack(">H", len(payload) + 2) + payload + data[2:]
+
+
+class RequestFactory:
+    """Тялото на една верификационна заявка; user_identifier (и без repeat_images – байтовете на снимките) е различен за всяка заявка."""
+
+    def __init__(self, id_card_path: str, selfie_path: str, video_path: str = None, repeat_images: bool = False):
+        self.repeat_images = repeat_images
+        self.files = {"idCardFront": _image_file("front", id_card_path), "idCardBack": _image_file("back", id_card_path),
+                      "selfie": _image_file("selfie", selfie_path)}
+        if video_path: self.files["video_selfie"] = ("selfie.mp4", _read(video_path), "video/mp4")
+
+    def build(self, i: int):
+        files = self.files
+        if not self.repeat_images:
+            # Иначе след първата заявка embedding-ите идват от кеша на сървъра (вж. verification_pipeline.embed_image)
+            files = {**files, **{name: (filename, tag_image(data, f"bench{i}"), content_type)
+                                 for name, (filename, data, content_type) in files.items() if name in ("idCardFront", "selfie")}}
+        return _multipart({"user_identifier": f"bench{i}", "firstName": "Bench", "lastName": "Load"}, files)
+
+
+def _request(method: str, url: str, body: bytes = None, content_type: str = None, timeout: float = 120):
+    request = urllib.request.Request(url, data=body, method=method)
+    if content_type: request.add_header("Content-Type", content_type)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response: return response.status, response.read()
+    except urllib.error.HTTPError as e_http:
+        return e_http.code, e_http.read()
+
+
+def _outcome(status: int, body: bytes) -> str:
+    try: content = json.loads(body)
+    except ValueError: return f"HTTP_{status}"
+    if status == 200: return "SUCCESS"
+    detail = content.get("detail") if isinstance(content, dict) else None
+    return (content.get("code") if isinstance(content, dict) else None) or (detail.get("code") if isinstance(detail, dict) else None) or f"HTTP_{status}"
+
+
+def one_request(base_url: str, factory: RequestFactory, i: int, endpoint: str, timeout: float):
+    """Една верификация. Връща (латентност в s, HTTP статус, outcome). За /verify/jobs – до приключване на задачата."""
+    body, content_type = factory.build(i)
+    started = time.perf_counter()
+    if endpoint == "verify":
+        status, payload = _request("POST", f"{base_url}/verify", body, content_type, timeout)
+        return time.perf_counter() - started, status, _outcome(status, payload)
+    status, payload = _request("POST", f"{base_url}/verify/jobs", body, content_type, timeout)
+    if status != 202: return time.perf_counter() - started, status, _outcome(status, payload)
+    status_url = json.loads(payload)["status_url"]
+    while time.perf_counter() - started < timeout:
+        time.sleep(0.05)
+        status, payload = _request("GET", f"{base_url}{status_url}", timeout=timeout)
+        job = json.loads(payload)
+        if job.get("state") == "completed":
+            result = job["result"]
+            return time.perf_counter() - started, result["status_code"], _outcome(result["status_code"], json.dumps(result["body"]).encode())
+    return time.perf_counter() - started, 0, "CLIENT_TIMEOUT"
+
+
+def embedding_cache_stats(base_url: str):
+    status, payload = _request("GET", f"{base_url}/embedding-cache/stats")
+    return json.loads(payload) if status == 200 else None
+
+
+def cache_delta(before, after):
+    """Попадения/пропуски в кеша за embeddings между две извадки от /embedding-cache/stats."""
+    if before is None or after is None: return None
+    hits, misses = after["hits"] - before["hits"], after["misses"] - before["misses"]
+    return {"hits": hits, "misses": misses, "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None}
+
+
+def run_level(base_url: str, factory: RequestFactory, concurrency: int, total: int, endpoint: str, timeout: float, offset: int = 0) -> dict:
+    cache_before = embedding_cache_stats(base_url)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(lambda i: one_request(base_url, factory, offset + i, endpoint, timeout), range(total)))
+    elapsed = time.perf_counter() - started
+    latencies = [latency for latency, _, _ in samples]
+    return {"concurrency": concurrency, "requests": total, "elapsed_sec": round(elapsed, 3),
+            "throughput_rps": round(total / elapsed, 3) if elapsed else None, "latency": summarize(latencies),
+            "status_codes": dict(Counter(str(status) for _, status, _ in samples)),
+            "outcomes": dict(Counter(outcome for _, _, outcome in samples)),
+            "embedding_cache": cache_delta(cache_before, embedding_cache_stats(base_url))}
+
+
+def stage_means(metrics_text: str) -> dict:
+    """Средно време (ms) по етап и стъпка от /metrics (сумарно за всички изходи)."""
+    totals = {}
+    for line in metrics_text.splitlines():
+        for metric, label in (("verification_stage_duration_seconds", "stage"), ("verification_step_duration_seconds", "step")):
+            for suffix in ("_sum", "_count"):
+                prefix = f"{metric}{suffix}{{{label}=\""
+                if not line.startswith(prefix): continue
+                name = line[len(prefix):].split('"', 1)[0]
+                entry = totals.setdefault(f"{label}:{name}", [0.0, 0])
+                entry[0 if suffix == "_sum" else 1] += float(line.rsplit(" ", 1)[1])
+    return {name: round(total / count * 1000.0, 3) for name, (total, count) in sorted(totals.items()) if count}
+
+
+def start_server(port: int, env_overrides: dict):
+    """uvicorn server:app в подпроцес с временни директории за данните. Връща (процес, временна директория)."""
+    data_dir = tempfile.mkdtemp(prefix="bench_load_")
+    env = {**os.environ, "PERMANENT_BASE_USER_FILES_DIR": os.path.join(data_dir, "users"),
+           "FACE_INDEX_DIR": os.path.join(data_dir, "face_index"), "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"), **env_overrides}
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port)],
+                               cwd=BACK_DIR, env=env)
+    return process, data_dir
+
+
+def wait_ready(base_url: str, timeout: float, process=None):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process is not None and process.poll() is not None: raise RuntimeError(f"Сървърът спря с код {process.returncode}")
+        try:
+            if _request("GET", f"{base_url}/health/ready", timeout=5)[0] == 200: return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"{base_url} не стана готов за {timeout} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end натоварване на верификационния сървър.")
+    parser.add_argument("--url", default=None, help="Вече стартиран сървър; без него се стартира локален.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--concurrency", default="1,4,8", help="Нива на едновременност, напр. 1,4,8.")
+    parser.add_argument("--requests", type=int, default=50, help="Заявки на всяко ниво.")
+    parser.add_argument("--warmup", type=int, default=2, help="Заявки преди измерването (не се отчитат).")
+    parser.add_argument("--endpoint", choices=("verify", "jobs"), default="verify")
+    parser.add_argument("--with-video", action="store_true", help="Добавя селфи видео (liveness етап).")
+    parser.add_argument("--video", default="blinks_audio", help="Име на видео от fixtures (blinks_audio, blinks_no_audio, no_blinks_no_audio).")
+    parser.add_argument("--id-card-image", default=None, help="Истинска снимка за ЛК (по подразбиране синтетичната).")
+    parser.add_argument("--selfie-image", default=None, help="Истинска селфи снимка (по подразбиране синтетичната).")
+    parser.add_argument("--repeat-images", action="store_true", help="Едни и същи байтове на снимките във всяка заявка (измерва кеша).")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--ready-timeout", type=float, default=300)
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE за локалния сървър (напр. VERIFY_POOL_SIZE=4).")
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    manifest = fixtures.load_manifest()
+    video_path = manifest["videos"].get(args.video) if args.with_video else None
+    if args.with_video and video_path is None: parser.error(f"Няма видео '{args.video}' във fixtures.")
+    factory = RequestFactory(args.id_card_image or manifest["images"]["id_card_front"], args.selfie_image or manifest["images"]["face_640"], video_path, args.repeat_images)
+
+    process = data_dir = None
+    base_url = args.url.rstrip("/") if args.url else f"http://127.0.0.1:{args.port}"
+    env_overrides = dict(item.split("=", 1) for item in args.env)
+    try:
+        if not args.url: process, data_dir = start_server(args.port, env_overrides)
+        started = time.perf_counter()
+        wait_ready(base_url, args.ready_timeout, process)
+        ready_sec = round(time.perf_counter() - started, 3)
+        if args.warmup: run_level(base_url, factory, 1, args.warmup, args.endpoint, args.timeout, offset=10 ** 6)
+        levels = []
+        for i, concurrency in enumerate(int(c) for c in args.concurrency.split(",")):
+            level = run_level(base_url, factory, concurrency, args.requests, args.endpoint, args.timeout, offset=i * args.requests)
+            latency = level["latency"]
+            cache = level["embedding_cache"] or {}
+            print(f"concurrency={concurrency:<3} {level['throughput_rps']:>8.2f} req/s  p50={latency['p50_ms']:.1f} ms  "
+                  f"p95={latency['p95_ms']:.1f} ms  p99={latency['p99_ms']:.1f} ms  cache_hit_ratio={cache.get('hit_ratio')}  {level['outcomes']}")
+            levels.append(level)
+        metrics_status, metrics_text = _request("GET", f"{base_url}/metrics")
+        payload = {"url": base_url, "endpoint": args.endpoint, "with_video": bool(video_path), "video": args.video if video_path else None,
+                   "repeat_images": args.repeat_images,
+                   "started_local_server": process is not None, "server_env": env_overrides, "ready_sec": ready_sec if process else None,
+                   "levels": levels, "stage_mean_ms": stage_means(metrics_text.decode()) if metrics_status == 200 else None,
+                   "embedding_cache": embedding_cache_stats(base_url)}
+        print(f"Резултати: {write_results('load', payload, args.out)}")
+    finally:
+        if process is not None:
+            process.terminate()
+            try: process.wait(timeout=30)
+            except subprocess.TimeoutExpired: process.kill()
+        if data_dir: shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+import time
+import argparse
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+
+from bench.common import SkipBench, summarize, time_call, write_results
+from bench import fixtures
+
+# Микробенчмаркове на отделните етапи на верификацията (изпълняват се в текущия процес, без сървър):
+#   cd back && python -m bench.micro [--only liveness] [--repeat 20]
+# Бенчмарк, за който липсва библиотека (DeepFace, MediaPipe, PyAV, MoviePy), се отбелязва като skipped.
+
+BENCHMARKS = []
+
+
+def bench(name: str, repeat: int = None):
+    """Регистрира fn(ctx) -> callable (или dict от име -> callable за няколко варианта)."""
+    def register(fn):
+        BENCHMARKS.append((name, fn, repeat))
+        return fn
+    return register
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f: return f.read()
+
+
+def _require(module_name: str):
+    try: return __import__(module_name)
+    except ImportError as e_import: raise SkipBench(f"{module_name} не е наличен ({e_import})")
+
+
+class ScriptedFaceMesh:
+    """Заместител на FaceMesh с landmark-и по скрипт (отворени/затворени очи, движение на носа).
+
+    Позволява да се измери цикълът на LivenessAnalyzer без MediaPipe и да се провери броят мигания.
+    """
+
+    def __init__(self, n_frames: int, blink_script=fixtures.BLINK_SCRIPT):
+        import liveness
+        self._indices = liveness.LANDMARK_INDICES
+        self._frames = [self._landmarks(i, n_frames, fixtures.eye_openness(i, blink_script)) for i in range(n_frames)]
+        self._calls = 0
+
+    def _landmarks(self, frame_idx: int, n_frames: int, eye_open: float):
+        dx, dy = fixtures.head_offset(frame_idx, n_frames)
+        points = [SimpleNamespace(x=0.5, y=0.5) for _ in range(max(self._indices) + 1)]
+        # Око: ъгли на ±0.04, клепачи на ±0.015 * eye_open (при 640x480: EAR ≈ 0.28 отворено, ≈ 0.03 затворено)
+        eye_shape = [(-0.04, 0), (-0.015, -0.015), (0.015, -0.015), (0.04, 0), (0.015, 0.015), (-0.015, 0.015)]
+        for eye_idx, center_x in ((slice(0, 6), 0.4), (slice(6, 12), 0.6)):
+            for landmark_idx, (ex, ey) in zip(self._indices[eye_idx], eye_shape):
+                points[landmark_idx] = SimpleNamespace(x=center_x + ex + dx / 640, y=0.45 + max(0.1, eye_open) * ey + dy / 480)
+        points[self._indices[12]] = SimpleNamespace(x=0.5 + dx / 640, y=0.55 + dy / 480)
+        return SimpleNamespace(multi_face_landmarks=[SimpleNamespace(landmark=points)])
+
+    def process(self, rgb_frame):
+        result = self._frames[self._calls % len(self._frames)]
+        self._calls += 1
+        return result
+
+    def reset(self):
+        self._calls = 0
+
+
+def _real_face_mesh():
+    _require("mediapipe")
+    import verification_tasks
+    face_mesh = verification_tasks._load_face_mesh()
+    if face_mesh is None: raise SkipBench("MediaPipe FaceMesh не може да бъде зареден")
+    return face_mesh
+
+
+@bench("image_decode_resize")
+def bench_image_decode_resize(ctx):
+    import image_pipeline
+    return {size: (lambda data=_read(ctx.images[f"face_{size}"]): image_pipeline.load_image(data)) for size in (640, 1280, 3000)}
+
+
+@bench("jpeg_encode")
+def bench_jpeg_encode(ctx):
+    import image_pipeline
+    img = image_pipeline.load_image(_read(ctx.images["face_3000"]))
+    return lambda: image_pipeline.encode_jpeg(img)
+
+
+@bench("ear")
+def bench_ear(ctx):
+    import liveness
+    eyes = np.random.default_rng(0).uniform(0, 100, (ctx.frames, 6, 2))
+    return {"calculate_ear_per_frame": lambda: [liveness.calculate_ear(eye) for eye in eyes],
+            "eye_aspect_ratios_batched": lambda: liveness.eye_aspect_ratios(eyes)}
+
+
+@bench("blink_counter")
+def bench_blink_counter(ctx):
+    import liveness
+    ears = np.array([0.05 if fixtures.eye_openness(i) == 0.0 else 0.3 for i in range(ctx.frames)])
+
+    def run():
+        counter = liveness.BlinkCounter(); counter.update(ears); counter.finish()
+        return counter.blinks
+    blinks = run()
+    if blinks != len(fixtures.BLINK_SCRIPT): raise AssertionError(f"BlinkCounter: {blinks} мигания, очаквани {len(fixtures.BLINK_SCRIPT)}")
+    return run
+
+
+@bench("liveness_loop_scripted")
+def bench_liveness_loop_scripted(ctx):
+    # Цикълът на LivenessAnalyzer (умаляване, BGR->RGB, EAR, ранно спиране) върху кадри в паметта
+    import liveness
+    frames = list(fixtures.scripted_frames(ctx.frames))
+    face_mesh = ScriptedFaceMesh(len(frames))
+
+    def run(early_exit):
+        face_mesh.reset()
+        analyzer = liveness.LivenessAnalyzer(face_mesh, stride=1, early_exit=early_exit, max_frames=len(frames))
+        for frame_idx, frame in enumerate(frames):
+            if analyzer.feed(frame_idx, frame): break
+        return analyzer.result()
+    result = run(False)
+    if result["blinks"] != len(fixtures.BLINK_SCRIPT) or not result["head_moved"]:
+        raise AssertionError(f"Скриптираното видео не премина liveness: {result}")
+    return {"full": lambda: run(False), "early_exit": lambda: run(True)}
+
+
+@bench("liveness_video", repeat=5)
+def bench_liveness_video(ctx):
+    # Декодиране на видеото + FaceMesh (истински, ако MediaPipe е наличен) + аудио – както liveness_task
+    import media_decode
+    try: face_mesh = _real_face_mesh(); ctx.notes["liveness_video"] = "mediapipe"
+    except SkipBench: face_mesh = ScriptedFaceMesh(ctx.frames); ctx.notes["liveness_video"] = "scripted_face_mesh"
+
+    def run(path):
+        face_mesh.reset()
+        return media_decode.analyze_selfie_video(face_mesh, path)
+    return {name: (lambda path=path: run(path)) for name, path in ctx.videos.items()}
+
+
+@bench("audio_check", repeat=5)
+def bench_audio_check(ctx):
+    import media_decode
+    variants = {}
+    if media_decode.MOVIEPY_AVAILABLE:
+        for name, path in ctx.videos.items(): variants[f"moviepy_{name}"] = lambda path=path: media_decode.check_audio_presence(path)
+    if media_decode.PYAV_AVAILABLE:
+        for name, path in ctx.videos.items(): variants[f"pyav_{name}"] = lambda path=path: _pyav_audio_present(path)
+    if not variants: raise SkipBench("нито PyAV, нито MoviePy са налични")
+    return variants
+
+
+def _pyav_audio_present(path: str) -> bool:
+    # Само аудио частта на demux_selfie_video: първите LIVENESS_AUDIO_DURATION_SEC секунди -> RMS
+    import av
+    import media_decode
+    from config import LIVENESS_AUDIO_DURATION_SEC, LIVENESS_AUDIO_RMS_THRESHOLD
+    with av.open(path) as container:
+        if not container.streams.audio: return False
+        stream = container.streams.audio[0]
+        rms = media_decode.RmsAccumulator(int((stream.rate or 44100) * LIVENESS_AUDIO_DURATION_SEC))
+        for frame in container.decode(stream):
+            rms.add(media_decode._audio_frame_to_mono(frame))
+            if rms.full: break
+        return rms.rms() > LIVENESS_AUDIO_RMS_THRESHOLD
+
+
+@bench("face_detect_embed", repeat=5)
+def bench_face_detect_embed(ctx):
+    _require("deepface")
+    import image_pipeline
+    from config import DETECTOR_BACKEND
+    from face_detection import detector_tiers, represent_faces
+    images = {name: image_pipeline.load_image(_read(ctx.images[name])) for name in ("face_640", "id_card_front")}
+    backends = list(dict.fromkeys(detector_tiers("idCardFront") + (DETECTOR_BACKEND,)))
+    variants = {}
+    for image_name, img in images.items():
+        for backend in backends: variants[f"{backend}_{image_name}"] = lambda img=img, backend=backend: represent_faces(img, (backend,))
+        variants[f"cascade_{image_name}"] = lambda img=img: represent_faces(img, detector_tiers("idCardFront"))
+    return variants
+
+
+@bench("embedding_cache")
+def bench_embedding_cache(ctx):
+    from embedding_cache import EmbeddingCache, content_key
+    data = _read(ctx.images["face_640"])
+    embeddings = np.random.default_rng(0).standard_normal((1, 128)).astype(np.float32)
+    memory = EmbeddingCache(1024, 3600)
+    disk = EmbeddingCache(1, 3600, disk_dir=tempfile.mkdtemp(prefix="bench_cache_"))
+    key = content_key(data, "SFace", "bench")
+    memory.put(key, embeddings); disk.put(key, embeddings); disk.put("evict", embeddings)
+    return {"content_key": lambda: content_key(data, "SFace", "bench"), "memory_hit": lambda: memory.get(key),
+            "disk_hit": lambda: (disk.get(key), disk.get("evict"))}
+
+
+@bench("face_index_search", repeat=20)
+def bench_face_index_search(ctx):
+    from face_index import FaceIndexWriter, FaceIndexReader
+    rng = np.random.default_rng(0)
+    query = rng.standard_normal((1, 128)).astype(np.float32)
+    variants = {}
+    for rows in (10_000, 100_000):
+        index_dir = tempfile.mkdtemp(prefix=f"bench_index_{rows}_")
+        FaceIndexWriter(index_dir, "bench", "bench").append(rng.standard_normal((rows, 128)).astype(np.float32),
+                                                             [{"user_identifier": str(i)} for i in range(rows)])
+        reader = FaceIndexReader(index_dir, "bench", "bench")
+        reader.search(query)  # първото търсене чете метаданните
+        variants[f"{rows}_rows"] = lambda reader=reader: reader.search(query)
+    return variants
+
+
+@bench("distance")
+def bench_distance(ctx):
+    from verification_tasks import min_cosine_distance
+    rng = np.random.default_rng(0)
+    a, b = rng.standard_normal((1, 128)), rng.standard_normal((2, 128))
+    return lambda: min_cosine_distance(a, b)
+
+
+def run(only: str = None, repeat: int = 20, frames: int = fixtures.VIDEO_FPS * fixtures.VIDEO_SECONDS) -> dict:
+    manifest = fixtures.load_manifest()
+    ctx = SimpleNamespace(images=manifest["images"], videos=manifest["videos"], frames=frames, notes={})
+    results = {}
+    wall_sec = {}
+    for name, factory, bench_repeat in BENCHMARKS:
+        if only and only not in name: continue
+        started = time.perf_counter()
+        try:
+            target = factory(ctx)
+            variants = target if isinstance(target, dict) else {None: target}
+            for variant, fn in variants.items():
+                key = name if variant is None else f"{name}[{variant}]"
+                results[key] = {"status": "ok", **summarize(time_call(fn, bench_repeat or repeat))}
+                print(f"{key:<55} p50={results[key]['p50_ms']:>10.3f} ms  p95={results[key]['p95_ms']:>10.3f} ms  p99={results[key]['p99_ms']:>10.3f} ms")
+        except SkipBench as e_skip:
+            results[name] = {"status": "skipped", "reason": str(e_skip)}
+            print(f"{name:<55} skipped: {e_skip}")
+        except Exception as e_bench:
+            results[name] = {"status": "error", "reason": f"{type(e_bench).__name__}: {e_bench}"}
+            print(f"{name:<55} ERROR: {e_bench}")
+        wall_sec[name] = round(time.perf_counter() - started, 3)
+    return {"results": results, "wall_sec": wall_sec, "notes": ctx.notes, "fixtures": manifest}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Микробенчмаркове на етапите на верификацията.")
+    parser.add_argument("--only", default=None, help="Само бенчмаркове, чието име съдържа този текст.")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--out", default=None, help="JSON файл за резултатите (по подразбиране bench/results/micro-<време>.json).")
+    args = parser.parse_args()
+    payload = run(args.only, args.repeat)
+    print(f"Резултати: {write_results('micro', {'repeat': args.repeat, **payload}, args.out)}")
@@ -0,0 +1,94 @@
+import os
+
+# Общи настройки за сървъра и за работните процеси (worker-ите) на верификацията.
+# Стойностите, свързани с производителността, могат да се променят чрез променливи на средата.
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+
+MODEL_NAME = "SFace"
+DETECTOR_BACKEND = "mtcnn"
+DISTANCE_METRIC = "cosine"
+# Бързи детектори (DeepFace backend-и), пробвани преди DETECTOR_BACKEND; празно = само mtcnn
+FAST_DETECTOR_BACKENDS = tuple(b.strip() for b in os.getenv("FAST_DETECTOR_BACKENDS", "yunet").split(",") if b.strip())
+# Под тази увереност (face_confidence на DeepFace) резултатът на бързия детектор се отхвърля и се пуска mtcnn
+FAST_DETECTOR_MIN_CONFIDENCE = float(os.getenv("FAST_DETECTOR_MIN_CONFIDENCE", "0.9"))
+# За кои снимки се пробват бързите детектори (idCardFront, selfie)
+FAST_DETECTOR_FIELDS = frozenset(f.strip() for f in os.getenv("FAST_DETECTOR_FIELDS", "idCardFront,selfie").split(",") if f.strip())
+
+PERMANENT_BASE_USER_FILES_DIR = os.getenv("PERMANENT_BASE_USER_FILES_DIR", "user_verification_data_verified")
+PHOTO_SUBDIR_NAME = "photos"
+VIDEO_SUBDIR_NAME = "videos"
+
+# --- Качване на файловете (POST /verify и /verify/jobs) ---
+# Лимитите се проверяват, докато тялото на заявката пристига; при превишаване отговорът е 413 веднага
+UPLOAD_MAX_IMAGE_BYTES = int(os.getenv("UPLOAD_MAX_IMAGE_BYTES", 10 * 1024 * 1024))
+UPLOAD_MAX_VIDEO_BYTES = int(os.getenv("UPLOAD_MAX_VIDEO_BYTES", 50 * 1024 * 1024))
+# Продължителност по заглавната част на контейнера (mvhd на MP4/MOV, Info на WebM); без нея важи само лимитът в байтове
+UPLOAD_MAX_VIDEO_DURATION_SEC = float(os.getenv("UPLOAD_MAX_VIDEO_DURATION_SEC", "30"))
+UPLOAD_MAX_FIELD_BYTES = 4096
+UPLOAD_MAX_BODY_BYTES = 3 * UPLOAD_MAX_IMAGE_BYTES + 3 * UPLOAD_MAX_VIDEO_BYTES + 1024 * 1024
+# Общ срок за качването на цялото тяло (408 след него)
+UPLOAD_TIMEOUT_SEC = float(os.getenv("UPLOAD_TIMEOUT_SEC", "120"))
+# Едновременни качвания (429 над тях). Отделно от слотовете на пула: те ограничават CPU работата и се заемат
+# едва при първата задача към пула, а не докато тялото още пристига по мрежата
+UPLOAD_MAX_CONCURRENT = int(os.getenv("UPLOAD_MAX_CONCURRENT", "64"))
+
+# Снимка за загряване на моделите в worker-ите; без нея се използва вградена синтетична снимка
+WARMUP_IMAGE_PATH = os.getenv("WARMUP_IMAGE_PATH") or None
+
+# Снимките на ЛК (предна) и селфито се умаляват до тази по-дълга страна преди сравнението
+IMAGE_MAX_DIM = 640
+IMAGE_JPEG_QUALITY = 85
+
+LIVENESS_EAR_THRESHOLD = 0.20
+LIVENESS_EAR_CONSEC_FRAMES_MIN = 2
+LIVENESS_EAR_CONSEC_FRAMES_MAX = 5
+LIVENESS_MIN_BLINKS_REQUIRED = 1
+LIVENESS_MOVEMENT_RANGE_THRESHOLD = 5.0
+LIVENESS_AUDIO_RMS_THRESHOLD = 0.005
+LIVENESS_AUDIO_DURATION_SEC = 3
+LIVENESS_MAX_FRAMES_TO_ANALYZE = 75
+REQUIRE_AUDIO_FOR_LIVENESS = False
+# Анализира се ~LIVENESS_TARGET_FPS кадъра в секунда от видеото (0 = всеки LIVENESS_FRAME_STRIDE-и кадър).
+# По подразбиране – всеки кадър: при прескачане кратките мигания/спадове на EAR не могат да се измерят точно
+LIVENESS_TARGET_FPS = float(os.getenv("LIVENESS_TARGET_FPS", "0"))
+LIVENESS_FRAME_STRIDE = int(os.getenv("LIVENESS_FRAME_STRIDE", "1"))
+# По-дългата страна на кадъра преди FaceMesh (0 = без умаляване – landmark-ите са точно като в оригиналния цикъл)
+LIVENESS_INFERENCE_MAX_DIM = int(os.getenv("LIVENESS_INFERENCE_MAX_DIM", "480"))
+LIVENESS_EARLY_EXIT = os.getenv("LIVENESS_EARLY_EXIT", "1") != "0"
+# През колко кадъра с лице се пресмятат EAR/движение и се проверява за ранно спиране
+LIVENESS_EVAL_EVERY_FRAMES = int(os.getenv("LIVENESS_EVAL_EVERY_FRAMES", "5"))
+# DEBUG ред за EAR/мигания се извежда за всяка N-та такава проверка (1 = за всяка)
+LIVENESS_DEBUG_LOG_EVERY = int(os.getenv("LIVENESS_DEBUG_LOG_EVERY", "4"))
+
+# --- Пул от процеси за CPU-тежките етапи (DeepFace, MediaPipe, аудио) ---
+VERIFY_POOL_SIZE = int(os.getenv("VERIFY_POOL_SIZE", os.cpu_count() or 1))
+# Колко заявки могат да чакат свободен worker, освен тези, които вече се изпълняват
+VERIFY_QUEUE_SIZE = int(os.getenv("VERIFY_QUEUE_SIZE", VERIFY_POOL_SIZE * 2))
+VERIFY_JOB_TIMEOUT_SEC = float(os.getenv("VERIFY_JOB_TIMEOUT_SEC", "60"))
+VERIFY_RETRY_AFTER_SEC = int(os.getenv("VERIFY_RETRY_AFTER_SEC", "5"))
+
+# --- Асинхронни задачи (POST /verify/jobs) ---
+VERIFY_JOBS_CONCURRENCY = int(os.getenv("VERIFY_JOBS_CONCURRENCY", VERIFY_POOL_SIZE))
+VERIFY_JOBS_QUEUE_SIZE = int(os.getenv("VERIFY_JOBS_QUEUE_SIZE", "100"))
+# Колко секунди се пази резултатът от приключила задача
+VERIFY_JOB_RESULT_TTL_SEC = float(os.getenv("VERIFY_JOB_RESULT_TTL_SEC", "600"))
+
+# --- Повторна проверка на вече верифицираните потребители (POST /verify/batch и batch_verification.py) ---
+# Потребители в една задача към worker-а
+VERIFY_BATCH_SIZE = int(os.getenv("VERIFY_BATCH_SIZE", "16"))
+# Колко партиди се обработват едновременно; по подразбиране половината пул – останалите worker-и са за /verify
+VERIFY_BATCH_CONCURRENCY = int(os.getenv("VERIFY_BATCH_CONCURRENCY", max(1, VERIFY_POOL_SIZE // 2)))
+VERIFY_BATCH_TIMEOUT_SEC = float(os.getenv("VERIFY_BATCH_TIMEOUT_SEC", "300"))
+
+# --- Кеш за face embeddings (по съдържание на снимката + модел/детектор), в сървърния процес и във всеки worker ---
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "1024"))
+EMBEDDING_CACHE_TTL_SEC = float(os.getenv("EMBEDDING_CACHE_TTL_SEC", "3600"))
+# Незадължително ниво на диска, общо за сървъра и всички worker-и (напр. "embedding_cache"); празно = изключено
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR") or None
+
+# --- 1:N индекс на верифицираните лица (търсене на дублирани самоличности) ---
+FACE_INDEX_DIR = os.getenv("FACE_INDEX_DIR", "face_index")
+FACE_INDEX_TOP_K = int(os.getenv("FACE_INDEX_TOP_K", "5"))
@@ -0,0 +1,107 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(data: bytes, model_name: str, detector_backend: str) -> str:
+    # Ключът включва модела и детектора – смяна на MODEL_NAME/DETECTOR_BACKEND не връща стари вектори.
+    digest = hashlib.sha256(data).hexdigest()
+    return f"{model_name}-{detector_backend}-{digest}"
+
+
+class EmbeddingCache:
+    """LRU кеш за face embeddings с TTL и незадължително ниво на диска.
+
+    Стойността е float32 матрица (брой_лица, dim) и името на детектора от каскадата, който е открил лицата.
+    Празна матрица означава, че на снимката не е открито лице – и този резултат се кешира, за да не се пуска
+    детекторът отново при повторен опит със същия файл.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_sec: float = 3600, disk_dir: Optional[str] = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl_sec = ttl_sec
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir: os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        # Ключът съдържа имената на детекторите (напр. "yunet>mtcnn") – името на файла е хешът му, за да е валидно и под Windows
+        return os.path.join(self.disk_dir, f"{hashlib.sha256(key.encode()).hexdigest()}.npz")
+
+    def get(self, key: str) -> Optional[tuple]:
+        """(embeddings, детектор или None) или None при пропуск."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if now - stored_at <= self.ttl_sec:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+        value = self._disk_get(key, now)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1; self.disk_hits += 1
+            self._store(key, value, now)
+        return value
+
+    def put(self, key: str, embeddings: np.ndarray, detector: Optional[str] = None):
+        value = (np.asarray(embeddings, dtype=np.float32), detector)
+        now = time.time()
+        with self._lock: self._store(key, value, now)
+        self._disk_put(key, value)
+
+    def _store(self, key: str, value: tuple, stored_at: float):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+
+    def _disk_get(self, key: str, now: float) -> Optional[tuple]:
+        if not self.disk_dir: return None
+        path = self._disk_path(key)
+        try:
+            if now - os.path.getmtime(path) > self.ttl_sec:
+                os.remove(path)
+                return None
+            with np.load(path, allow_pickle=False) as stored:
+                return stored["embeddings"], str(stored["detector"]) or None
+        except FileNotFoundError:
+            return None
+        except Exception as e_disk:
+            logger.warning(f"Грешка при четене на embedding от диска ({path}): {e_disk}")
+            return None
+
+    def _disk_put(self, key: str, value: tuple):
+        if not self.disk_dir: return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        embeddings, detector = value
+        try:
+            # np.savez добавя .npz, ако името не завършва така – затова записваме през файлов обект.
+            with open(tmp_path, "wb") as f: np.savez(f, embeddings=embeddings, detector=np.array(detector or ""))
+            os.replace(tmp_path, path)
+        except Exception as e_disk:
+            logger.warning(f"Грешка при запис на embedding на диска ({path}): {e_disk}")
+            try: os.remove(tmp_path)
+            except OSError: pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "ttl_sec": self.ttl_sec,
+                    "hits": self.hits, "misses": self.misses, "disk_hits": self.disk_hits, "disk_enabled": bool(self.disk_dir)}
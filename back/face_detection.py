@@ -0,0 +1,60 @@
+import time
+import logging
+
+import numpy as np
+
+from config import MODEL_NAME, DETECTOR_BACKEND, FAST_DETECTOR_BACKENDS, FAST_DETECTOR_MIN_CONFIDENCE, FAST_DETECTOR_FIELDS
+
+# Каскада от детектори: бързите CPU детектори (DeepFace backend-и като "yunet" или "opencv") се пробват първи,
+# а DETECTOR_BACKEND (mtcnn) се пуска само ако бързият не намери лице или увереността му е под
+# FAST_DETECTOR_MIN_CONFIDENCE. Сканираните ЛК обикновено имат чисто фронтално лице и не стигат до mtcnn.
+#
+# Модулът се импортира и от сървърния процес (имената на каскадата участват в ключа на кеша и в индекса),
+# затова DeepFace се зарежда едва при първата детекция в worker-а.
+
+logger = logging.getLogger(__name__)
+
+
+def detector_tiers(field: str) -> tuple:
+    """Детекторите за дадено поле (idCardFront/selfie) в реда, в който се пробват."""
+    fast = tuple(b for b in FAST_DETECTOR_BACKENDS if b != DETECTOR_BACKEND) if field in FAST_DETECTOR_FIELDS else ()
+    return fast + (DETECTOR_BACKEND,)
+
+
+def detector_cascade_name(field: str) -> str:
+    # Напр. "yunet>mtcnn" – записва се в ключа на кеша и в header-а на индекса на лицата
+    return ">".join(detector_tiers(field))
+
+
+def represent_faces(img: np.ndarray, tiers: tuple, min_confidence: float = FAST_DETECTOR_MIN_CONFIDENCE, timings: dict = None):
+    """SFace embeddings на лицата в img през каскадата. Връща (матрица (n, dim), детектор, грешка).
+
+    Лице не е открито от нито един детектор -> празна матрица, детектор None и съобщението на последния.
+    timings (ако е подаден) получава времето на всеки пробван детектор: "detect_embed_<backend>".
+    """
+    from deepface import DeepFace
+
+    error = None
+    for i, backend in enumerate(tiers):
+        last_tier = i == len(tiers) - 1
+        started = time.perf_counter()
+        try:
+            # DeepFace.represent прави детекцията, подравняването и embedding-а в едно извикване
+            representations = DeepFace.represent(
+                img_path=img, model_name=MODEL_NAME, detector_backend=backend,
+                enforce_detection=True, align=True)
+        except ValueError as ve:
+            representations = None; error = str(ve)
+        finally:
+            if timings is not None: timings[f"detect_embed_{backend}"] = round(time.perf_counter() - started, 4)
+        if representations is None:
+            if not last_tier: logger.debug(f"Детектор '{backend}' не откри лице – следващ: '{tiers[i + 1]}'.")
+            continue
+        if not last_tier:
+            confident = [r for r in representations if (r.get("face_confidence") or 0.0) >= min_confidence]
+            if not confident:
+                logger.debug(f"Детектор '{backend}': ниска увереност {[r.get('face_confidence') for r in representations]} – следващ: '{tiers[i + 1]}'.")
+                continue
+            representations = confident
+        return np.array([r["embedding"] for r in representations], dtype=np.float32), backend, None
+    return np.empty((0, 0), dtype=np.float32), None, error
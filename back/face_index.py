@@ -0,0 +1,216 @@
+import os
+import json
+import shutil
+import logging
+import argparse
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from config import (
+    MODEL_NAME, PERMANENT_BASE_USER_FILES_DIR, PHOTO_SUBDIR_NAME,
+    FACE_INDEX_DIR, FACE_INDEX_TOP_K, LOG_FORMAT, LOG_DATEFMT,
+)
+from face_detection import detector_cascade_name
+
+# Индекс с embeddings на верифицираните потребители за 1:N търсене на дублирани самоличности.
+#
+# На диска: <dir>/embeddings.f32 – непрекъсната float32 матрица (редове = L2-нормализирани embeddings),
+# <dir>/meta.jsonl – по един ред метаданни за всеки ред на матрицата, <dir>/header.json – модел/каскада от детектори на селфито/dim.
+# Записва само сървърният процес (FaceIndexWriter, append при успешна верификация); worker-ите четат
+# матрицата през np.memmap само за четене, така че страниците ѝ се споделят между процесите от OS кеша.
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_FILE = "embeddings.f32"
+META_FILE = "meta.jsonl"
+HEADER_FILE = "header.json"
+# В папката на всеки верифициран потребител: {"user_identifier": ...} (вж. persist_verified_files)
+USER_META_FILE = "user.json"
+
+
+def user_identifier_from_folder(folder_name: str) -> str:
+    # Папките са "<Име>_<Фамилия>_<user_identifier>" или "user_<user_identifier>" (вж. persist_verified_files).
+    # Вярно е само ако user_identifier няма "_" – затова е само резервен вариант за папки без USER_META_FILE.
+    return folder_name.rsplit("_", 1)[-1]
+
+
+def write_user_meta(user_dir: str, user_identifier: str):
+    with open(os.path.join(user_dir, USER_META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"user_identifier": str(user_identifier), "verified_at": int(time.time())}, f, ensure_ascii=False)
+
+
+def read_user_identifier(base_dir: str, folder_name: str) -> str:
+    """Истинският user_identifier от USER_META_FILE; за папки, записани преди него – от името на папката."""
+    try:
+        with open(os.path.join(base_dir, folder_name, USER_META_FILE), "r", encoding="utf-8") as f:
+            return str(json.load(f)["user_identifier"])
+    except FileNotFoundError:
+        return user_identifier_from_folder(folder_name)
+    except (OSError, ValueError, KeyError) as e_meta:
+        logger.warning(f"Невалиден {USER_META_FILE} в {folder_name} ({e_meta}); user_identifier се взема от името на папката.")
+        return user_identifier_from_folder(folder_name)
+
+
+def _normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embeddings.ndim == 1: embeddings = embeddings[None, :]
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def _read_header(index_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(index_dir, HEADER_FILE), "r", encoding="utf-8") as f: return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class FaceIndexWriter:
+    """Добавяне на редове в индекса. Един writer на директория (сървърният процес)."""
+
+    def __init__(self, index_dir: str = FACE_INDEX_DIR, model_name: str = MODEL_NAME, detector_backend: str = detector_cascade_name("selfie")):
+        self.index_dir = index_dir
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+        self._lock = threading.Lock()
+
+    def append(self, embeddings: np.ndarray, metas: list):
+        rows = _normalize(embeddings)
+        if len(rows) != len(metas): raise ValueError("Броят редове и метаданни се различава")
+        with self._lock:
+            os.makedirs(self.index_dir, exist_ok=True)
+            header = _read_header(self.index_dir)
+            if header is None:
+                header = {"model": self.model_name, "detector": self.detector_backend, "dim": int(rows.shape[1])}
+                with open(os.path.join(self.index_dir, HEADER_FILE), "w", encoding="utf-8") as f: json.dump(header, f)
+            elif (header["model"], header["detector"], header["dim"]) != (self.model_name, self.detector_backend, rows.shape[1]):
+                logger.error(f"Индексът в {self.index_dir} е за {header}, а не за {self.model_name}/{self.detector_backend}. Нужен е rebuild.")
+                return
+            # Първо матрицата, после метаданните: читателите ползват min(редове, метаданни), така че
+            # полузаписан ред никога не се вижда без метаданните си.
+            with open(os.path.join(self.index_dir, EMBEDDINGS_FILE), "ab") as f: f.write(rows.tobytes())
+            with open(os.path.join(self.index_dir, META_FILE), "a", encoding="utf-8") as f:
+                for meta in metas: f.write(json.dumps(meta, ensure_ascii=False) + "\n")
+
+
+class FaceIndexReader:
+    """Memory-mapped индекс само за четене с векторизирано косинусово top-k търсене."""
+
+    def __init__(self, index_dir: str = FACE_INDEX_DIR, model_name: str = MODEL_NAME, detector_backend: str = detector_cascade_name("selfie")):
+        self.index_dir = index_dir
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+        self._matrix = None
+        self._metas = []
+        self._user_ids = np.empty(0, dtype=object)
+        self._meta_offset = 0
+        self._dim = None
+        self._inode = None
+
+    def _refresh(self) -> int:
+        """Пренасочва memmap-а, ако файлът е пораснал или е заменен от rebuild. Връща броя редове."""
+        embeddings_path = os.path.join(self.index_dir, EMBEDDINGS_FILE)
+        try: st = os.stat(embeddings_path)
+        except FileNotFoundError: return 0
+        if self._inode != st.st_ino or (self._matrix is not None and st.st_size < self._matrix.nbytes):
+            header = _read_header(self.index_dir)
+            if header is None or (header["model"], header["detector"]) != (self.model_name, self.detector_backend):
+                logger.warning(f"Индексът в {self.index_dir} не съответства на {self.model_name}/{self.detector_backend} – търсенето се пропуска.")
+                return 0
+            self._dim = int(header["dim"]); self._inode = st.st_ino
+            self._matrix = None; self._metas = []; self._meta_offset = 0
+        rows_on_disk = st.st_size // (self._dim * 4)
+        if self._matrix is None or len(self._matrix) != rows_on_disk:
+            self._matrix = np.memmap(embeddings_path, dtype=np.float32, mode="r", shape=(rows_on_disk, self._dim)) if rows_on_disk else None
+        self._read_new_metas()
+        return min(rows_on_disk, len(self._metas))
+
+    def _read_new_metas(self):
+        try:
+            with open(os.path.join(self.index_dir, META_FILE), "r", encoding="utf-8") as f:
+                f.seek(self._meta_offset)
+                while True:
+                    line = f.readline()
+                    if not line.endswith("\n"): break  # ред, който още се записва
+                    self._metas.append(json.loads(line))
+                    self._meta_offset = f.tell()
+        except FileNotFoundError:
+            pass
+        if len(self._user_ids) != len(self._metas):
+            self._user_ids = np.array([str(meta.get("user_identifier")) for meta in self._metas], dtype=object)
+
+    def search(self, query: np.ndarray, top_k: int = FACE_INDEX_TOP_K, exclude_user_identifier: Optional[str] = None) -> list:
+        """Най-близките top_k реда за всяко от лицата в query (n, dim). Връща [{..meta, "distance"}], сортирани."""
+        rows = self._refresh()
+        if not rows: return []
+        queries = _normalize(query)
+        if queries.shape[1] != self._dim: return []
+        distances = (1.0 - self._matrix[:rows] @ queries.T).min(axis=1)
+        if exclude_user_identifier is not None:
+            # Повторна верификация на същия потребител не е дубликат
+            distances[self._user_ids[:rows] == str(exclude_user_identifier)] = np.inf
+        k = min(top_k, rows)
+        candidates = np.argpartition(distances, k - 1)[:k]
+        candidates = candidates[np.argsort(distances[candidates])]
+        return [{**self._metas[i], "distance": round(float(distances[i]), 4)} for i in candidates if np.isfinite(distances[i])]
+
+
+def _iter_user_selfies(base_dir: str):
+    for folder_name in sorted(os.listdir(base_dir)):
+        photo_dir = os.path.join(base_dir, folder_name, PHOTO_SUBDIR_NAME)
+        if not os.path.isdir(photo_dir): continue
+        for filename in sorted(os.listdir(photo_dir)):
+            if filename.startswith("selfie_"): yield folder_name, os.path.join(photo_dir, filename)
+
+
+def rebuild(base_dir: str = PERMANENT_BASE_USER_FILES_DIR, index_dir: str = FACE_INDEX_DIR, workers: int = None, chunksize: int = 8) -> int:
+    """Наново изгражда индекса от всички photos/selfie_* файлове (embeddings се изчисляват паралелно).
+
+    Пуска се, докато сървърът не приема верификации: редовете, добавени по време на rebuild, се губят.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    import verification_tasks
+
+    selfies = list(_iter_user_selfies(base_dir))
+    logger.info(f"Rebuild на индекса: {len(selfies)} селфи снимки в {base_dir}.")
+    tmp_dir = f"{index_dir}.rebuild"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    writer = FaceIndexWriter(tmp_dir)
+    added = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=verification_tasks.init_worker) as executor:
+        for (folder_name, path), embedded in zip(selfies, executor.map(verification_tasks.embed_image_file_task, [p for _, p in selfies], chunksize=chunksize)):
+            if embedded["image_error"] or embedded["face_not_found"]:
+                logger.warning(f"Пропуснат файл (няма лице/невалиден): {path}")
+                continue
+            meta = {"user_identifier": read_user_identifier(base_dir, folder_name), "user_folder": folder_name,
+                    "source": os.path.relpath(path, base_dir).replace("\\", "/"), "added_at": int(os.path.getmtime(path))}
+            # Едно лице на ред – при няколко лица на селфито се взема първото (както е при верификацията).
+            writer.append(embedded["embeddings"][:1], [meta])
+            added += 1
+    # Подмяна на индекса с една операция; читателите забелязват новия inode при следващото търсене.
+    os.makedirs(tmp_dir, exist_ok=True)
+    old_dir = f"{index_dir}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(index_dir): os.replace(index_dir, old_dir)
+    os.replace(tmp_dir, index_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    logger.info(f"Индексът е изграден наново: {added} реда в {index_dir}.")
+    return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Face embedding index за търсене на дублирани самоличности.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser("rebuild", help="Изгражда индекса наново от папките photos/ на верифицираните потребители.")
+    rebuild_parser.add_argument("--base-dir", default=PERMANENT_BASE_USER_FILES_DIR)
+    rebuild_parser.add_argument("--index-dir", default=FACE_INDEX_DIR)
+    rebuild_parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, datefmt=LOG_DATEFMT)
+    started = time.perf_counter()
+    rebuild(args.base_dir, args.index_dir, args.workers)
+    logger.info(f"Готово за {time.perf_counter() - started:.1f} s.")
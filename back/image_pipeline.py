@@ -0,0 +1,58 @@
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from config import IMAGE_MAX_DIM, IMAGE_JPEG_QUALITY
+
+# Снимките се обработват изцяло в паметта: байтовете от качването се декодират веднъж,
+# умаляват се като ndarray и се подават директно на детектора/модела. JPEG се кодира
+# само за файловете, които ще бъдат запазени след успешна верификация.
+
+
+def decode_image(data: bytes) -> Optional[np.ndarray]:
+    if not data: return None
+    try: return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    except Exception: return None
+
+
+def resize_array(img: np.ndarray, max_dim: int = IMAGE_MAX_DIM) -> np.ndarray:
+    h, w = img.shape[:2]
+    if max(h, w) <= max_dim: return img
+    scale = max_dim / max(h, w)
+    new_w, new_h = int(w * scale), int(h * scale)
+    return cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+
+def load_image(data: bytes, max_dim: int = IMAGE_MAX_DIM) -> Optional[np.ndarray]:
+    """Декодиране + умаляване. None, ако байтовете не са валидно изображение."""
+    img = decode_image(data)
+    if img is None: return None
+    try: return resize_array(img, max_dim)
+    except Exception: return None
+
+
+def encode_jpeg(img: np.ndarray, quality: int = IMAGE_JPEG_QUALITY) -> Optional[bytes]:
+    ok, buffer = cv2.imencode(".jpg", img, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    return buffer.tobytes() if ok else None
+
+
+def synthetic_face_image(size: int = 320, eye_open: float = 1.0, offset=(0, 0)) -> np.ndarray:
+    """Нарисувано "лице" (овал, очи, вежди, нос, уста) – вградена снимка за загряване на детекторите и модела.
+
+    eye_open (0..1) и offset (dx, dy в пиксели) се използват от back/bench за кадри със "скриптирани" мигания.
+    """
+    img = np.full((size, size, 3), 205, dtype=np.uint8)
+    c = size // 2
+    s = lambda k: int(size * k)
+    cx, cy = c + int(offset[0]), c + int(offset[1])
+    cv2.ellipse(img, (cx, cy), (s(0.27), s(0.35)), 0, 0, 360, (140, 170, 215), -1)
+    for side in (-1, 1):
+        eye = (cx + side * s(0.1), cy - s(0.07))
+        eye_height = max(1, int(s(0.025) * eye_open))
+        cv2.ellipse(img, eye, (s(0.05), eye_height), 0, 0, 360, (245, 245, 245), -1)
+        if eye_open > 0.3: cv2.circle(img, eye, min(s(0.018), eye_height), (40, 30, 25), -1)
+        cv2.line(img, (eye[0] - s(0.05), eye[1] - s(0.05)), (eye[0] + s(0.05), eye[1] - s(0.06)), (50, 60, 80), max(1, s(0.012)))
+    cv2.line(img, (cx, cy - s(0.02)), (cx - s(0.02), cy + s(0.08)), (110, 130, 175), max(1, s(0.01)))
+    cv2.ellipse(img, (cx, cy + s(0.16)), (s(0.08), s(0.03)), 0, 0, 180, (70, 70, 160), max(1, s(0.015)))
+    return img
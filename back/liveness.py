@@ -0,0 +1,218 @@
+import time
+import logging
+
+import cv2
+import numpy as np
+
+from config import (
+    LIVENESS_EAR_THRESHOLD, LIVENESS_EAR_CONSEC_FRAMES_MIN, LIVENESS_EAR_CONSEC_FRAMES_MAX,
+    LIVENESS_MIN_BLINKS_REQUIRED, LIVENESS_MOVEMENT_RANGE_THRESHOLD, LIVENESS_MAX_FRAMES_TO_ANALYZE,
+    LIVENESS_TARGET_FPS, LIVENESS_FRAME_STRIDE, LIVENESS_INFERENCE_MAX_DIM, LIVENESS_EARLY_EXIT, LIVENESS_EVAL_EVERY_FRAMES,
+    LIVENESS_DEBUG_LOG_EVERY,
+)
+
+# Liveness анализ на селфи видео: мигания (EAR) и движение на главата (обхват на върха на носа).
+# Решението е същото като в оригиналния цикъл от server.py, но:
+#  - анализира се всеки stride-и кадър (пропуснатите само се grab()-ват, без retrieve()/BGR конверсия);
+#  - FaceMesh работи върху умален кадър (landmark-ите са нормализирани, така че пикселните
+#    координати се смятат спрямо оригиналния размер и праговете не се променят). Правилото е същото, но
+#    истинският FaceMesh дава леко различни landmark-и върху умаления кадър – за входове като в оригинала
+#    LIVENESS_INFERENCE_MAX_DIM=0;
+#  - EAR се изчислява векторно за натрупаните кадри, а анализът спира веднага щом критериите са изпълнени.
+
+logger = logging.getLogger(__name__)
+
+LEFT_EYE_INDICES_FOR_EAR = [33, 160, 158, 133, 153, 144]
+RIGHT_EYE_INDICES_FOR_EAR = [263, 387, 385, 362, 380, 373]
+NOSE_TIP_INDEX = 1
+# Ред в масива с landmark-и на кадър: 6 точки ляво око, 6 точки дясно око, връх на носа
+LANDMARK_INDICES = LEFT_EYE_INDICES_FOR_EAR + RIGHT_EYE_INDICES_FOR_EAR + [NOSE_TIP_INDEX]
+MIN_NOSE_POSITIONS_FOR_MOVEMENT = 10
+DEFAULT_EAR = 0.35
+
+
+def eye_aspect_ratios(eyes: np.ndarray) -> np.ndarray:
+    """EAR за масив от очи с форма (n, 6, 2) в пиксели. Дегенерирано око (C≈0) дава DEFAULT_EAR."""
+    eyes = np.asarray(eyes, dtype=np.float64)
+    a = np.linalg.norm(eyes[:, 1] - eyes[:, 5], axis=1)
+    b = np.linalg.norm(eyes[:, 2] - eyes[:, 4], axis=1)
+    c = np.linalg.norm(eyes[:, 0] - eyes[:, 3], axis=1)
+    ears = np.full(len(eyes), DEFAULT_EAR)
+    valid = c >= 1e-7
+    ears[valid] = (a[valid] + b[valid]) / (2.0 * c[valid])
+    return ears
+
+
+def calculate_ear(eye_landmarks_pixels) -> float:
+    try: return float(eye_aspect_ratios(np.asarray(eye_landmarks_pixels)[None, :, :])[0])
+    except Exception as e_ear_calc:
+        logger.debug(f"Грешка при изчисляване на EAR: {e_ear_calc}")
+        return DEFAULT_EAR
+
+
+def frame_stride_for(source_fps: float, target_fps: float = LIVENESS_TARGET_FPS, default_stride: int = LIVENESS_FRAME_STRIDE) -> int:
+    if target_fps and source_fps and source_fps > 0:
+        return max(1, int(round(source_fps / target_fps)))
+    return max(1, default_stride)
+
+
+def downscale_for_inference(frame: np.ndarray, max_dim: int = LIVENESS_INFERENCE_MAX_DIM) -> np.ndarray:
+    h, w = frame.shape[:2]
+    if not max_dim or max(h, w) <= max_dim: return frame
+    scale = max_dim / max(h, w)
+    return cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+
+class BlinkCounter:
+    """Брояч на мигания върху поредица от EAR стойности.
+
+    Мигане е поредица от кадри с EAR под прага с дължина между min_frames и max_frames (в изходни кадри).
+    При stride > 1 поредица от run анализирани кадъра отговаря на (run - 1) * stride + 1 до run * stride
+    кадъра на видеото; приема се, ако този интервал се застъпва с [min_frames, max_frames].
+    При stride 1 това е точно старото правило.
+    """
+
+    def __init__(self, threshold: float = LIVENESS_EAR_THRESHOLD, min_frames: int = LIVENESS_EAR_CONSEC_FRAMES_MIN,
+                 max_frames: int = LIVENESS_EAR_CONSEC_FRAMES_MAX, frame_weight: int = 1):
+        self.threshold = threshold
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.frame_weight = frame_weight
+        self.blinks = 0
+        self._run = 0
+
+    def _is_blink(self) -> bool:
+        if not self._run: return False
+        shortest, longest = (self._run - 1) * self.frame_weight + 1, self._run * self.frame_weight
+        return shortest <= self.max_frames and longest >= self.min_frames
+
+    def update(self, ears: np.ndarray):
+        for closed in (ears < self.threshold):
+            if closed: self._run += 1
+            else:
+                if self._is_blink(): self.blinks += 1
+                self._run = 0
+
+    def finish(self):
+        # Мигане, което не е завършило до последния анализиран кадър
+        if self._is_blink(): self.blinks += 1
+        self._run = 0
+
+
+class LivenessAnalyzer:
+    """Подават се кадри с feed(); връща True, когато анализът може да спре (критериите са изпълнени)."""
+
+    def __init__(self, face_mesh, stride: int = 1, inference_max_dim: int = LIVENESS_INFERENCE_MAX_DIM,
+                 max_frames: int = LIVENESS_MAX_FRAMES_TO_ANALYZE, early_exit: bool = LIVENESS_EARLY_EXIT,
+                 eval_every: int = LIVENESS_EVAL_EVERY_FRAMES, should_stop=None):
+        self.face_mesh = face_mesh
+        self.should_stop = should_stop
+        self.stride = max(1, stride)
+        self.inference_max_dim = inference_max_dim
+        self.max_frames = max_frames
+        self.early_exit = early_exit
+        self.eval_every = max(1, eval_every)
+        self.blink_counter = BlinkCounter(frame_weight=self.stride)
+        self.frames_seen = 0
+        self.frames_analyzed = 0
+        self.stopped_early = False
+        self.cancelled = False
+        self._landmarks = np.empty((max_frames // self.stride + 1, len(LANDMARK_INDICES), 2), dtype=np.float64)
+        self._count = 0
+        self._evaluated = 0
+        self._nose_min = None
+        self._nose_max = None
+        self._evaluations = 0
+        # Време в FaceMesh (умаляване + инференция), за метриката face_mesh
+        self.inference_sec = 0.0
+
+    def wants_frame(self, frame_idx: int) -> bool:
+        return frame_idx % self.stride == 0
+
+    def feed(self, frame_idx: int, frame: np.ndarray) -> bool:
+        if self.should_stop is not None and self.should_stop():
+            # Друг етап на заявката вече е неуспешен – резултатът няма да се използва.
+            self.cancelled = True
+            logger.info(f"Liveness анализът е отменен на кадър {frame_idx}.")
+            return True
+        self.frames_seen = frame_idx + 1
+        inference_started = time.perf_counter()
+        small = downscale_for_inference(frame, self.inference_max_dim)
+        rgb_frame = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+        rgb_frame.flags.writeable = False; results = self.face_mesh.process(rgb_frame)
+        self.inference_sec += time.perf_counter() - inference_started
+        self.frames_analyzed += 1
+        if results.multi_face_landmarks:
+            frame_h, frame_w = frame.shape[:2]
+            landmark = results.multi_face_landmarks[0].landmark
+            if self._count < len(self._landmarks):
+                self._landmarks[self._count] = [(landmark[i].x * frame_w, landmark[i].y * frame_h) for i in LANDMARK_INDICES]
+                self._count += 1
+        if self._count - self._evaluated >= self.eval_every:
+            self._evaluate()
+            if self.early_exit and self.criteria_met():
+                self.stopped_early = True
+                logger.info(f"Liveness критериите са изпълнени на кадър {frame_idx} – анализът спира.")
+                return True
+        return False
+
+    def _evaluate(self):
+        if self._count == self._evaluated: return
+        batch = self._landmarks[self._evaluated:self._count]
+        ears = (eye_aspect_ratios(batch[:, 0:6]) + eye_aspect_ratios(batch[:, 6:12])) / 2.0
+        self.blink_counter.update(ears)
+        nose = batch[:, 12]
+        batch_min, batch_max = nose.min(axis=0), nose.max(axis=0)
+        self._nose_min = batch_min if self._nose_min is None else np.minimum(self._nose_min, batch_min)
+        self._nose_max = batch_max if self._nose_max is None else np.maximum(self._nose_max, batch_max)
+        # Семплирано: форматирането на реда за всяка група кадри е забележим разход при DEBUG
+        if self._evaluations % max(1, LIVENESS_DEBUG_LOG_EVERY) == 0 and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Кадри {self._evaluated}-{self._count - 1} с лице: EAR min={ears.min():.3f}, max={ears.max():.3f}, мигания={self.blink_counter.blinks} (Праг: {LIVENESS_EAR_THRESHOLD})")
+        self._evaluations += 1
+        self._evaluated = self._count
+
+    def head_moved(self) -> bool:
+        if self._evaluated <= MIN_NOSE_POSITIONS_FOR_MOVEMENT or self._nose_min is None: return False
+        x_range, y_range = self._nose_max - self._nose_min
+        return bool(x_range > LIVENESS_MOVEMENT_RANGE_THRESHOLD or y_range > LIVENESS_MOVEMENT_RANGE_THRESHOLD)
+
+    def criteria_met(self) -> bool:
+        return self.blink_counter.blinks >= LIVENESS_MIN_BLINKS_REQUIRED and self.head_moved()
+
+    def result(self) -> dict:
+        self._evaluate()
+        if not self.stopped_early and not self.cancelled: self.blink_counter.finish()
+        if self._nose_min is not None:
+            x_range, y_range = self._nose_max - self._nose_min
+            logger.debug(f"Движение на носа: X обхват={x_range:.2f}, Y обхват={y_range:.2f}")
+        return {"blinks": self.blink_counter.blinks, "head_moved": self.head_moved(),
+                "frames_seen": self.frames_seen, "frames_analyzed": self.frames_analyzed,
+                "frames_with_face": self._count, "stride": self.stride, "stopped_early": self.stopped_early,
+                "cancelled": self.cancelled, "timings": {"face_mesh": round(self.inference_sec, 4)}}
+
+
+def analyze_video(face_mesh, video_path: str, should_stop=None) -> dict:
+    """Анализ на видео файл. Връща None, ако видеото не може да се отвори."""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        logger.error(f"Не може да се отвори видео файл за liveness: {video_path}")
+        return None
+    started = time.perf_counter()
+    try:
+        analyzer = LivenessAnalyzer(face_mesh, stride=frame_stride_for(cap.get(cv2.CAP_PROP_FPS)), should_stop=should_stop)
+        frame_idx = 0
+        while frame_idx < analyzer.max_frames:
+            if not analyzer.wants_frame(frame_idx):
+                # grab() без retrieve() пропуска кадъра без конверсия и копиране до BGR изображение
+                if not cap.grab(): break
+                frame_idx += 1
+                continue
+            ret, frame = cap.read()
+            if not ret: break
+            if analyzer.feed(frame_idx, frame): break
+            frame_idx += 1
+        result = analyzer.result()
+        result["timings"]["video_decode"] = round(time.perf_counter() - started - analyzer.inference_sec, 4)
+        return result
+    finally:
+        cap.release()
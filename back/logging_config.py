@@ -0,0 +1,38 @@
+import queue
+import logging
+import logging.handlers
+from multiprocessing import util as mp_util
+
+from config import LOG_FORMAT, LOG_DATEFMT, LOG_LEVEL
+
+# Неблокиращо логване: handler-ът на root logger-а само слага записа в опашка, а форматирането и писането
+# в stderr стават в отделна нишка (QueueListener). Така event loop-ът на сървъра и цикълът по кадрите
+# в worker-ите не чакат I/O на конзолата. Всеки процес (сървър, worker) има собствен listener.
+
+_listener = None
+
+
+def setup_logging(level: str = LOG_LEVEL):
+    """Идемпотентно; извиква се веднъж в сървърния процес и в init_worker() на всеки worker."""
+    global _listener
+    if _listener is not None: return _listener
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers): root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    # Finalize (а не atexit): изпълнява се и при изхода на процесите от multiprocessing пула,
+    # така че записите, останали в опашката, се изписват.
+    mp_util.Finalize(None, stop_logging, exitpriority=10)
+    return _listener
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,156 @@
+import time
+import logging
+
+import numpy as np
+
+from config import LIVENESS_AUDIO_RMS_THRESHOLD, LIVENESS_AUDIO_DURATION_SEC
+import liveness
+
+# Еднократно четене на селфи видеото: PyAV демултиплексира контейнера в процеса (без ffmpeg подпроцес),
+# видео кадрите отиват към LivenessAnalyzer, а първите LIVENESS_AUDIO_DURATION_SEC секунди аудио –
+# към инкрементален RMS акумулатор. Без PyAV се използва старият път: cv2.VideoCapture + MoviePy.
+try:
+    import av
+    PYAV_AVAILABLE = True
+except ImportError:
+    PYAV_AVAILABLE = False
+    logging.warning("PyAV не е намерен. Видеото и аудиото ще се четат поотделно (cv2 + MoviePy).")
+
+try:
+    from moviepy.editor import VideoFileClip
+    MOVIEPY_AVAILABLE = True
+except ImportError:
+    MOVIEPY_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+class RmsAccumulator:
+    """RMS на моно сигнал, подаван на парчета, до max_samples семпъла."""
+
+    def __init__(self, max_samples: int):
+        self.max_samples = max_samples
+        self.samples = 0
+        self._sum_squares = 0.0
+
+    @property
+    def full(self) -> bool:
+        return self.samples >= self.max_samples
+
+    def add(self, mono: np.ndarray):
+        mono = mono[:self.max_samples - self.samples]
+        self._sum_squares += float(np.dot(mono, mono))
+        self.samples += len(mono)
+
+    def rms(self) -> float:
+        return (self._sum_squares / self.samples) ** 0.5 if self.samples else 0.0
+
+
+def _audio_frame_to_mono(frame) -> np.ndarray:
+    # Като MoviePy to_soundarray(): стойности в [-1, 1], каналите се осредняват.
+    data = frame.to_ndarray()
+    channels = len(frame.layout.channels)
+    if frame.format.is_planar: data = data.reshape(channels, -1).T
+    else: data = data.reshape(-1, channels)
+    if np.issubdtype(data.dtype, np.unsignedinteger):
+        half = np.iinfo(data.dtype).max / 2.0 + 0.5
+        data = (data.astype(np.float64) - half) / half
+    elif np.issubdtype(data.dtype, np.integer):
+        data = data.astype(np.float64) / (np.iinfo(data.dtype).max + 1.0)
+    return data.mean(axis=1, dtype=np.float64)
+
+
+def demux_selfie_video(face_mesh, video_path: str, duration_sec: float = LIVENESS_AUDIO_DURATION_SEC,
+                       threshold: float = LIVENESS_AUDIO_RMS_THRESHOLD, require_audio: bool = False, should_stop=None):
+    """Едно преминаване през контейнера. Връща (video_result или None, audio_present)."""
+    started = time.perf_counter()
+    try:
+        container = av.open(video_path)
+    except Exception as e_open:
+        logger.error(f"Не може да се отвори видео файл за liveness: {video_path} ({e_open})")
+        return None, False
+    with container:
+        if not container.streams.video:
+            logger.error(f"Няма видео поток във файла: {video_path}")
+            return None, False
+        video_stream = container.streams.video[0]
+        audio_stream = container.streams.audio[0] if container.streams.audio else None
+        if audio_stream is None:
+            logger.warning(f"Не е намерено аудио в клипа: {video_path}")
+            if require_audio:
+                # Без аудио liveness не може да премине – видеото изобщо не се декодира.
+                return {"blinks": 0, "head_moved": False, "rejected": "NO_AUDIO_TRACK"}, False
+        video_stream.thread_type = "AUTO"
+
+        analyzer = liveness.LivenessAnalyzer(face_mesh, stride=liveness.frame_stride_for(float(video_stream.average_rate or 0)), should_stop=should_stop)
+        audio_rms = RmsAccumulator(int((audio_stream.rate or 44100) * duration_sec)) if audio_stream is not None else None
+        video_done = False; frame_idx = 0; audio_sec = 0.0
+        streams = [video_stream] + ([audio_stream] if audio_stream is not None else [])
+
+        try:
+            for packet in container.demux(*streams):
+                if packet.stream is video_stream:
+                    if video_done: continue
+                    for frame in packet.decode():
+                        if analyzer.wants_frame(frame_idx) and analyzer.feed(frame_idx, frame.to_ndarray(format="bgr24")):
+                            video_done = True
+                        frame_idx += 1
+                        if frame_idx >= analyzer.max_frames: video_done = True
+                        if video_done: break
+                elif audio_rms is not None and not audio_rms.full:
+                    audio_started = time.perf_counter()
+                    for frame in packet.decode():
+                        audio_rms.add(_audio_frame_to_mono(frame))
+                    audio_sec += time.perf_counter() - audio_started
+                if analyzer.cancelled or (video_done and (audio_rms is None or audio_rms.full)): break
+        except Exception as e_decode:
+            logger.warning(f"Грешка при декодиране на {video_path}: {e_decode}. Използват се вече прочетените кадри.")
+
+        video_result = analyzer.result()
+        # Видео декодирането е времето на цикъла без FaceMesh и без аудиото
+        video_result["timings"].update(video_decode=round(time.perf_counter() - started - analyzer.inference_sec - audio_sec, 4), audio_check=round(audio_sec, 4))
+        if audio_rms is None or audio_rms.samples == 0:
+            if audio_rms is not None: logger.warning(f"Аудио данните са празни: {video_path}")
+            return video_result, False
+        rms = audio_rms.rms()
+        logger.info(f"Аудио RMS: {rms:.4f} (Праг: {threshold})")
+        return video_result, rms > threshold
+
+
+def check_audio_presence(video_path, threshold=LIVENESS_AUDIO_RMS_THRESHOLD, duration_sec=LIVENESS_AUDIO_DURATION_SEC):
+    if not MOVIEPY_AVAILABLE:
+        logger.warning("MoviePy не е налична, аудио проверката се пропуска.")
+        return False
+    try:
+        logger.info(f"Анализ на аудио от: {video_path}")
+        with VideoFileClip(video_path, audio=True, verbose=False) as clip:
+            if clip.audio is None: logger.warning(f"Не е намерено аудио в клипа: {video_path}"); return False
+            actual_duration = clip.duration
+            target_fps = clip.audio.fps if clip.audio.fps else 44100
+            if actual_duration is None or actual_duration == 0:
+                audio_data = clip.audio.to_soundarray(fps=target_fps, nbytes=2, buffersize=2000)
+            else:
+                audio_segment = clip.audio.subclip(0, min(duration_sec, actual_duration))
+                if audio_segment is None or audio_segment.fps is None: logger.warning(f"Невалиден аудио сегмент: {video_path}"); return False
+                audio_data = audio_segment.to_soundarray(fps=target_fps, nbytes=2, buffersize=2000)
+            if audio_data.ndim > 1: audio_data = audio_data.mean(axis=1)
+            if audio_data.size == 0: logger.warning(f"Аудио данните са празни: {video_path}"); return False
+            rms = np.sqrt(np.mean(np.square(audio_data)))
+            logger.info(f"Аудио RMS: {rms:.4f} (Праг: {threshold})")
+            return rms > threshold
+    except Exception as e_audio:
+        logger.error(f"Грешка при аудио анализ за {video_path} (MoviePy/ffmpeg): {e_audio}", exc_info=False)
+        logger.warning("Аудио проверката се провали. За целите на liveness, това ще се счита за липса на аудио (връща False).")
+        return False
+
+
+def analyze_selfie_video(face_mesh, video_path: str, require_audio: bool = False, should_stop=None):
+    """Liveness кадри + аудио за селфи видео. Връща (video_result или None, audio_present)."""
+    if PYAV_AVAILABLE:
+        return demux_selfie_video(face_mesh, video_path, require_audio=require_audio, should_stop=should_stop)
+    video_result = liveness.analyze_video(face_mesh, video_path, should_stop=should_stop)
+    if video_result is None or video_result["cancelled"]: return video_result, False
+    audio_started = time.perf_counter()
+    audio_present = check_audio_presence(video_path)
+    video_result["timings"]["audio_check"] = round(time.perf_counter() - audio_started, 4)
+    return video_result, audio_present
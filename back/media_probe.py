@@ -0,0 +1,122 @@
+import struct
+from typing import Optional
+
+# Разпознаване на качените файлове по първите байтове и продължителност на видеото по заглавната част на
+# контейнера, докато файлът още пристига (вж. upload_ingest.py). Само стандартната библиотека.
+
+SNIFF_BYTES = 12
+IMAGE_SIGNATURES = ((b"\xff\xd8\xff", "jpeg"), (b"\x89PNG\r\n\x1a\n", "png"))
+# MP4/MOV/3GP започват с кутия ftyp (старите QuickTime файлове – направо с moov/mdat/wide/free)
+MP4_LEADING_BOXES = (b"ftyp", b"moov", b"mdat", b"wide", b"free")
+EBML_MAGIC = b"\x1a\x45\xdf\xa3"
+
+
+def sniff_image(head: bytes) -> Optional[str]:
+    for signature, kind in IMAGE_SIGNATURES:
+        if head.startswith(signature): return kind
+    return None
+
+
+def sniff_video(head: bytes) -> Optional[str]:
+    if head[4:8] in MP4_LEADING_BOXES: return "mp4"
+    if head.startswith(EBML_MAGIC): return "webm"
+    return None
+
+
+class Mp4DurationProbe:
+    """Продължителност от mvhd (в moov) на MP4/MOV, докато файлът пристига; mdat и другите кутии се прескачат."""
+
+    def __init__(self):
+        self._buf = b""
+        self._skip = 0
+        self.done = False
+        self.duration = None
+
+    def feed(self, data: bytes):
+        if self.done: return
+        if self._skip:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped; data = data[skipped:]
+        self._buf += data
+        while not self.done and not self._skip and len(self._buf) >= 8:
+            buf = self._buf
+            size, box_type = struct.unpack(">I4s", buf[:8]); header = 8
+            if size == 1:
+                if len(buf) < 16: return
+                size = struct.unpack(">Q", buf[8:16])[0]; header = 16
+            if box_type == b"moov":
+                # mvhd е дете на moov – продължаваме с децата му вместо да прескочим кутията
+                self._buf = buf[header:]
+                continue
+            if box_type == b"mvhd":
+                if len(buf) < header + 32: return
+                if buf[header] == 1: timescale, duration = struct.unpack(">IQ", buf[header + 20:header + 32])
+                else: timescale, duration = struct.unpack(">II", buf[header + 12:header + 20])
+                self.duration = duration / timescale if timescale and duration else None
+                self.done = True; self._buf = b""
+                return
+            if size < header:
+                # size 0 (кутията продължава до края на файла) или повреден размер – продължителността е неизвестна
+                self.done = True; self._buf = b""
+                return
+            self._skip = max(0, size - len(buf)); self._buf = buf[size:]
+
+
+def _ebml_vint(buf: bytes, pos: int, keep_marker: bool):
+    # EBML число с променлива дължина: броят водещи нули в първия байт + 1 е дължината в байтове
+    first = buf[pos]
+    length = 9 - first.bit_length() if first else 9
+    if length > 8 or pos + length > len(buf): raise IndexError
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in buf[pos + 1:pos + length]: value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1: value = None  # неизвестен размер
+    return value, pos + length
+
+
+class WebmDurationProbe:
+    """Продължителност от Segment > Info (TimecodeScale, Duration) на WebM/Matroska в първите limit байта.
+
+    Записите на MediaRecorder обикновено нямат Duration – тогава продължителността остава неизвестна.
+    """
+
+    SEGMENT, INFO, CLUSTER = 0x18538067, 0x1549A966, 0x1F43B675
+    TIMECODE_SCALE, DURATION = 0x2AD7B1, 0x4489
+
+    def __init__(self, limit: int = 64 * 1024):
+        self._buf = b""
+        self._limit = limit
+        self.done = False
+        self.duration = None
+
+    def feed(self, data: bytes):
+        if self.done: return
+        self._buf += data[:self._limit - len(self._buf)]
+        try:
+            self.duration = self._parse(self._buf)
+            self.done = True
+        except IndexError:
+            if len(self._buf) >= self._limit: self.done = True
+        except (struct.error, ValueError):
+            self.done = True
+        if self.done: self._buf = b""
+
+    def _parse(self, buf: bytes) -> Optional[float]:
+        pos = 0
+        while True:
+            element_id, pos = _ebml_vint(buf, pos, True)
+            size, pos = _ebml_vint(buf, pos, False)
+            if element_id == self.SEGMENT: continue
+            if element_id == self.CLUSTER or size is None: return None
+            if element_id != self.INFO:
+                pos += size
+                continue
+            if pos + size > len(buf): raise IndexError
+            end, scale, duration = pos + size, 1_000_000, None
+            while pos < end:
+                child_id, pos = _ebml_vint(buf, pos, True)
+                child_size, pos = _ebml_vint(buf, pos, False)
+                payload = buf[pos:pos + (child_size or 0)]
+                if child_id == self.TIMECODE_SCALE: scale = int.from_bytes(payload, "big")
+                elif child_id == self.DURATION: duration = struct.unpack(">f" if len(payload) == 4 else ">d", payload)[0]
+                pos += child_size or 0
+            return duration * scale / 1e9 if duration else None
@@ -0,0 +1,146 @@
+import math
+import threading
+
+# Минимален регистър от метрики в текстовия формат на Prometheus (GET /metrics), без външни зависимости.
+# Метриките живеят в сървърния процес; worker-ите връщат времената на стъпките си в резултатите на задачите.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Секунди: от бързите стъпки (разстояние, запис) до liveness анализа на цяло видео
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra: parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value): return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock: self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> list:
+        with self._lock: items = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock: self._values[key] = float(value)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None: entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = entry[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value; entry[2] += 1
+
+    def render(self) -> list:
+        with self._lock: items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._values.items())
+        lines = self._header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+http_request_duration = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "Време за обработка на HTTP заявка.", ("method", "route", "status")))
+verification_requests = REGISTRY.register(Counter(
+    "verification_requests_total", "Приключили верификации по изход (SUCCESS или код на грешката).", ("outcome",)))
+verification_duration = REGISTRY.register(Histogram(
+    "verification_duration_seconds", "Общо време на една верификация по изход.", ("outcome",)))
+verification_stage_duration = REGISTRY.register(Histogram(
+    "verification_stage_duration_seconds", "Време на етап от верификацията (StageTracker) по изход на заявката.", ("stage", "outcome")))
+verification_step_duration = REGISTRY.register(Histogram(
+    "verification_step_duration_seconds", "Време на стъпка в етап (декодиране, FaceMesh, детекция, запис...) по изход на заявката.", ("step", "outcome")))
+pool_in_flight = REGISTRY.register(Gauge("verification_pool_in_flight", "Приети верификации, които още заемат слот в пула."))
+pool_capacity = REGISTRY.register(Gauge("verification_pool_capacity", "Максимален брой едновременно приети верификации."))
+pool_ready = REGISTRY.register(Gauge("verification_pool_ready", "1, ако всички worker-и са заредили моделите си."))
+
+
+def outcome_of(status_code: int, content) -> str:
+    """Етикетът outcome: SUCCESS или кодът на грешката от отговора (LIVENESS_FAILED, VERIFICATION_FAILED, ...)."""
+    if status_code is None: return "CANCELLED"
+    if status_code == 200: return "SUCCESS"
+    if isinstance(content, dict):
+        detail = content.get("detail")
+        code = content.get("code") or (detail.get("code") if isinstance(detail, dict) else None)
+        if code: return str(code)
+    return f"HTTP_{status_code}"
+
+
+def record_verification(tracker, outcome: str):
+    """Записва времената на една приключила верификация (етапи + стъпки от worker-ите) с етикет outcome."""
+    for entry in tracker.snapshot():
+        if entry["duration_sec"] is None: continue
+        verification_stage_duration.observe(entry["duration_sec"], stage=entry["name"], outcome=outcome)
+    for step, seconds in tracker.step_timings:
+        verification_step_duration.observe(seconds, step=step, outcome=outcome)
+    verification_requests.inc(outcome=outcome)
+    verification_duration.observe(tracker.elapsed(), outcome=outcome)
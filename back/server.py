@@ -1,41 +1,42 @@
+import time
+IMPORT_STARTED_AT = time.perf_counter()
 import os
 import shutil
+import asyncio
 import logging
-import time
-import traceback 
-from tempfile import TemporaryDirectory
-from typing import Optional 
+import traceback
+from tempfile import TemporaryDirectory, mkdtemp
+from typing import Optional, List
 
-import cv2 
-from deepface import DeepFace 
-from fastapi import FastAPI, File, UploadFile, HTTPException, status, Request, Form 
+from fastapi import FastAPI, HTTPException, status, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import uvicorn 
-
-try:
-    import mediapipe as mp
-    from moviepy.editor import VideoFileClip 
-    import numpy as np 
-    from scipy.spatial import distance as dist 
-    MEDIAPIPE_AVAILABLE = True
-    MOVIEPY_AVAILABLE = True 
-except ImportError as e_import:
-    MEDIAPIPE_AVAILABLE = False
-    MOVIEPY_AVAILABLE = False 
-    logging.warning(f"Една или повече библиотеки за Liveness (MediaPipe, MoviePy, SciPy, NumPy) не са намерени ({e_import}). Liveness детекцията ще бъде ограничена или деактивирана.")
-
-logging.basicConfig(
-    level=logging.DEBUG, 
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel
+import uvicorn
+
+from config import (
+    PERMANENT_BASE_USER_FILES_DIR,
+    VERIFY_POOL_SIZE, VERIFY_QUEUE_SIZE, VERIFY_JOB_TIMEOUT_SEC, VERIFY_RETRY_AFTER_SEC,
+    VERIFY_JOBS_CONCURRENCY, VERIFY_JOBS_QUEUE_SIZE, VERIFY_JOB_RESULT_TTL_SEC,
+    VERIFY_BATCH_SIZE, VERIFY_BATCH_CONCURRENCY, UPLOAD_MAX_CONCURRENT,
 )
+from worker_pool import VerificationPool, PoolSaturatedError, JobTimeoutError
+from verification_pipeline import StageTracker, run_verification, embedding_cache_counters, server_embedding_cache
+from upload_ingest import ingest_upload, UploadRejected, UploadSlots
+from verification_jobs import VerificationJob, VerificationJobQueue, JobQueueFullError
+from batch_verification import iter_verified_users, stream_reverification
+from logging_config import setup_logging, stop_logging
+import metrics
+import verification_tasks
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
 app = FastAPI(
     title="Identity Verification API (Conditional User File Storage)",
     description="API for verifying identity. Files are saved in user-specific named folders only upon full verification success.",
-    version="1.4.9" # Актуализирана версия
+    version="1.5.0" # Актуализирана версия
 )
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
@@ -45,327 +46,193 @@ async def add_process_time_header(request: Request, call_next):
     response = await call_next(request)
     process_time = time.time() - start_time
     response.headers["X-Process-Time"] = f"{process_time:.4f}"
+    # Шаблонът на пътя (напр. /verify/jobs/{job_id}), за да не расте броят серии с всеки job id
+    route = request.scope.get("route")
+    metrics.http_request_duration.observe(process_time, method=request.method, route=getattr(route, "path", "unmatched"), status=response.status_code)
     logger.info(f"Request {request.method} {request.url.path} processed in {process_time:.4f} seconds")
     return response
 
-MODEL_NAME = "SFace"
-DETECTOR_BACKEND = "mtcnn"
-DISTANCE_METRIC = "cosine"
-
-PERMANENT_BASE_USER_FILES_DIR = "user_verification_data_verified" 
-PHOTO_SUBDIR_NAME = "photos" 
-VIDEO_SUBDIR_NAME = "videos" 
 os.makedirs(PERMANENT_BASE_USER_FILES_DIR, exist_ok=True)
 
-DUMMY_IMAGE_PATH = "dummy.jpg" 
-
-LIVENESS_EAR_THRESHOLD = 0.20 
-LIVENESS_EAR_CONSEC_FRAMES_MIN = 2 
-LIVENESS_EAR_CONSEC_FRAMES_MAX = 5 
-LIVENESS_MIN_BLINKS_REQUIRED = 1   
-LIVENESS_MOVEMENT_RANGE_THRESHOLD = 5.0 
-LIVENESS_AUDIO_RMS_THRESHOLD = 0.005 
-LIVENESS_MAX_FRAMES_TO_ANALYZE = 75 
-REQUIRE_AUDIO_FOR_LIVENESS = False 
-
-mp_face_mesh_solution = None
-face_mesh_detector = None
-if MEDIAPIPE_AVAILABLE:
-    # ... (кодът за зареждане на MediaPipe остава същият) ...
-    model_file_to_check = os.path.join(os.path.dirname(mp.__file__), 'modules', 'face_landmark', 'face_landmark_front_cpu.binarypb')
-    if os.path.exists(model_file_to_check):
-        try:
-            with open(model_file_to_check, 'rb') as f_model_check: f_model_check.read(16)
-            mp_face_mesh_solution = mp.solutions.face_mesh
-            face_mesh_detector = mp_face_mesh_solution.FaceMesh(
-                static_image_mode=False, max_num_faces=1,
-                min_detection_confidence=0.5, min_tracking_confidence=0.5)
-            logger.info("MediaPipe Face Mesh detector loaded successfully.")
-        except Exception as e_mp_init:
-            logger.error(f"Грешка при инициализация на MediaPipe FaceMesh: {e_mp_init}", exc_info=True)
-            face_mesh_detector = None 
-    else:
-        logger.error(f"MediaPipe модел файл НЕ Е НАМЕРЕН: {model_file_to_check}")
-        face_mesh_detector = None 
-else:
-    logger.warning("MediaPipe не е налична. Liveness detection features will be disabled.")
-
-try:
-    if os.path.exists(DUMMY_IMAGE_PATH): DeepFace.extract_faces(DUMMY_IMAGE_PATH, detector_backend=DETECTOR_BACKEND, enforce_detection=False)
-    logger.info(f"DeepFace model '{MODEL_NAME}' and detector '{DETECTOR_BACKEND}' pre-loaded/checked.")
-except Exception as e: logger.error(f"Error pre-loading DeepFace: {e}", exc_info=True)
-
-
-def calculate_ear(eye_landmarks_pixels):
-    # ... (кодът остава същият) ...
-    try:
-        A = dist.euclidean(eye_landmarks_pixels[1], eye_landmarks_pixels[5])
-        B = dist.euclidean(eye_landmarks_pixels[2], eye_landmarks_pixels[4])
-        C = dist.euclidean(eye_landmarks_pixels[0], eye_landmarks_pixels[3])
-        if C < 1e-7: return 0.35 
-        ear = (A + B) / (2.0 * C)
-        return ear
-    except Exception as e_ear_calc: 
-        logger.debug(f"Грешка при изчисляване на EAR: {e_ear_calc}")
-        return 0.35 
-
-LEFT_EYE_INDICES_FOR_EAR = [33, 160, 158, 133, 153, 144] 
-RIGHT_EYE_INDICES_FOR_EAR = [263, 387, 385, 362, 380, 373] 
+# CPU-тежките етапи (преоразмеряване, liveness, аудио, DeepFace) се изпълняват в отделни процеси,
+# за да не блокират event loop-а на uvicorn. Всеки worker зарежда моделите веднъж при старт.
+verification_pool = VerificationPool(
+    size=VERIFY_POOL_SIZE, queue_size=VERIFY_QUEUE_SIZE,
+    job_timeout=VERIFY_JOB_TIMEOUT_SEC, retry_after=VERIFY_RETRY_AFTER_SEC,
+    initializer=verification_tasks.init_worker, warmup=verification_tasks.warmup_task,
+)
+# Едновременните качвания се ограничават отделно – бавен клиент не държи слот в пула, докато тялото пристига.
+upload_slots = UploadSlots(UPLOAD_MAX_CONCURRENT, VERIFY_RETRY_AFTER_SEC)
+# POST /verify/jobs: клиентът получава job id веднага и следи прогреса чрез GET /verify/jobs/{id}.
+verification_jobs = VerificationJobQueue(
+    verification_pool, concurrency=VERIFY_JOBS_CONCURRENCY, queue_size=VERIFY_JOBS_QUEUE_SIZE,
+    result_ttl=VERIFY_JOB_RESULT_TTL_SEC, retry_after=VERIFY_RETRY_AFTER_SEC,
+)
 
-def check_audio_presence(video_path, threshold=LIVENESS_AUDIO_RMS_THRESHOLD, duration_sec=3):
-    # ... (кодът остава същият, с корекцията за ffmpeg_params) ...
-    if not MOVIEPY_AVAILABLE:
-        logger.warning("MoviePy не е налична, аудио проверката се пропуска.")
-        return False 
-    try:
-        logger.info(f"Анализ на аудио от: {video_path}")
-        with VideoFileClip(video_path, audio=True, verbose=False) as clip: 
-            if clip.audio is None: logger.warning(f"Не е намерено аудио в клипа: {video_path}"); return False
-            actual_duration = clip.duration
-            target_fps = clip.audio.fps if clip.audio.fps else 44100
-            if actual_duration is None or actual_duration == 0:
-                audio_data = clip.audio.to_soundarray(fps=target_fps, nbytes=2, buffersize=2000)
-            else:
-                audio_segment = clip.audio.subclip(0, min(duration_sec, actual_duration))
-                if audio_segment is None or audio_segment.fps is None: logger.warning(f"Невалиден аудио сегмент: {video_path}"); return False
-                audio_data = audio_segment.to_soundarray(fps=target_fps, nbytes=2, buffersize=2000) 
-            if audio_data.ndim > 1: audio_data = audio_data.mean(axis=1)
-            if audio_data.size == 0: logger.warning(f"Аудио данните са празни: {video_path}"); return False
-            rms = np.sqrt(np.mean(np.square(audio_data))) 
-            logger.info(f"Аудио RMS: {rms:.4f} (Праг: {threshold})")
-            return rms > threshold
-    except Exception as e_audio:
-        logger.error(f"Грешка при аудио анализ за {video_path} (MoviePy/ffmpeg): {e_audio}", exc_info=False)
-        logger.warning("Аудио проверката се провали. За целите на liveness, това ще се счита за липса на аудио (връща False).")
-        return False
+@app.on_event("startup")
+async def start_verification_pool():
+    # Worker-ите зареждат и загряват моделите във фонов режим; /health/ready връща 200 едва след това.
+    started = time.perf_counter()
+    verification_pool.start()
+    verification_jobs.start()
+    logger.info(f"Startup: {time.perf_counter() - IMPORT_STARTED_AT:.2f} s от импорта на server.py (стартиране на пула: {time.perf_counter() - started:.3f} s); загряване на worker-ите...")
 
-def resize_image(image_path: str, max_dim: int = 640, quality: int = 85) -> bool:
-    # ... (кодът остава същият) ...
-    try:
-        img = cv2.imread(image_path)
-        if img is None: return False
-        h, w = img.shape[:2]
-        if max(h, w) <= max_dim: resized_img = img
-        else:
-            scale = max_dim / max(h, w)
-            new_w, new_h = int(w * scale), int(h * scale)
-            try: resized_img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
-            except Exception: return False
-        if not cv2.imwrite(image_path, resized_img, [int(cv2.IMWRITE_JPEG_QUALITY), quality]): return False
-        return True
-    except Exception: return False
+@app.on_event("shutdown")
+async def stop_verification_pool():
+    await verification_jobs.stop()
+    verification_pool.shutdown()
+    stop_logging()
 
-def sanitize_foldername(name_part: Optional[str]) -> str:
-    if name_part is None: return "" 
-    processed_name = str(name_part).replace(" ", "_").strip()
-    return "".join(c for c in processed_name if c.isalnum() or c in ['_', '-'])
 
 @app.get("/")
 def read_root(): return {"message": "Verification server running"}
 
-@app.post("/verify")
-async def verify_identity(
-    user_identifier: str = Form(...), 
-    firstName: Optional[str] = Form(None), 
-    lastName: Optional[str] = Form(None),  
-    idCardFront: UploadFile = File(...), 
-    idCardBack: UploadFile = File(...), 
-    selfie: UploadFile = File(...),
-    video_front_id: Optional[UploadFile] = File(None), 
-    video_back_id: Optional[UploadFile] = File(None), 
-    video_selfie: Optional[UploadFile] = File(None)
-):
-    logger.info(f"Получена заявка за верификация. user_identifier: '{user_identifier}', firstName: '{firstName}', lastName: '{lastName}'")
-    
-    if not all([idCardFront, idCardFront.filename, idCardBack, idCardBack.filename, selfie, selfie.filename]):
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={"status": "error", "code": "MISSING_IMAGE_FILES", "message": "Липсват една или повече от необходимите СНИМКИ или имената на файловете им."})
-
-    timestamp = int(time.time())
-    
-    with TemporaryDirectory(prefix="verification_temp_") as tmp_dir:
-        logger.info(f"Временна директория за всички файлове: {tmp_dir}")
-        
-        temp_image_paths = {}
-        temp_video_paths = {}
-
-        # --- ЗАПИС НА СНИМКИ И ВИДЕА ВЪВ ВРЕМЕННА ДИРЕКТОРИЯ ---
-        all_files_to_process = {
-            "idCardFront": idCardFront, "idCardBack": idCardBack, "selfie": selfie,
-            "video_front_id": video_front_id, "video_back_id": video_back_id, "video_selfie": video_selfie
-        }
-        allowed_image_extensions = {".jpg", ".jpeg", ".png"}
-        # Можете да добавите и проверка за видео разширения, ако е нужно
-
-        for key, uploaded_file in all_files_to_process.items():
-            if uploaded_file and uploaded_file.filename:
-                file_ext = os.path.splitext(uploaded_file.filename)[1].lower()
-                is_image = key.startswith("idCard") or key == "selfie"
-                
-                if is_image and file_ext not in allowed_image_extensions:
-                    return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"status": "error", "code": "INVALID_IMAGE_FILE_TYPE", "field": key, "message": f"Невалиден тип файл за снимка {key}."})
-                
-                safe_filename = f"{key}_{timestamp}{file_ext}"
-                temp_file_path = os.path.join(tmp_dir, safe_filename)
-                
-                if is_image:
-                    temp_image_paths[key] = temp_file_path
-                else: # е видео
-                    temp_video_paths[key] = temp_file_path
-                
-                try:
-                    with open(temp_file_path, "wb") as f_out: shutil.copyfileobj(uploaded_file.file, f_out)
-                    logger.info(f"Файл '{key}' запазен временно в: {temp_file_path}")
-                except Exception as e_save:
-                    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail={"status": "error", "code": "FILE_SAVE_ERROR", "message": f"Грешка при запис на файл {key}."})
-                finally:
-                    if hasattr(uploaded_file, 'close') and callable(uploaded_file.close): await uploaded_file.close()
-            elif uploaded_file:
-                 logger.warning(f"Файлът за '{key}' няма име и ще бъде пропуснат.")
-                 if hasattr(uploaded_file, 'close') and callable(uploaded_file.close): await uploaded_file.close()
+@app.get("/health/live")
+def health_live(): return {"status": "alive"}
 
-        # Преоразмеряване на снимките
-        if temp_image_paths.get("idCardFront") and not resize_image(temp_image_paths["idCardFront"]):
-            return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"status": "error", "code": "IMAGE_PROCESSING_ERROR", "field": "idCardFront", "message": "Грешка при обработка на снимката на ЛК (предна)." })
-        if temp_image_paths.get("selfie") and not resize_image(temp_image_paths["selfie"]):
-            return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"status": "error", "code": "IMAGE_PROCESSING_ERROR", "field": "selfie", "message": "Грешка при обработка на селфи снимката."})
-        
-        # --- LIVENESS ДЕТЕКЦИЯ ---
-        liveness_check_passed = False 
-        # ... (останалата част от liveness логиката, както беше) ...
-        blinks_counted = 0; head_moved_significantly = False; audio_present_in_selfie_video = False
-        if temp_video_paths.get("video_selfie") and face_mesh_detector: 
-            video_path_selfie_for_liveness = temp_video_paths['video_selfie']
-            # ... (пълната liveness логика от предишната версия) ...
-            logger.info(f"Извършване на Liveness детекция върху: {video_path_selfie_for_liveness}")
-            cap = cv2.VideoCapture(video_path_selfie_for_liveness)
-            if not cap.isOpened(): logger.error(f"Не може да се отвори видео файл за liveness: {video_path_selfie_for_liveness}")
-            else:
-                blink_on_consecutive_frames = 0; nose_positions = []; frame_idx = 0
-                while cap.isOpened() and frame_idx < LIVENESS_MAX_FRAMES_TO_ANALYZE:
-                    ret, frame = cap.read();
-                    if not ret: break
-                    frame_for_mp = frame; rgb_frame = cv2.cvtColor(frame_for_mp, cv2.COLOR_BGR2RGB)
-                    rgb_frame.flags.writeable = False; results = face_mesh_detector.process(rgb_frame); rgb_frame.flags.writeable = True
-                    if results.multi_face_landmarks:
-                        for face_landmarks in results.multi_face_landmarks: 
-                            try:
-                                frame_h, frame_w = frame_for_mp.shape[:2]
-                                left_eye_lm_pixels = np.array([(face_landmarks.landmark[i].x * frame_w, face_landmarks.landmark[i].y * frame_h) for i in LEFT_EYE_INDICES_FOR_EAR], dtype=np.float32)
-                                right_eye_lm_pixels = np.array([(face_landmarks.landmark[i].x * frame_w, face_landmarks.landmark[i].y * frame_h) for i in RIGHT_EYE_INDICES_FOR_EAR], dtype=np.float32)
-                                left_ear = calculate_ear(left_eye_lm_pixels); right_ear = calculate_ear(right_eye_lm_pixels)
-                                avg_ear = (left_ear + right_ear) / 2.0
-                                logger.debug(f"Кадър {frame_idx}: Ляво EAR={left_ear:.3f}, Дясно EAR={right_ear:.3f}, Средно EAR={avg_ear:.3f} (Праг: {LIVENESS_EAR_THRESHOLD})")
-                                if avg_ear < LIVENESS_EAR_THRESHOLD: blink_on_consecutive_frames += 1
-                                else:
-                                    if LIVENESS_EAR_CONSEC_FRAMES_MIN <= blink_on_consecutive_frames <= LIVENESS_EAR_CONSEC_FRAMES_MAX:
-                                        blinks_counted += 1; logger.info(f"Засечено мигане! (Кадър: {frame_idx}, Общо: {blinks_counted})")
-                                    blink_on_consecutive_frames = 0 
-                            except IndexError: logger.warning(f"IndexError за EAR на кадър {frame_idx}.")
-                            except Exception as e_blink: logger.warning(f"Грешка при EAR на кадър {frame_idx}: {e_blink}")
-                            nose_tip = (face_landmarks.landmark[1].x * frame_w, face_landmarks.landmark[1].y * frame_h)
-                            nose_positions.append(nose_tip); break 
-                    frame_idx += 1
-                cap.release()
-                if LIVENESS_EAR_CONSEC_FRAMES_MIN <= blink_on_consecutive_frames <= LIVENESS_EAR_CONSEC_FRAMES_MAX:
-                    blinks_counted += 1; logger.info(f"Засечено мигане (край на цикъла)! (Общо: {blinks_counted})")
-                if len(nose_positions) > 10: 
-                    nose_x_coords = np.array([p[0] for p in nose_positions]); nose_y_coords = np.array([p[1] for p in nose_positions])
-                    x_range = np.ptp(nose_x_coords) if nose_x_coords.size > 0 else 0
-                    y_range = np.ptp(nose_y_coords) if nose_y_coords.size > 0 else 0
-                    logger.debug(f"Движение на носа: X обхват={x_range:.2f}, Y обхват={y_range:.2f}")
-                    if x_range > LIVENESS_MOVEMENT_RANGE_THRESHOLD or y_range > LIVENESS_MOVEMENT_RANGE_THRESHOLD: head_moved_significantly = True
-                audio_present_in_selfie_video = check_audio_presence(video_path_selfie_for_liveness)
-            if blinks_counted >= LIVENESS_MIN_BLINKS_REQUIRED and head_moved_significantly and (audio_present_in_selfie_video or not REQUIRE_AUDIO_FOR_LIVENESS):
-                liveness_check_passed = True
-            logger.info(f"Liveness Резултати: Мигания={blinks_counted}, Движение на главата={head_moved_significantly}, Аудио засечено={audio_present_in_selfie_video} => Liveness Преминал={liveness_check_passed}")
-        
-        elif not face_mesh_detector and MEDIAPIPE_AVAILABLE: liveness_check_passed = True; logger.warning("MediaPipe не е зареден. Liveness пропуснат (симулиран успех).")
-        elif not MEDIAPIPE_AVAILABLE: liveness_check_passed = True; logger.warning("MediaPipe не е налична. Liveness пропуснат (симулиран успех).")
-        else: liveness_check_passed = True; logger.warning("Селфи видео не е предоставено. Liveness пропуснат (симулиран успех).")
+@app.get("/health/ready")
+def health_ready():
+    # Готов е едва когато всички worker-и са заредили и загряли моделите си (вкл. след рестарт на пула).
+    workers = {str(pid): {"ready": worker["ready"], "startup_phases": worker["startup_phases"]} for pid, worker in verification_pool.workers.items()}
+    if not verification_pool.ready:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": str(VERIFY_RETRY_AFTER_SEC)}, content={"status": "starting", "workers": workers})
+    return {"status": "ready", "workers": workers}
 
-        if not liveness_check_passed:
-            return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"status": "error", "code": "LIVENESS_FAILED", "message": "Проверката за реално присъствие е неуспешна."})
-        
-        logger.info("Liveness проверката е успешна. Продължаване с DeepFace.")
-        
-        if not temp_image_paths.get("idCardFront") or not temp_image_paths.get("selfie"):
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail={"status": "error", "code": "INTERNAL_ERROR_MISSING_IMAGE_PATHS", "message": "Вътрешна грешка: липсват пътища до временни снимки."})
+def server_busy_response(retry_after: int) -> JSONResponse:
+    return JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS, headers={"Retry-After": str(retry_after)}, content={"status": "error", "code": "SERVER_BUSY", "message": "Сървърът за верификация е претоварен. Моля, опитайте отново след малко."})
 
-        try:
-            result = DeepFace.verify(
-                img1_path=temp_image_paths["idCardFront"], 
-                img2_path=temp_image_paths["selfie"],      
-                model_name=MODEL_NAME, detector_backend=DETECTOR_BACKEND,
-                distance_metric=DISTANCE_METRIC, enforce_detection=True, align=True
-            )
-            model_threshold = DeepFace.verification.find_threshold(MODEL_NAME, DISTANCE_METRIC)
-            calculated_distance = result.get("distance", 999); is_verified = result.get("verified", False) 
-            logger.info(f"DeepFace Детайли: Разстояние={calculated_distance:.4f}, Праг={model_threshold:.4f}, Резултат={is_verified}")
-
-            if is_verified: 
-                logger.info("Верификацията е успешна. Копиране на файловете на постоянно място...")
-                
-                # Генериране на име на папка, базирано на имената и ID-то
-                folder_name_parts = []
-                if firstName: folder_name_parts.append(sanitize_foldername(firstName))
-                if lastName: folder_name_parts.append(sanitize_foldername(lastName))
-                folder_name_parts.append(str(user_identifier)) 
-                
-                user_specific_folder_name = "_".join(filter(None, folder_name_parts))
-                if not user_specific_folder_name: 
-                    user_specific_folder_name = f"user_{user_identifier}" # Fallback
+@app.post("/verify")
+async def verify_identity(request: Request):
+    # Тялото се чете поточно: превишен лимит или невалидно съдържание прекъсват качването веднага (вж. upload_ingest.py).
+    # Докато тялото пристига, заявката заема само слот за качване; слот в пула (CPU) се заема с първата задача към него.
+    timestamp = int(time.time())
+    tracker = StageTracker()
+    outcome = "INTERNAL_ERROR"
+    job = None
+    liveness_started = None
+
+    def admit_job():
+        nonlocal job
+        if job is None: job = verification_pool.acquire()
+        return job
+
+    def start_liveness(field: str, video_path: str):
+        # Liveness анализът на селфи видеото започва, щом то е качено, без да чака останалите полета.
+        # Чакането на качването е тук, в event loop-а – worker се заема (и timeout-ът тече) едва сега.
+        nonlocal liveness_started
+        if field == "video_selfie":
+            liveness_started = asyncio.ensure_future(admit_job().run(verification_tasks.liveness_task, video_path, job.cancel_token))
 
-                permanent_user_photo_dir = os.path.join(PERMANENT_BASE_USER_FILES_DIR, user_specific_folder_name, PHOTO_SUBDIR_NAME)
-                permanent_user_video_dir = os.path.join(PERMANENT_BASE_USER_FILES_DIR, user_specific_folder_name, VIDEO_SUBDIR_NAME)
-                os.makedirs(permanent_user_photo_dir, exist_ok=True)
-                os.makedirs(permanent_user_video_dir, exist_ok=True)
+    try:
+        with TemporaryDirectory(prefix="verification_temp_") as tmp_dir:
+            logger.info(f"Временна директория за всички файлове: {tmp_dir}")
+            try:
+                # --- ПОТОЧНО КАЧВАНЕ: СНИМКИТЕ В ПАМЕТТА, ВИДЕАТА ВЪВ ВРЕМЕННАТА ДИРЕКТОРИЯ ---
+                with upload_slots.admit(), tracker.stage("upload_save"):
+                    upload = await ingest_upload(request, tmp_dir, timestamp, on_video_received=start_liveness)
+                status_code, content = await run_verification(
+                    admit_job(), tracker, upload["images"], upload["temp_video_paths"],
+                    upload["user_identifier"], upload["firstName"], upload["lastName"], liveness_started=liveness_started)
+            except UploadRejected as e_upload:
+                logger.warning(f"Качването е отхвърлено: {e_upload.content}")
+                status_code, content = e_upload.status_code, e_upload.content
+            finally:
+                # Отхвърлено качване или неуспешен етап преди liveness – анализът на видеото се прекратява
+                if liveness_started is not None:
+                    if not liveness_started.done(): job.cancel_token.cancel(); liveness_started.cancel()
+                    await asyncio.gather(liveness_started, return_exceptions=True)
+            outcome = metrics.outcome_of(status_code, content)
+            return JSONResponse(status_code=status_code, content=content)
+
+    except HTTPException as e_http:
+        outcome = metrics.outcome_of(e_http.status_code, {"detail": e_http.detail})
+        raise
+    except PoolSaturatedError as e_busy:
+        outcome = "SERVER_BUSY"
+        logger.warning(f"Сървърът е претоварен (пул {verification_pool.in_flight}/{verification_pool.capacity}, качвания {upload_slots.in_flight}/{upload_slots.limit}). Заявката е отхвърлена.")
+        return server_busy_response(e_busy.retry_after)
+    except JobTimeoutError as e_timeout:
+        outcome = "VERIFICATION_TIMEOUT"
+        logger.error(f"Времето за обработка на верификацията изтече: {e_timeout}")
+        return JSONResponse(status_code=status.HTTP_504_GATEWAY_TIMEOUT, content={"status": "error", "code": "VERIFICATION_TIMEOUT", "message": "Времето за обработка на верификацията изтече."})
+    finally:
+        if job is not None: job.release()
+        logger.info(f"Етапи на верификацията: {tracker.snapshot()}")
+        metrics.record_verification(tracker, outcome)
+
+@app.post("/verify/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_verification_job(request: Request):
+    # Място в опашката се запазва преди качването: при пълна опашка 429 идва, без да се чете тялото.
+    # Файловете (и снимките) се записват поточно в tmp_dir, а обработката продължава във фонов режим.
+    try:
+        verification_jobs.reserve()
+    except JobQueueFullError as e_busy:
+        logger.warning("Опашката за верификационни задачи е пълна. Заявката е отхвърлена.")
+        return server_busy_response(e_busy.retry_after)
 
-                final_saved_paths_for_db = {"photos": {}, "videos": {}}
+    timestamp = int(time.time())
+    tracker = StageTracker()
+    tmp_dir = mkdtemp(prefix="verification_job_")
+    try:
+        with upload_slots.admit(), tracker.stage("upload_save"):
+            upload = await ingest_upload(request, tmp_dir, timestamp, spill_images=True)
+        job = VerificationJob(tmp_dir, tracker, upload["images"], upload["temp_video_paths"], upload["user_identifier"], upload["firstName"], upload["lastName"])
+    except UploadRejected as e_upload:
+        verification_jobs.release()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        logger.warning(f"Качването е отхвърлено: {e_upload.content}")
+        return JSONResponse(status_code=e_upload.status_code, content=e_upload.content)
+    except PoolSaturatedError as e_busy:
+        verification_jobs.release()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        logger.warning(f"Твърде много едновременни качвания ({upload_slots.in_flight}/{upload_slots.limit}). Заявката е отхвърлена.")
+        return server_busy_response(e_busy.retry_after)
+    except BaseException:
+        verification_jobs.release()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    verification_jobs.submit(job, reserved=True)
+
+    status_url = f"/verify/jobs/{job.id}"
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, headers={"Location": status_url}, content={"status": "accepted", "job_id": job.id, "status_url": status_url})
+
+@app.get("/verify/jobs/{job_id}")
+async def get_verification_job(job_id: str):
+    job = verification_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={"status": "error", "code": "JOB_NOT_FOUND", "message": "Няма верификационна задача с този идентификатор или резултатът е изтекъл."})
+    return job.to_dict()
+
+class BatchVerifyRequest(BaseModel):
+    # Имена на папки или user_identifier-и; без списък се проверяват всички верифицирани потребители
+    users: Optional[List[str]] = None
+    # Праг за косинусово разстояние; по подразбиране – прагът на текущия модел
+    threshold: Optional[float] = None
+    batch_size: int = VERIFY_BATCH_SIZE
+
+@app.post("/verify/batch")
+async def verify_batch(request: BatchVerifyRequest):
+    # Повторна проверка на вече записаните снимки (напр. след смяна на MODEL_NAME/прага). Резултатите са NDJSON –
+    # по един ред на потребител веднага щом партидата му е готова и накрая ред {"summary": ...}.
+    users = await run_in_threadpool(lambda: list(iter_verified_users(PERMANENT_BASE_USER_FILES_DIR, request.users)))
+    logger.info(f"Повторна проверка на {len(users)} потребители (партиди по {request.batch_size}).")
+    return StreamingResponse(
+        stream_reverification(verification_pool, users, request.threshold, request.batch_size, VERIFY_BATCH_CONCURRENCY),
+        media_type="application/x-ndjson")
+
+@app.get("/metrics")
+def get_metrics():
+    metrics.pool_in_flight.set(verification_pool.in_flight)
+    metrics.pool_capacity.set(verification_pool.capacity)
+    metrics.pool_ready.set(1 if verification_pool.ready else 0)
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/embedding-cache/stats")
+async def get_embedding_cache_stats():
+    lookups = embedding_cache_counters["hits"] + embedding_cache_counters["misses"]
+    return {**embedding_cache_counters, "hit_ratio": round(embedding_cache_counters["hits"] / lookups, 4) if lookups else None,
+            "server": server_embedding_cache.stats()}
 
-                for key, temp_path in temp_image_paths.items():
-                    if os.path.exists(temp_path):
-                        permanent_filename = os.path.basename(temp_path) 
-                        permanent_path = os.path.join(permanent_user_photo_dir, permanent_filename)
-                        shutil.copy2(temp_path, permanent_path)
-                        # Запазваме ОТНОСИТЕЛНИЯ път за базата данни, спрямо PERMANENT_BASE_USER_FILES_DIR
-                        final_saved_paths_for_db["photos"][key] = os.path.join(user_specific_folder_name, PHOTO_SUBDIR_NAME, permanent_filename).replace("\\", "/")
-                        logger.info(f"Снимка '{key}' копирана в: {permanent_path}")
-                
-                for key, temp_path in temp_video_paths.items():
-                     if os.path.exists(temp_path):
-                        permanent_filename = os.path.basename(temp_path)
-                        permanent_path = os.path.join(permanent_user_video_dir, permanent_filename)
-                        shutil.copy2(temp_path, permanent_path)
-                        final_saved_paths_for_db["videos"][key] = os.path.join(user_specific_folder_name, VIDEO_SUBDIR_NAME, permanent_filename).replace("\\", "/")
-                        logger.info(f"Видео '{key}' копирано в: {permanent_path}")
-                
-                logger.info(f"Пътищата до файловете за user '{user_specific_folder_name}' (за БД): {final_saved_paths_for_db}")
-                
-                # Връщаме пътищата към Next.js проксито, за да може то да ги запише в Prisma
-                return JSONResponse(
-                    status_code=status.HTTP_200_OK, 
-                    content={
-                        "status": "success", 
-                        "verified": True, 
-                        "distance": round(calculated_distance, 4),
-                        "threshold": round(model_threshold, 4), 
-                        "model": MODEL_NAME, 
-                        "detector": DETECTOR_BACKEND,
-                        "saved_file_paths": final_saved_paths_for_db # НОВО: Връщаме пътищата
-                    }
-                )
-            else: 
-                # Ако DeepFace верификацията е неуспешна, файловете НЕ се копират на постоянно място
-                logger.warning("DeepFace верификацията е неуспешна. Файловете няма да бъдат запазени постоянно.")
-                return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"status": "error", "code": "VERIFICATION_FAILED", "message": "Лицата не съвпадат или не са открити."})
-        
-        except ValueError as ve: 
-            logger.warning(f"Грешка при детекция (DeepFace): {str(ve)}")
-            return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"status": "error", "code": "VERIFICATION_FAILED", "message": "Не е открито лице на някоя от снимките или лицата не съвпадат."})
-        except Exception as e_deepface: 
-            logger.error(f"Неочаквана грешка (DeepFace): {e_deepface}", exc_info=True)
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail={"status": "error", "code": "VERIFICATION_ERROR", "message": "Сървърна грешка при сравняване на лица."})
-    
 if __name__ == "__main__":
     logger.info("Starting Uvicorn server for local development...")
     uvicorn.run("server:app", host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StageFailed(Exception):
+    """Етап, който отхвърля заявката. Носи отговора (status_code, content), който трябва да се върне."""
+
+    def __init__(self, status_code: int, content: dict):
+        super().__init__(content.get("code"))
+        self.status_code = status_code
+        self.content = content
+
+
+class StageGraph:
+    """Малък планировчик: етапите се стартират веднага щом зависимостите им са готови и вървят паралелно.
+
+    Първият етап, който хвърли StageFailed (или друго изключение), прекратява всички останали,
+    а грешката се пропагира към извикващия. on_cancel() се извиква преди отмяната – напр. за да
+    сигнализира на worker процесите да спрат текущата си работа.
+    """
+
+    def __init__(self, tracker, on_cancel=None):
+        self.tracker = tracker
+        self.on_cancel = on_cancel
+        self._stages = {}
+
+    def add(self, name: str, fn, depends_on=()):
+        """fn(results) -> awaitable; results съдържа резултатите на вече завършилите етапи."""
+        self._stages[name] = (fn, tuple(depends_on))
+
+    async def _run_stage(self, name: str, fn, results: dict):
+        with self.tracker.stage(name):
+            return await fn(results)
+
+    async def run(self) -> dict:
+        results = {}
+        pending = dict(self._stages)
+        running = {}
+        try:
+            while pending or running:
+                for name, (fn, depends_on) in list(pending.items()):
+                    if all(dep in results for dep in depends_on):
+                        running[asyncio.create_task(self._run_stage(name, fn, results))] = name
+                        del pending[name]
+                if not running:
+                    raise RuntimeError(f"Неизпълними зависимости между етапите: {sorted(pending)}")
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                failure = None
+                for task in done:
+                    name = running.pop(task)
+                    if task.exception() is not None: failure = failure or task.exception()
+                    else: results[name] = task.result()
+                if failure is not None: raise failure
+            return results
+        except BaseException:
+            if running:
+                logger.info(f"Прекратяване на незавършените етапи: {sorted(running.values())}")
+                if self.on_cancel is not None: self.on_cancel()
+                for task in running: task.cancel()
+                await asyncio.gather(*running, return_exceptions=True)
+            for name in pending: self.tracker.skip(name)
+            raise
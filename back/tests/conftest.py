@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модулите в back/ се импортират един друг по име (както при "uvicorn server:app" от back/)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,18 @@
+import os
+import re
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from embedding_cache import EmbeddingCache, content_key
+
+
+def test_disk_tier_uses_filename_safe_names(tmp_path):
+    key = content_key(b"image", "SFace", "yunet>mtcnn")
+    EmbeddingCache(8, 3600, str(tmp_path)).put(key, np.ones((1, 4)), "yunet")
+
+    [name] = os.listdir(tmp_path)
+    assert re.fullmatch(r"[0-9a-f]{64}\.npz", name)
+    embeddings, detector = EmbeddingCache(8, 3600, str(tmp_path)).get(key)
+    assert embeddings.shape == (1, 4) and detector == "yunet"
@@ -0,0 +1,33 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from config import PHOTO_SUBDIR_NAME
+from face_index import write_user_meta, read_user_identifier
+
+
+def make_user(base_dir, folder_name: str, user_identifier: str = None):
+    photo_dir = base_dir / folder_name / PHOTO_SUBDIR_NAME
+    photo_dir.mkdir(parents=True)
+    (photo_dir / "selfie_1700000000.jpg").write_bytes(b"")
+    if user_identifier is not None: write_user_meta(str(base_dir / folder_name), user_identifier)
+
+
+def test_user_identifier_with_underscore_comes_from_the_meta_file(tmp_path):
+    make_user(tmp_path, "Ivan_Petrov_acme_42", "acme_42")
+    assert read_user_identifier(str(tmp_path), "Ivan_Petrov_acme_42") == "acme_42"
+
+
+def test_folders_without_meta_fall_back_to_the_folder_name(tmp_path):
+    make_user(tmp_path, "Ivan_Petrov_42")
+    assert read_user_identifier(str(tmp_path), "Ivan_Petrov_42") == "42"
+
+
+def test_iter_verified_users_reports_the_real_identifier(tmp_path):
+    pytest.importorskip("cv2")
+    from batch_verification import iter_verified_users
+    make_user(tmp_path, "Ivan_Petrov_acme_42", "acme_42")
+
+    [user] = iter_verified_users(str(tmp_path), ["acme_42"])
+    assert user["user_identifier"] == "acme_42"
+    assert user["photos"]["selfie"].endswith("selfie_1700000000.jpg")
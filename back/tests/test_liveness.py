@@ -0,0 +1,82 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+from liveness import BlinkCounter
+
+
+def count_blinks(closed_frames: list, stride: int = 1, n_frames: int = 40) -> int:
+    # EAR по кадри на видеото (0.05 – затворено око), от които се анализира всеки stride-и кадър
+    ears = np.array([0.05 if i in closed_frames else 0.3 for i in range(n_frames)])
+    counter = BlinkCounter(threshold=0.2, min_frames=2, max_frames=5, frame_weight=stride)
+    counter.update(ears[::stride]); counter.finish()
+    return counter.blinks
+
+
+@pytest.mark.parametrize("length,expected", [(1, 0), (2, 1), (5, 1), (6, 0)])
+def test_stride_one_matches_consecutive_frame_rule(length, expected):
+    assert count_blinks(list(range(10, 10 + length))) == expected
+
+
+@pytest.mark.parametrize("start", [10, 11])
+def test_five_frame_blink_is_accepted_with_stride_two(start):
+    assert count_blinks(list(range(start, start + 5)), stride=2) == 1
+
+
+def test_long_closure_is_rejected_with_stride_two():
+    assert count_blinks(list(range(10, 20)), stride=2) == 0
+
+
+def baseline_liveness(face_mesh, frames) -> dict:
+    # Копие на цикъла от server.py преди LivenessAnalyzer: всеки кадър, EAR поотделно, мигане при затваряне на поредицата
+    from config import (LIVENESS_EAR_THRESHOLD, LIVENESS_EAR_CONSEC_FRAMES_MIN, LIVENESS_EAR_CONSEC_FRAMES_MAX,
+                        LIVENESS_MAX_FRAMES_TO_ANALYZE, LIVENESS_MOVEMENT_RANGE_THRESHOLD)
+    from liveness import LEFT_EYE_INDICES_FOR_EAR, RIGHT_EYE_INDICES_FOR_EAR
+
+    def calculate_ear(eye):
+        a = np.linalg.norm(eye[1] - eye[5]); b = np.linalg.norm(eye[2] - eye[4]); c = np.linalg.norm(eye[0] - eye[3])
+        return 0.35 if c < 1e-7 else (a + b) / (2.0 * c)
+
+    blinks = 0; run = 0; nose_positions = []; head_moved = False
+    for frame in frames[:LIVENESS_MAX_FRAMES_TO_ANALYZE]:
+        results = face_mesh.process(frame)
+        if not results.multi_face_landmarks: continue
+        landmark = results.multi_face_landmarks[0].landmark
+        frame_h, frame_w = frame.shape[:2]
+        left = np.array([(landmark[i].x * frame_w, landmark[i].y * frame_h) for i in LEFT_EYE_INDICES_FOR_EAR], dtype=np.float32)
+        right = np.array([(landmark[i].x * frame_w, landmark[i].y * frame_h) for i in RIGHT_EYE_INDICES_FOR_EAR], dtype=np.float32)
+        if (calculate_ear(left) + calculate_ear(right)) / 2.0 < LIVENESS_EAR_THRESHOLD: run += 1
+        else:
+            if LIVENESS_EAR_CONSEC_FRAMES_MIN <= run <= LIVENESS_EAR_CONSEC_FRAMES_MAX: blinks += 1
+            run = 0
+        nose_positions.append((landmark[1].x * frame_w, landmark[1].y * frame_h))
+    if LIVENESS_EAR_CONSEC_FRAMES_MIN <= run <= LIVENESS_EAR_CONSEC_FRAMES_MAX: blinks += 1
+    if len(nose_positions) > 10:
+        nose = np.array(nose_positions)
+        head_moved = bool(np.ptp(nose[:, 0]) > LIVENESS_MOVEMENT_RANGE_THRESHOLD or np.ptp(nose[:, 1]) > LIVENESS_MOVEMENT_RANGE_THRESHOLD)
+    return {"blinks": blinks, "head_moved": head_moved}
+
+
+@pytest.mark.parametrize("blink_script", [((25, 3), (60, 3)), ((10, 1), (30, 6), (50, 2)), ()])
+@pytest.mark.parametrize("early_exit", [False, True])
+@pytest.mark.parametrize("inference_max_dim", [0, 480])
+def test_analyzer_matches_baseline_loop(blink_script, early_exit, inference_max_dim):
+    from bench.micro import ScriptedFaceMesh
+    from config import LIVENESS_MIN_BLINKS_REQUIRED
+    from liveness import LivenessAnalyzer
+    # 640x480 кадри: с inference_max_dim=480 FaceMesh получава умален кадър, а координатите се връщат към оригинала
+    frames = [np.zeros((480, 640, 3), dtype=np.uint8) for _ in range(90)]
+    expected = baseline_liveness(ScriptedFaceMesh(len(frames), blink_script), frames)
+
+    analyzer = LivenessAnalyzer(ScriptedFaceMesh(len(frames), blink_script), stride=1, inference_max_dim=inference_max_dim, early_exit=early_exit)
+    for frame_idx, frame in enumerate(frames[:analyzer.max_frames]):
+        if analyzer.feed(frame_idx, frame): break
+    result = analyzer.result()
+
+    assert result["head_moved"] == expected["head_moved"]
+    if result["stopped_early"]:
+        # Ранното спиране пропуска само мигания след вече изпълнените критерии
+        assert early_exit and LIVENESS_MIN_BLINKS_REQUIRED <= result["blinks"] <= expected["blinks"]
+    else:
+        assert result["blinks"] == expected["blinks"]
@@ -0,0 +1,100 @@
+import struct
+
+import pytest
+
+from media_probe import sniff_image, sniff_video, Mp4DurationProbe, WebmDurationProbe
+
+
+def box(box_type: bytes, payload: bytes = b"", largesize: bool = False) -> bytes:
+    if largesize: return struct.pack(">I4sQ", 1, box_type, 16 + len(payload)) + payload
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def mvhd(timescale: int, duration: int, version: int = 0) -> bytes:
+    # version/flags, creation/modification time, timescale, duration (32 или 64 бита) + остатък на кутията
+    if version == 1: payload = struct.pack(">B3xQQIQ", 1, 0, 0, timescale, duration)
+    else: payload = struct.pack(">B3xIIII", 0, 0, 0, timescale, duration)
+    return box(b"mvhd", payload + bytes(80))
+
+
+def ftyp() -> bytes:
+    return box(b"ftyp", b"isom\x00\x00\x02\x00isomiso2mp41")
+
+
+def probe_mp4(data: bytes, chunk: int = None) -> Mp4DurationProbe:
+    probe = Mp4DurationProbe()
+    for pos in range(0, len(data), chunk or len(data)): probe.feed(data[pos:pos + (chunk or len(data))])
+    return probe
+
+
+@pytest.mark.parametrize("version", [0, 1])
+def test_mp4_mvhd_versions(version):
+    probe = probe_mp4(ftyp() + box(b"moov", mvhd(1000, 12_500, version)))
+    assert probe.done and probe.duration == pytest.approx(12.5)
+
+
+def test_mp4_largesize_box_is_skipped():
+    probe = probe_mp4(ftyp() + box(b"free", bytes(100), largesize=True) + box(b"moov", mvhd(600, 1800)))
+    assert probe.duration == pytest.approx(3.0)
+
+
+@pytest.mark.parametrize("chunk", [1, 7, 4096])
+def test_mp4_moov_after_mdat_in_split_chunks(chunk):
+    probe = probe_mp4(ftyp() + box(b"mdat", bytes(10_000)) + box(b"moov", mvhd(90_000, 90_000 * 45)), chunk)
+    assert probe.done and probe.duration == pytest.approx(45.0)
+
+
+def test_mp4_truncated_before_mvhd():
+    data = ftyp() + box(b"moov", mvhd(1000, 5000))
+    probe = probe_mp4(data[:len(data) - 90])
+    assert not probe.done and probe.duration is None
+
+
+def test_mp4_box_to_end_of_file_gives_up():
+    probe = probe_mp4(ftyp() + struct.pack(">I4s", 0, b"mdat") + bytes(64))
+    assert probe.done and probe.duration is None
+
+
+def ebml(element_id: int, payload: bytes) -> bytes:
+    # ID-то се записва с маркера си; размерът – като 8-байтово EBML число
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + (0x01 << 56 | len(payload)).to_bytes(8, "big") + payload
+
+
+def webm(duration_ms: float = None) -> bytes:
+    info = ebml(WebmDurationProbe.TIMECODE_SCALE, (1_000_000).to_bytes(3, "big"))
+    if duration_ms is not None: info += ebml(WebmDurationProbe.DURATION, struct.pack(">d", duration_ms))
+    header = ebml(0x1A45DFA3, ebml(0x4282, b"webm"))
+    return header + ebml(WebmDurationProbe.SEGMENT, ebml(WebmDurationProbe.INFO, info) + ebml(WebmDurationProbe.CLUSTER, bytes(32)))
+
+
+def probe_webm(data: bytes, chunk: int = None) -> WebmDurationProbe:
+    probe = WebmDurationProbe()
+    for pos in range(0, len(data), chunk or len(data)): probe.feed(data[pos:pos + (chunk or len(data))])
+    return probe
+
+
+@pytest.mark.parametrize("chunk", [None, 1])
+def test_webm_duration(chunk):
+    probe = probe_webm(webm(duration_ms=31_000), chunk)
+    assert probe.done and probe.duration == pytest.approx(31.0)
+
+
+def test_webm_without_duration():
+    # Записите на MediaRecorder нямат Duration – продължителността остава неизвестна
+    probe = probe_webm(webm())
+    assert probe.done and probe.duration is None
+
+
+def test_webm_truncated_inside_info():
+    data = webm(duration_ms=5000)
+    probe = probe_webm(data[:60])
+    assert not probe.done and probe.duration is None
+
+
+def test_sniff_signatures():
+    assert sniff_image(b"\xff\xd8\xff\xe0" + bytes(8)) == "jpeg"
+    assert sniff_image(b"\x89PNG\r\n\x1a\n" + bytes(4)) == "png"
+    assert sniff_image(b"GIF89a" + bytes(6)) is None
+    assert sniff_video(ftyp()[:12]) == "mp4"
+    assert sniff_video(webm()[:12]) == "webm"
+    assert sniff_video(b"RIFF\x00\x00\x00\x00AVI ") is None
@@ -0,0 +1,103 @@
+import asyncio
+from contextlib import contextmanager
+
+import pytest
+
+from stage_graph import StageGraph, StageFailed
+
+
+class FakeTracker:
+    def __init__(self):
+        self.statuses = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        self.statuses[name] = "running"
+        try: yield
+        except asyncio.CancelledError:
+            self.statuses[name] = "cancelled"
+            raise
+        except BaseException:
+            self.statuses[name] = "failed"
+            raise
+        self.statuses[name] = "done"
+
+    def skip(self, name: str):
+        self.statuses[name] = "skipped"
+
+
+def never(results):
+    return asyncio.Event().wait()
+
+
+def test_first_failure_cancels_siblings_and_skips_pending():
+    tracker = FakeTracker()
+    cancelled = []
+
+    async def fail(results):
+        await asyncio.sleep(0)
+        raise StageFailed(400, {"code": "VERIFICATION_FAILED"})
+
+    graph = StageGraph(tracker, on_cancel=lambda: cancelled.append(True))
+    graph.add("fail", fail); graph.add("slow", never); graph.add("after", never, depends_on=("slow",))
+    with pytest.raises(StageFailed) as e_stage: asyncio.run(graph.run())
+
+    assert e_stage.value.content["code"] == "VERIFICATION_FAILED"
+    assert cancelled == [True]
+    assert tracker.statuses == {"fail": "failed", "slow": "cancelled", "after": "skipped"}
+
+
+@pytest.mark.parametrize("depends_on", [("missing",), ("b",)])
+def test_unsatisfiable_dependency_raises(depends_on):
+    # Липсващ етап или цикъл a -> b -> a
+    graph = StageGraph(FakeTracker())
+    graph.add("a", never, depends_on=depends_on); graph.add("b", never, depends_on=("a",))
+    with pytest.raises(RuntimeError): asyncio.run(graph.run())
+
+
+def test_results_flow_in_dependency_order():
+    order = []
+
+    def stage(name, value):
+        async def run(results):
+            order.append(name)
+            return value(results)
+        return run
+
+    graph = StageGraph(FakeTracker())
+    graph.add("sum", stage("sum", lambda r: r["left"] + r["right"]), depends_on=("left", "right"))
+    graph.add("right", stage("right", lambda r: r["left"] * 10), depends_on=("left",))
+    graph.add("left", stage("left", lambda r: 2))
+    results = asyncio.run(graph.run())
+
+    assert order == ["left", "right", "sum"]
+    assert results == {"left": 2, "right": 20, "sum": 22}
+
+
+def test_tracker_reports_every_running_stage():
+    pytest.importorskip("fastapi")
+    pytest.importorskip("numpy")
+    from verification_pipeline import StageTracker
+    tracker = StageTracker(stages=("a", "b", "c"))
+    seen = {}
+
+    async def scenario():
+        a_done = asyncio.Event()
+
+        async def a(results):
+            await asyncio.sleep(0)
+            seen["both"] = tracker.running
+            a_done.set()
+
+        async def b(results):
+            await a_done.wait()
+            seen["after_a"] = tracker.running
+
+        graph = StageGraph(tracker)
+        graph.add("a", a); graph.add("b", b)
+        graph.add("c", lambda results: asyncio.sleep(0), depends_on=("a", "b"))
+        await graph.run()
+
+    asyncio.run(scenario())
+    assert seen == {"both": ["a", "b"], "after_a": ["b"]}
+    assert tracker.running == [] and tracker.current is None
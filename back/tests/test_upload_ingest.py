@@ -0,0 +1,116 @@
+import asyncio
+import struct
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("numpy")
+
+import upload_ingest
+from upload_ingest import VerificationUploadParser, UploadRejected, ingest_upload
+
+BOUNDARY = b"verification-test-boundary"
+JPEG = b"\xff\xd8\xff\xe0" + bytes(200)
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(200)
+MP4 = struct.pack(">I4s", 24, b"ftyp") + b"isom\x00\x00\x02\x00isom" + struct.pack(">I4s", 1008, b"mdat") + bytes(1000)
+
+
+def part(name: str, content: bytes, filename: str = None) -> bytes:
+    disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else "")
+    return b"--" + BOUNDARY + b"\r\nContent-Disposition: " + disposition.encode() + b"\r\n\r\n" + content + b"\r\n"
+
+
+def body(*parts: bytes) -> bytes:
+    return b"".join(parts) + b"--" + BOUNDARY + b"--\r\n"
+
+
+def images() -> tuple:
+    return part("idCardFront", JPEG, "front.jpg"), part("idCardBack", JPEG, "back.jpg"), part("selfie", PNG, "selfie.png")
+
+
+def parser(tmp_path, **kwargs) -> VerificationUploadParser:
+    return VerificationUploadParser(BOUNDARY, str(tmp_path), 1700000000, **kwargs)
+
+
+def rejected(tmp_path, data: bytes, chunk: int = None) -> UploadRejected:
+    upload = parser(tmp_path)
+    with pytest.raises(UploadRejected) as e_upload:
+        for pos in range(0, len(data), chunk or len(data)): upload.feed(data[pos:pos + (chunk or len(data))])
+    upload.close()
+    return e_upload.value
+
+
+def test_complete_body_is_parsed(tmp_path):
+    upload = parser(tmp_path)
+    upload.feed(body(part("user_identifier", b"42"), *images(), part("video_selfie", MP4, "selfie.mp4")))
+    assert not upload.incomplete
+    assert upload.fields == {"user_identifier": "42"}
+    assert upload.images["selfie"] == ("selfie_1700000000.png", PNG)
+    assert open(upload.temp_video_paths["video_selfie"], "rb").read() == MP4
+
+
+def test_field_over_its_limit_is_rejected_with_413(tmp_path, monkeypatch):
+    monkeypatch.setattr(upload_ingest, "UPLOAD_MAX_IMAGE_BYTES", 100)
+    e_upload = rejected(tmp_path, body(part("selfie", JPEG, "selfie.jpg")), chunk=64)
+    assert (e_upload.status_code, e_upload.content["code"], e_upload.content["field"]) == (413, "FILE_TOO_LARGE", "selfie")
+
+
+def test_text_field_over_its_limit_is_rejected_with_413(tmp_path):
+    e_upload = rejected(tmp_path, body(part("user_identifier", b"x" * (upload_ingest.UPLOAD_MAX_FIELD_BYTES + 1))))
+    assert (e_upload.status_code, e_upload.content["code"]) == (413, "FIELD_TOO_LARGE")
+
+
+def test_body_over_the_limit_is_rejected_with_413(tmp_path, monkeypatch):
+    monkeypatch.setattr(upload_ingest, "UPLOAD_MAX_BODY_BYTES", 300)
+    e_upload = rejected(tmp_path, body(*images()), chunk=128)
+    assert (e_upload.status_code, e_upload.content["code"]) == (413, "REQUEST_TOO_LARGE")
+
+
+def test_invalid_content_is_rejected_on_the_first_chunk(tmp_path):
+    upload = parser(tmp_path)
+    first_chunk = part("selfie", b"GIF89a" + bytes(200), "selfie.jpg")[:-50]
+    with pytest.raises(UploadRejected) as e_upload: upload.feed(first_chunk)
+    assert (e_upload.value.status_code, e_upload.value.content["code"]) == (400, "INVALID_FILE_CONTENT")
+
+
+@pytest.mark.parametrize("filename,code", [("selfie.gif", "INVALID_IMAGE_FILE_TYPE"), ("selfie.jpg", "INVALID_FILE_CONTENT")])
+def test_extension_must_match_the_image(tmp_path, filename, code):
+    # .gif не е допустимо разширение; .jpg с PNG съдържание не съответства
+    e_upload = rejected(tmp_path, body(part("selfie", PNG, filename)))
+    assert (e_upload.status_code, e_upload.content["code"]) == (400, code)
+
+
+def test_duplicate_field_keeps_the_first_value(tmp_path):
+    upload = parser(tmp_path)
+    upload.feed(body(part("user_identifier", b"first"), part("user_identifier", b"second"),
+                     part("selfie", JPEG, "selfie.jpg"), part("selfie", PNG, "other.png")))
+    assert upload.fields["user_identifier"] == "first"
+    assert upload.images["selfie"] == ("selfie_1700000000.jpg", JPEG)
+
+
+class FakeRequest:
+    def __init__(self, data: bytes, chunk: int = 256):
+        self.headers = {"content-type": f"multipart/form-data; boundary={BOUNDARY.decode()}"}
+        self._chunks = [data[pos:pos + chunk] for pos in range(0, len(data), chunk)]
+
+    async def stream(self):
+        for chunk in self._chunks: yield chunk
+
+
+def test_truncated_body_is_rejected_as_incomplete(tmp_path):
+    data = body(part("user_identifier", b"42"), *images())
+    with pytest.raises(UploadRejected) as e_upload:
+        asyncio.run(ingest_upload(FakeRequest(data[:len(data) - 120]), str(tmp_path), 1700000000))
+    assert (e_upload.value.status_code, e_upload.value.content["code"]) == (400, "UPLOAD_INCOMPLETE")
+
+
+def test_on_video_received_fires_only_for_a_completed_video(tmp_path):
+    received = []
+    upload = parser(tmp_path, on_video_received=lambda name, path: received.append((name, open(path, "rb").read())))
+    data = body(part("video_selfie", MP4, "selfie.mp4"), part("video_front_id", MP4, "front.mp4"))
+    video_end = data.index(b"--" + BOUNDARY, len(BOUNDARY) + 2)
+    upload.feed(data[:video_end - 10])
+    assert received == []
+    upload.feed(data[video_end - 10:len(data) - 200])
+    assert received == [("video_selfie", MP4)]
+    upload.close()
@@ -0,0 +1,112 @@
+import sys
+import types
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+STUB_THRESHOLD = 0.593
+
+
+@pytest.fixture
+def stub_deepface(monkeypatch):
+    # DeepFace без TensorFlow: всяко извикване на represent връща едно уверено лице
+    calls = []
+
+    class DeepFace:
+        verification = types.SimpleNamespace(find_threshold=lambda model_name, distance_metric: STUB_THRESHOLD)
+
+        @staticmethod
+        def represent(img_path, model_name, detector_backend, enforce_detection, align):
+            calls.append(detector_backend)
+            return [{"embedding": [0.1] * 128, "face_confidence": 0.99}]
+
+        @staticmethod
+        def build_model(model_name):
+            return None
+
+    monkeypatch.setitem(sys.modules, "deepface", types.SimpleNamespace(DeepFace=DeepFace))
+    return calls
+
+
+def test_embed_image_task_smoke(stub_deepface, monkeypatch):
+    import image_pipeline
+    import verification_tasks
+    from face_detection import detector_tiers
+    monkeypatch.setattr(verification_tasks, "embedding_cache", None)
+    data = image_pipeline.encode_jpeg(image_pipeline.synthetic_face_image())
+
+    embedded = verification_tasks.embed_image_task(data, "selfie")
+
+    assert embedded["image_error"] is False
+    assert embedded["face_not_found"] is False
+    assert embedded["threshold"] == STUB_THRESHOLD
+    assert embedded["embeddings"].shape == (1, 128)
+    assert embedded["detector"] == detector_tiers("selfie")[0] == stub_deepface[0]
+    assert "image_decode" in embedded["timings"]
+
+
+def test_embed_image_task_invalid_image(stub_deepface, monkeypatch):
+    import verification_tasks
+    monkeypatch.setattr(verification_tasks, "embedding_cache", None)
+    assert verification_tasks.embed_image_task(b"not an image", "selfie")["image_error"] is True
+    assert stub_deepface == []
+
+
+def test_reverify_batch_task_uses_model_threshold(stub_deepface, monkeypatch, tmp_path):
+    import image_pipeline
+    import verification_tasks
+    monkeypatch.setattr(verification_tasks, "embedding_cache", None)
+    photo = tmp_path / "selfie.jpg"
+    photo.write_bytes(image_pipeline.encode_jpeg(image_pipeline.synthetic_face_image()))
+    user = {"user_folder": "A_1", "user_identifier": "1", "photos": {"idCardFront": str(photo), "selfie": str(photo)}}
+
+    [result] = verification_tasks.reverify_batch_task([user])
+
+    assert result["status"] == "verified"
+    assert result["threshold"] == round(STUB_THRESHOLD, 4)
+
+
+def test_embed_image_task_cache_hit_keeps_detector(stub_deepface, monkeypatch, tmp_path):
+    import image_pipeline
+    import verification_tasks
+    from embedding_cache import EmbeddingCache
+    monkeypatch.setattr(verification_tasks, "embedding_cache", EmbeddingCache(8, 3600, str(tmp_path)))
+    data = image_pipeline.encode_jpeg(image_pipeline.synthetic_face_image())
+    first = verification_tasks.embed_image_task(data, "selfie")
+
+    # Нов кеш със същата директория: попадението идва от диска
+    monkeypatch.setattr(verification_tasks, "embedding_cache", EmbeddingCache(8, 3600, str(tmp_path)))
+    second = verification_tasks.embed_image_task(data, "selfie")
+
+    assert second["cache_hit"] is True
+    assert second["detector"] == first["detector"] is not None
+    assert len(stub_deepface) == 1
+
+
+def test_cached_embed_result_matches_task_shape(stub_deepface, monkeypatch):
+    import image_pipeline
+    import verification_tasks
+    monkeypatch.setattr(verification_tasks, "embedding_cache", None)
+    embedded = verification_tasks.embed_image_task(image_pipeline.encode_jpeg(image_pipeline.synthetic_face_image()), "selfie")
+
+    cached = verification_tasks.cached_embed_result((embedded["embeddings"], embedded["detector"]), embedded["threshold"])
+
+    assert cached.keys() == embedded.keys()
+    assert cached["cache_hit"] is True and cached["detector"] == embedded["detector"]
+    assert verification_tasks.cached_embed_result((np.empty((0, 128), np.float32), None), STUB_THRESHOLD)["face_not_found"] is True
+
+
+def test_embed_image_task_keeps_the_persist_jpeg(stub_deepface, monkeypatch):
+    import cv2
+    import image_pipeline
+    import verification_tasks
+    monkeypatch.setattr(verification_tasks, "embedding_cache", None)
+    data = image_pipeline.encode_jpeg(image_pipeline.synthetic_face_image(size=900))
+
+    assert verification_tasks.embed_image_task(data, "selfie")["jpeg"] is None
+    embedded = verification_tasks.embed_image_task(data, "selfie", True)
+
+    assert embedded["jpeg"] == verification_tasks.encode_for_persist_task(data)
+    assert max(cv2.imdecode(np.frombuffer(embedded["jpeg"], np.uint8), cv2.IMREAD_COLOR).shape[:2]) <= image_pipeline.IMAGE_MAX_DIM
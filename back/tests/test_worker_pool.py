@@ -0,0 +1,45 @@
+import os
+import signal
+import asyncio
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from worker_pool import VerificationPool, PoolSaturatedError
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGKILL"), reason="SIGKILL не е наличен")
+def test_pool_recovers_after_idle_worker_is_killed():
+    async def scenario():
+        pool = VerificationPool(size=1, queue_size=0, job_timeout=30, retry_after=1)
+        pool.start()
+        try:
+            async with pool.admit() as job: pid = await job.run(os.getpid)
+            broken = pool.executor
+            os.kill(pid, signal.SIGKILL)
+            # Executor-ът се маркира като повреден без чакаща задача – следващият submit() вдига веднага
+            deadline = time.monotonic() + 10
+            while not broken._broken and time.monotonic() < deadline: await asyncio.sleep(0.05)
+            assert broken._broken
+
+            async with pool.admit() as job:
+                with pytest.raises(BrokenProcessPool): await job.run(os.getpid)
+            assert pool.executor is not broken
+            async with pool.admit() as job: new_pid = await job.run(os.getpid)
+            assert new_pid != pid
+        finally:
+            pool.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_acquire_counts_against_capacity_until_release():
+    pool = VerificationPool(size=1, queue_size=1, job_timeout=30, retry_after=7)
+    jobs = [pool.acquire(), pool.acquire()]
+    with pytest.raises(PoolSaturatedError) as e_busy: pool.acquire()
+    assert e_busy.value.retry_after == 7
+    jobs[0].release()
+    assert pool.in_flight == 1
+    pool.acquire().release(); jobs[1].release()
+    assert pool.in_flight == 0
@@ -0,0 +1,282 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Optional, Callable
+from contextlib import contextmanager
+
+from fastapi import HTTPException, Request, status
+from starlette.requests import ClientDisconnect
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+
+from config import (
+    UPLOAD_MAX_IMAGE_BYTES, UPLOAD_MAX_VIDEO_BYTES, UPLOAD_MAX_VIDEO_DURATION_SEC,
+    UPLOAD_MAX_FIELD_BYTES, UPLOAD_MAX_BODY_BYTES, UPLOAD_TIMEOUT_SEC,
+)
+from verification_pipeline import error_content, ALLOWED_IMAGE_EXTENSIONS
+from worker_pool import PoolSaturatedError
+from media_probe import SNIFF_BYTES, sniff_image, sniff_video, Mp4DurationProbe, WebmDurationProbe
+
+# Поточно четене на multipart тялото на /verify и /verify/jobs (вместо Form/File на FastAPI, които първо
+# записват цялото тяло във временни файлове). Всяко парче се проверява при пристигането си:
+#  - лимит в байтове по поле и за цялото тяло (413), продължителност на видеата по заглавната им част (413);
+#  - съдържанието се разпознава по първите байтове (JPEG/PNG за снимките, MP4/MOV/WebM за видеата) – иначе 400;
+#    разпознаването и продължителността са в media_probe.py;
+#  - видеата се пишат направо във временната директория, а снимките остават в паметта, както преди;
+#  - цялото тяло трябва да пристигне за UPLOAD_TIMEOUT_SEC (иначе 408).
+# Щом видео бъде прочетено докрай, се извиква on_video_received(поле, път): /verify изпраща liveness анализа
+# на селфи видеото към пула, докато останалите полета още се качват. Worker-ът не чака качването, а
+# timeout-ът на задачата тече едва от изпращането ѝ.
+# Отклонение от първоначалната идея: селфи видеото НЕ се декодира, докато пристига. PyAV чете синхронно, така
+# че декодиране на непълен файл означава worker, блокиран в чакане на мрежата (и timeout, който включва
+# качването). Затова анализът започва след последния байт на полето video_selfie, а не след цялото тяло –
+# печалбата остава за клиентите, които изпращат видеото преди снимките.
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FIELDS = ("idCardFront", "idCardBack", "selfie")
+VIDEO_FIELDS = ("video_front_id", "video_back_id", "video_selfie")
+TEXT_FIELDS = ("user_identifier", "firstName", "lastName")
+# Разширенията, допустими за всеки разпознат вид снимка (разширението се пази и при записа на файла)
+IMAGE_KIND_EXTENSIONS = {"jpeg": (".jpg", ".jpeg"), "png": (".png",)}
+
+
+class UploadRejected(Exception):
+    def __init__(self, status_code: int, content: dict):
+        super().__init__(content["message"])
+        self.status_code = status_code
+        self.content = content
+
+
+class UploadSlots:
+    """Брояч на едновременните качвания; при пълен брояч – PoolSaturatedError (429 + Retry-After)."""
+
+    def __init__(self, limit: int, retry_after: int):
+        self.limit = max(1, limit)
+        self.retry_after = retry_after
+        self.in_flight = 0
+
+    @contextmanager
+    def admit(self):
+        if self.in_flight >= self.limit:
+            raise PoolSaturatedError(self.retry_after)
+        self.in_flight += 1
+        try: yield
+        finally: self.in_flight -= 1
+
+
+class _Part:
+    def __init__(self, name: str, filename: Optional[str], kind: str, max_bytes: int):
+        self.name = name
+        self.filename = filename
+        self.kind = kind  # "image", "video", "text" или "ignored"
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.head = b""
+        self.sniffed = None
+        self.chunks = []
+        self.file = None
+        self.path = None
+        self.probe = None
+
+
+class VerificationUploadParser:
+    """Разбира multipart тялото парче по парче и проверява лимитите и съдържанието на всяко поле."""
+
+    def __init__(self, boundary: bytes, tmp_dir: str, timestamp: int, on_video_received: Optional[Callable] = None, spill_images: bool = False):
+        self.tmp_dir = tmp_dir
+        self.timestamp = timestamp
+        self.on_video_received = on_video_received
+        self.spill_images = spill_images
+        self.fields = {}
+        self.images = {}
+        self.temp_video_paths = {}
+        self.received = 0
+        self._part = None
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition = None
+        self._events = []
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin, "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value, "on_header_end": self._on_header_end,
+            "on_headers_finished": lambda: self._events.append(("headers", self._disposition)),
+            "on_part_data": lambda data, start, end: self._events.append(("data", data[start:end])),
+            "on_part_end": lambda: self._events.append(("end", None)),
+        })
+
+    def _on_part_begin(self):
+        self._disposition = None
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_field.lower() == b"content-disposition": self._disposition = self._header_value
+        self._header_field = b""; self._header_value = b""
+
+    def feed(self, chunk: bytes):
+        self.received += len(chunk)
+        if self.received > UPLOAD_MAX_BODY_BYTES:
+            raise UploadRejected(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, error_content("REQUEST_TOO_LARGE", "Заявката надвишава максимално допустимия размер."))
+        self._parser.write(chunk)
+        events, self._events = self._events, []
+        for event, payload in events:
+            if event == "headers": self._begin(payload)
+            elif event == "data": self._data(self._part, payload)
+            else: self._end(self._part)
+
+    @property
+    def incomplete(self) -> bool:
+        # Тялото е свършило по средата на поле (липсва крайната граница)
+        return self._part is not None
+
+    def close(self):
+        part = self._part
+        if part is not None and part.file is not None: part.file.close()
+
+    def _begin(self, disposition: Optional[bytes]):
+        _, options = parse_options_header(disposition or b"")
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        filename = options.get(b"filename")
+        filename = filename.decode("utf-8", "replace") if filename is not None else None
+        seen = name in self.fields or name in self.images or name in self.temp_video_paths
+        if name in TEXT_FIELDS and not seen:
+            self._part = _Part(name, None, "text", UPLOAD_MAX_FIELD_BYTES)
+        elif name in IMAGE_FIELDS + VIDEO_FIELDS and filename and not seen:
+            is_image = name in IMAGE_FIELDS
+            file_ext = os.path.splitext(filename)[1].lower()
+            if is_image and file_ext not in ALLOWED_IMAGE_EXTENSIONS:
+                raise UploadRejected(status.HTTP_400_BAD_REQUEST, error_content("INVALID_IMAGE_FILE_TYPE", f"Невалиден тип файл за снимка {name}.", field=name))
+            self._part = _Part(name, filename, "image" if is_image else "video", UPLOAD_MAX_IMAGE_BYTES if is_image else UPLOAD_MAX_VIDEO_BYTES)
+        else:
+            if name in IMAGE_FIELDS + VIDEO_FIELDS and not filename: logger.warning(f"Файлът за '{name}' няма име и ще бъде пропуснат.")
+            elif seen: logger.warning(f"Полето '{name}' е изпратено повече от веднъж; повторението се пропуска.")
+            self._part = _Part(name, None, "ignored", UPLOAD_MAX_BODY_BYTES)
+
+    def _data(self, part: _Part, data: bytes):
+        part.size += len(data)
+        if part.size > part.max_bytes:
+            code = "FILE_TOO_LARGE" if part.kind in ("image", "video") else "FIELD_TOO_LARGE"
+            raise UploadRejected(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, error_content(code, f"Полето {part.name} надвишава максималния размер от {part.max_bytes} байта.", field=part.name))
+        if part.kind == "ignored": return
+        if part.kind == "text": part.chunks.append(data); return
+        if part.sniffed is None:
+            # Съдържанието се проверява, щом пристигнат първите SNIFF_BYTES байта (дотогава се буферират)
+            part.head += data
+            if len(part.head) < SNIFF_BYTES: return
+            self._sniff(part)
+            data, part.head = part.head, b""
+        self._write(part, data)
+
+    def _sniff(self, part: _Part):
+        part.sniffed = sniff_image(part.head) if part.kind == "image" else sniff_video(part.head)
+        if part.sniffed is None:
+            kind = "снимка" if part.kind == "image" else "видео"
+            raise UploadRejected(status.HTTP_400_BAD_REQUEST, error_content("INVALID_FILE_CONTENT", f"Съдържанието на {part.name} не е валидно {kind}.", field=part.name))
+        if part.kind == "image" and os.path.splitext(part.filename)[1].lower() not in IMAGE_KIND_EXTENSIONS[part.sniffed]:
+            raise UploadRejected(status.HTTP_400_BAD_REQUEST, error_content("INVALID_FILE_CONTENT", f"Съдържанието на {part.name} не съответства на разширението на файла.", field=part.name))
+        if part.kind == "image" and not self.spill_images: return
+        file_ext = os.path.splitext(part.filename)[1].lower() or f".{part.sniffed}"
+        part.path = os.path.join(self.tmp_dir, f"{part.name}_{self.timestamp}{file_ext}")
+        part.file = open(part.path, "wb")
+        if part.kind == "image": return
+        part.probe = Mp4DurationProbe() if part.sniffed == "mp4" else WebmDurationProbe()
+        self.temp_video_paths[part.name] = part.path
+
+    def _write(self, part: _Part, data: bytes):
+        if part.kind == "image":
+            if part.file is not None: part.file.write(data)
+            else: part.chunks.append(data)
+            return
+        part.file.write(data)
+        part.probe.feed(data)
+        duration = part.probe.duration
+        if duration is not None and duration > UPLOAD_MAX_VIDEO_DURATION_SEC:
+            raise UploadRejected(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, error_content("VIDEO_TOO_LONG", f"Видеото {part.name} е по-дълго от {UPLOAD_MAX_VIDEO_DURATION_SEC:g} секунди.", field=part.name))
+
+    def _end(self, part: _Part):
+        if part.kind in ("image", "video") and part.sniffed is None:
+            # Файл, по-къс от SNIFF_BYTES (празният файл не минава проверката)
+            self._sniff(part)
+            data, part.head = part.head, b""
+            self._write(part, data)
+        if part.kind == "text":
+            self.fields[part.name] = b"".join(part.chunks).decode("utf-8", "replace")
+        elif part.kind == "image" and part.file is not None:
+            part.file.close()
+            self.images[part.name] = (os.path.basename(part.path), part.path)
+            logger.info(f"Снимка '{part.name}' запазена временно в: {part.path} ({part.size} байта).")
+        elif part.kind == "image":
+            file_ext = os.path.splitext(part.filename)[1].lower()
+            self.images[part.name] = (f"{part.name}_{self.timestamp}{file_ext}", b"".join(part.chunks))
+            logger.info(f"Снимка '{part.name}' прочетена в паметта ({part.size} байта).")
+        elif part.kind == "video":
+            part.file.close()
+            logger.info(f"Файл '{part.name}' запазен временно в: {part.path} ({part.size} байта).")
+            if self.on_video_received is not None: self.on_video_received(part.name, part.path)
+        self._part = None
+
+
+async def _read_chunks(request: Request, timeout: float):
+    # request.stream() с общ срок за цялото тяло, а не за всяко парче поотделно
+    deadline = time.monotonic() + timeout
+    chunks = request.stream().__aiter__()
+    while True:
+        try:
+            yield await asyncio.wait_for(chunks.__anext__(), max(0.0, deadline - time.monotonic()))
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            raise UploadRejected(status.HTTP_408_REQUEST_TIMEOUT, error_content("UPLOAD_TIMEOUT", f"Качването не завърши за {timeout:g} секунди."))
+
+
+async def ingest_upload(request: Request, tmp_dir: str, timestamp: int, on_video_received: Optional[Callable] = None,
+                        spill_images: bool = False, timeout: float = UPLOAD_TIMEOUT_SEC) -> dict:
+    """Чете тялото на верификационната заявка поточно. Връща речник с user_identifier, firstName, lastName,
+    images ({поле: (име_на_файл, байтове)}) и temp_video_paths; при нарушение вдига UploadRejected веднага.
+    spill_images=True записва и снимките в tmp_dir – тогава images е {поле: (име_на_файл, път)}.
+    Тяло, което не пристигне цялото за timeout секунди, се отхвърля с 408.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise UploadRejected(status.HTTP_400_BAD_REQUEST, error_content("INVALID_CONTENT_TYPE", "Очаква се multipart/form-data заявка."))
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > UPLOAD_MAX_BODY_BYTES:
+        raise UploadRejected(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, error_content("REQUEST_TOO_LARGE", "Заявката надвишава максимално допустимия размер."))
+
+    parser = VerificationUploadParser(boundary, tmp_dir, timestamp, on_video_received, spill_images)
+    try:
+        async for chunk in _read_chunks(request, timeout):
+            if chunk: parser.feed(chunk)
+    except ClientDisconnect:
+        raise UploadRejected(status.HTTP_400_BAD_REQUEST, error_content("UPLOAD_INCOMPLETE", "Връзката прекъсна преди файловете да бъдат качени."))
+    except UploadRejected:
+        raise
+    except ValueError as e_parse:
+        # Грешките на python-multipart (MultipartParseError) наследяват ValueError
+        raise UploadRejected(status.HTTP_400_BAD_REQUEST, error_content("INVALID_MULTIPART", f"Невалидно multipart тяло: {e_parse}"))
+    except OSError as e_save:
+        logger.error(f"Грешка при запис на качен файл: {e_save}", exc_info=True)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail={"status": "error", "code": "FILE_SAVE_ERROR", "message": "Грешка при запис на файл."})
+    finally:
+        parser.close()
+
+    if parser.incomplete:
+        raise UploadRejected(status.HTTP_400_BAD_REQUEST, error_content("UPLOAD_INCOMPLETE", "Тялото на заявката свършва преди края на файловете."))
+    fields = parser.fields
+    logger.info(f"Получена заявка за верификация. user_identifier: '{fields.get('user_identifier')}', firstName: '{fields.get('firstName')}', lastName: '{fields.get('lastName')}'")
+    if not fields.get("user_identifier"):
+        raise UploadRejected(status.HTTP_422_UNPROCESSABLE_ENTITY, error_content("MISSING_FORM_FIELDS", "Липсва user_identifier.", field="user_identifier"))
+    if not all(field in parser.images for field in IMAGE_FIELDS):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={"status": "error", "code": "MISSING_IMAGE_FILES", "message": "Липсват една или повече от необходимите СНИМКИ или имената на файловете им."})
+    return {"user_identifier": fields["user_identifier"], "firstName": fields.get("firstName"), "lastName": fields.get("lastName"),
+            "images": parser.images, "temp_video_paths": parser.temp_video_paths}
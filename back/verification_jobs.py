@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import shutil
+import time
+import uuid
+from typing import Optional
+
+from fastapi import HTTPException, status
+from starlette.concurrency import run_in_threadpool
+
+from verification_pipeline import StageTracker, run_verification, error_content
+from worker_pool import VerificationPool, PoolSaturatedError, JobTimeoutError
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Verification job queue is full")
+        self.retry_after = retry_after
+
+
+def read_images(image_paths: dict) -> dict:
+    """{поле: (име_на_файл, път)} -> {поле: (име_на_файл, байтове)}."""
+    images = {}
+    for field, (filename, path) in image_paths.items():
+        with open(path, "rb") as f: images[field] = (filename, f.read())
+    return images
+
+
+class VerificationJob:
+    def __init__(self, tmp_dir: str, tracker: StageTracker, image_paths: dict, temp_video_paths: dict,
+                 user_identifier: str, firstName: Optional[str], lastName: Optional[str]):
+        self.id = uuid.uuid4().hex
+        self.tmp_dir = tmp_dir
+        self.tracker = tracker
+        # Снимките на чакащите задачи са в tmp_dir, а не в паметта; четат се едва когато задачата започне
+        self.image_paths = image_paths
+        self.temp_video_paths = temp_video_paths
+        self.user_identifier = user_identifier
+        self.firstName = firstName
+        self.lastName = lastName
+        self.state = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.status_code = None
+        self.result = None
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "current_stage": self.tracker.current,
+            "running_stages": self.tracker.running,
+            "stages": self.tracker.snapshot(),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": None if self.result is None else {"status_code": self.status_code, "body": self.result},
+        }
+
+
+class VerificationJobQueue:
+    """Локална опашка за асинхронни верификации (POST /verify/jobs) с ограничен брой едновременни задачи.
+
+    Задачите се изпълняват от concurrency на брой asyncio runner-а, които използват същия VerificationPool
+    като /verify. Приключилите задачи се пазят result_ttl секунди, за да могат клиентите да вземат резултата.
+    """
+
+    def __init__(self, pool: VerificationPool, concurrency: int, queue_size: int, result_ttl: float, retry_after: int):
+        self.pool = pool
+        self.concurrency = max(1, concurrency)
+        self.result_ttl = result_ttl
+        self.retry_after = retry_after
+        self._queue_size = max(1, queue_size)
+        self._queue = None
+        self._reserved = 0
+        self._jobs = {}
+        self._runners = []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        self._runners = [asyncio.create_task(self._runner()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for runner in self._runners: runner.cancel()
+        await asyncio.gather(*self._runners, return_exceptions=True)
+        self._runners = []
+        for job in self._jobs.values():
+            if job.state != "completed": shutil.rmtree(job.tmp_dir, ignore_errors=True)
+
+    def reserve(self):
+        """Запазва място в опашката преди качването на файловете, за да не се приема цялото тяло при пълна опашка.
+
+        Мястото се използва от submit(job, reserved=True) или се освобождава с release().
+        """
+        if self._queue.qsize() + self._reserved >= self._queue_size:
+            raise JobQueueFullError(self.retry_after)
+        self._reserved += 1
+
+    def release(self):
+        self._reserved -= 1
+
+    def submit(self, job: VerificationJob, reserved: bool = False) -> VerificationJob:
+        self._purge_expired()
+        if reserved: self.release()
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFullError(self.retry_after)
+        self._jobs[job.id] = job
+        logger.info(f"Верификационна задача {job.id} е добавена в опашката ({self._queue.qsize()}/{self._queue_size}).")
+        return job
+
+    def get(self, job_id: str) -> Optional[VerificationJob]:
+        self._purge_expired()
+        return self._jobs.get(job_id)
+
+    def _purge_expired(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished_at and now - job.finished_at > self.result_ttl]
+        for job_id in expired: del self._jobs[job_id]
+
+    async def _runner(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._execute(job)
+            except Exception as e_job:
+                logger.error(f"Неочаквана грешка във верификационна задача {job.id}: {e_job}", exc_info=True)
+                job.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+                job.result = error_content("VERIFICATION_ERROR", "Сървърна грешка при верификация.")
+            finally:
+                job.state = "completed"; job.finished_at = time.time()
+                metrics.record_verification(job.tracker, metrics.outcome_of(job.status_code, job.result))
+                shutil.rmtree(job.tmp_dir, ignore_errors=True)
+                self._queue.task_done()
+
+    async def _execute(self, job: VerificationJob):
+        while True:
+            try:
+                async with self.pool.admit() as pool_job:
+                    job.state = "running"; job.started_at = job.started_at or time.time()
+                    try:
+                        images = await run_in_threadpool(read_images, job.image_paths)
+                        job.status_code, job.result = await run_verification(
+                            pool_job, job.tracker, images, job.temp_video_paths,
+                            job.user_identifier, job.firstName, job.lastName)
+                    except HTTPException as e_http:
+                        job.status_code, job.result = e_http.status_code, {"detail": e_http.detail}
+                    except JobTimeoutError as e_timeout:
+                        logger.error(f"Времето за обработка на задача {job.id} изтече: {e_timeout}")
+                        job.status_code = status.HTTP_504_GATEWAY_TIMEOUT
+                        job.result = error_content("VERIFICATION_TIMEOUT", "Времето за обработка на верификацията изтече.")
+                    return
+            except PoolSaturatedError as e_busy:
+                # Пулът е зает със синхронни /verify заявки – задачата остава в опашката и опитва отново.
+                await asyncio.sleep(e_busy.retry_after)
@@ -0,0 +1,293 @@
+import os
+import shutil
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from fastapi import HTTPException, status
+from starlette.concurrency import run_in_threadpool
+
+from config import (
+    MODEL_NAME, DETECTOR_BACKEND, PERMANENT_BASE_USER_FILES_DIR, PHOTO_SUBDIR_NAME, VIDEO_SUBDIR_NAME,
+    EMBEDDING_CACHE_MAX_ENTRIES, EMBEDDING_CACHE_TTL_SEC, EMBEDDING_CACHE_DIR,
+)
+from worker_pool import PoolJob, JobTimeoutError
+from stage_graph import StageGraph, StageFailed
+from face_index import FaceIndexWriter, write_user_meta
+from embedding_cache import EmbeddingCache, content_key
+from face_detection import detector_cascade_name
+import verification_tasks
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_STAGES = ("upload_save", "embed_idCardFront", "embed_selfie", "liveness", "match", "duplicate_search", "persist")
+ALLOWED_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+# Сумарни попадения/пропуски в кешовете за embeddings – на сървъра и на worker-ите (вж. GET /embedding-cache/stats)
+embedding_cache_counters = {"hits": 0, "misses": 0}
+# Кеш и в сървърния процес: повторен опит със същата снимка (напр. след 429/504) не стига до пула, дори
+# следващата задача да попадне на друг worker. При EMBEDDING_CACHE_DIR чете същото ниво на диска като тях.
+server_embedding_cache = EmbeddingCache(EMBEDDING_CACHE_MAX_ENTRIES, EMBEDDING_CACHE_TTL_SEC, EMBEDDING_CACHE_DIR)
+# Прагът на модела от последния отговор на worker – нужен и за отговорите от кеша
+model_thresholds = {}
+
+# Селфитата на успешно верифицираните потребители се добавят в 1:N индекса (вж. face_index.py)
+face_index_writer = FaceIndexWriter()
+
+
+class StageTracker:
+    """Прогрес по етапи на една верификация (за GET /verify/jobs/{id} и за логовете)."""
+
+    def __init__(self, stages=PIPELINE_STAGES):
+        self.stages = {name: {"name": name, "status": "pending", "duration_sec": None} for name in stages}
+        # Стъпки вътре в етапите (декодиране, FaceMesh, детекция...) като (име, секунди) – за /metrics
+        self.step_timings = []
+        self.started_at = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        entry = self.stages[name]
+        entry["status"] = "running"
+        start = time.perf_counter()
+        try:
+            yield entry
+        except asyncio.CancelledError:
+            entry["status"] = "cancelled"
+            raise
+        except BaseException:
+            entry["status"] = "failed"
+            raise
+        finally:
+            entry["duration_sec"] = round(time.perf_counter() - start, 4)
+            if entry["status"] == "running": entry["status"] = "done"
+
+    @property
+    def running(self) -> list:
+        # Етапите вървят паралелно (вж. StageGraph) – текущите са всички със статус "running", по реда на PIPELINE_STAGES
+        return [name for name, entry in self.stages.items() if entry["status"] == "running"]
+
+    @property
+    def current(self) -> Optional[str]:
+        running = self.running
+        return running[0] if running else None
+
+    def fail(self, name: str):
+        self.stages[name]["status"] = "failed"
+
+    def skip(self, name: str):
+        self.stages[name]["status"] = "skipped"
+
+    def snapshot(self) -> list:
+        return [dict(entry) for entry in self.stages.values()]
+
+    def add_steps(self, timings: Optional[dict]):
+        if timings: self.step_timings.extend(timings.items())
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try: yield
+        finally: self.step_timings.append((name, round(time.perf_counter() - start, 4)))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+
+def error_content(code: str, message: str, field: Optional[str] = None) -> dict:
+    content = {"status": "error", "code": code}
+    if field: content["field"] = field
+    content["message"] = message
+    return content
+
+
+def sanitize_foldername(name_part: Optional[str]) -> str:
+    if name_part is None: return ""
+    processed_name = str(name_part).replace(" ", "_").strip()
+    return "".join(c for c in processed_name if c.isalnum() or c in ['_', '-'])
+
+
+def persist_verified_files(user_identifier: str, firstName: Optional[str], lastName: Optional[str], images: dict, temp_video_paths: dict) -> dict:
+    # Генериране на име на папка, базирано на имената и ID-то
+    folder_name_parts = []
+    if firstName: folder_name_parts.append(sanitize_foldername(firstName))
+    if lastName: folder_name_parts.append(sanitize_foldername(lastName))
+    folder_name_parts.append(str(user_identifier))
+
+    user_specific_folder_name = "_".join(filter(None, folder_name_parts))
+    if not user_specific_folder_name:
+        user_specific_folder_name = f"user_{user_identifier}" # Fallback
+
+    permanent_user_photo_dir = os.path.join(PERMANENT_BASE_USER_FILES_DIR, user_specific_folder_name, PHOTO_SUBDIR_NAME)
+    permanent_user_video_dir = os.path.join(PERMANENT_BASE_USER_FILES_DIR, user_specific_folder_name, VIDEO_SUBDIR_NAME)
+    os.makedirs(permanent_user_photo_dir, exist_ok=True)
+    os.makedirs(permanent_user_video_dir, exist_ok=True)
+    # Името на папката не може да се разбере еднозначно обратно (user_identifier може да съдържа "_")
+    write_user_meta(os.path.join(PERMANENT_BASE_USER_FILES_DIR, user_specific_folder_name), user_identifier)
+
+    final_saved_paths_for_db = {"photos": {}, "videos": {}}
+
+    # Снимките се записват на диска само тук – умалените ЛК (предна)/селфи и оригиналната ЛК (задна).
+    for key, (permanent_filename, data) in images.items():
+        if data:
+            permanent_path = os.path.join(permanent_user_photo_dir, permanent_filename)
+            with open(permanent_path, "wb") as f_out: f_out.write(data)
+            # Запазваме ОТНОСИТЕЛНИЯ път за базата данни, спрямо PERMANENT_BASE_USER_FILES_DIR
+            final_saved_paths_for_db["photos"][key] = os.path.join(user_specific_folder_name, PHOTO_SUBDIR_NAME, permanent_filename).replace("\\", "/")
+            logger.info(f"Снимка '{key}' копирана в: {permanent_path}")
+
+    for key, temp_path in temp_video_paths.items():
+         if os.path.exists(temp_path):
+            permanent_filename = os.path.basename(temp_path)
+            permanent_path = os.path.join(permanent_user_video_dir, permanent_filename)
+            shutil.copy2(temp_path, permanent_path)
+            final_saved_paths_for_db["videos"][key] = os.path.join(user_specific_folder_name, VIDEO_SUBDIR_NAME, permanent_filename).replace("\\", "/")
+            logger.info(f"Видео '{key}' копирано в: {permanent_path}")
+
+    logger.info(f"Пътищата до файловете за user '{user_specific_folder_name}' (за БД): {final_saved_paths_for_db}")
+    return final_saved_paths_for_db
+
+
+IMAGE_ERROR_MESSAGES = {
+    "idCardFront": "Грешка при обработка на снимката на ЛК (предна).",
+    "selfie": "Грешка при обработка на селфи снимката.",
+}
+
+
+async def embed_image(job: PoolJob, data: bytes, field: str) -> dict:
+    """embed_image_task през кеша на сървърния процес; към пула се изпраща само при пропуск."""
+    key = await run_in_threadpool(content_key, data, MODEL_NAME, detector_cascade_name(field))
+    cached = await run_in_threadpool(server_embedding_cache.get, key)
+    threshold = model_thresholds.get(MODEL_NAME)
+    if cached is not None and threshold is not None: return verification_tasks.cached_embed_result(cached, threshold)
+    embedded = await job.run(verification_tasks.embed_image_task, data, field, True)
+    if not embedded["image_error"]:
+        model_thresholds[MODEL_NAME] = embedded["threshold"]
+        await run_in_threadpool(server_embedding_cache.put, key, embedded["embeddings"], embedded["detector"])
+    return embedded
+
+
+async def run_verification(job: PoolJob, tracker: StageTracker, images: dict, temp_video_paths: dict,
+                           user_identifier: str, firstName: Optional[str], lastName: Optional[str],
+                           liveness_started: Optional[asyncio.Future] = None):
+    """Етапите след качването на файловете. Връща (status_code, content) – същия отговор, който /verify връща.
+
+    Етапите са граф: embedding на ЛК (предна) и на селфито вървят паралелно с liveness анализа на видеото,
+    сравнението чака двата embedding-а, а записът – сравнението и liveness. Първият неуспешен етап
+    (невалидна снимка, липсващо лице, liveness) прекратява останалите и определя отговора.
+    liveness_started е liveness задачата, ако /verify я е пуснал още докато останалите полета се качваха.
+    """
+    if not images.get("idCardFront") or not images.get("selfie"):
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail={"status": "error", "code": "INTERNAL_ERROR_MISSING_IMAGE_PATHS", "message": "Вътрешна грешка: липсват пътища до временни снимки."})
+
+    def embed_stage(field):
+        async def _embed(results):
+            try:
+                embedded = await embed_image(job, images[field][1], field)
+            except JobTimeoutError:
+                raise
+            except Exception as e_deepface:
+                logger.error(f"Неочаквана грешка (DeepFace) за '{field}': {e_deepface}", exc_info=True)
+                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail={"status": "error", "code": "VERIFICATION_ERROR", "message": "Сървърна грешка при сравняване на лица."})
+            tracker.add_steps(embedded["timings"])
+            if embedded["image_error"]:
+                raise StageFailed(status.HTTP_400_BAD_REQUEST, error_content("IMAGE_PROCESSING_ERROR", IMAGE_ERROR_MESSAGES[field], field=field))
+            embedding_cache_counters["hits" if embedded["cache_hit"] else "misses"] += 1
+            if embedded["detector"]: logger.info(f"Лицето на '{field}' е открито от детектор '{embedded['detector']}'.")
+            if embedded["face_not_found"]:
+                logger.warning(f"Грешка при детекция (DeepFace) за '{field}': {embedded['error']}")
+                raise StageFailed(status.HTTP_400_BAD_REQUEST, error_content("VERIFICATION_FAILED", "Не е открито лице на някоя от снимките или лицата не съвпадат."))
+            return embedded
+        return _embed
+
+    async def liveness_stage(results):
+        liveness = await (liveness_started or job.run(verification_tasks.liveness_task, temp_video_paths["video_selfie"], job.cancel_token))
+        tracker.add_steps(liveness.get("timings"))
+        if not liveness["passed"]:
+            raise StageFailed(status.HTTP_400_BAD_REQUEST, error_content("LIVENESS_FAILED", "Проверката за реално присъствие е неуспешна."))
+        logger.info("Liveness проверката е успешна.")
+        return liveness
+
+    async def match_stage(results):
+        front, selfie = results["embed_idCardFront"], results["embed_selfie"]
+        with tracker.step("distance"): calculated_distance = verification_tasks.min_cosine_distance(front["embeddings"], selfie["embeddings"])
+        model_threshold = front["threshold"]; is_verified = calculated_distance <= model_threshold
+        logger.info(f"DeepFace Детайли: Разстояние={calculated_distance:.4f}, Праг={model_threshold:.4f}, Резултат={is_verified}")
+        if not is_verified:
+            # Ако DeepFace верификацията е неуспешна, файловете НЕ се записват на постоянно място
+            logger.warning("DeepFace верификацията е неуспешна. Файловете няма да бъдат запазени постоянно.")
+            raise StageFailed(status.HTTP_400_BAD_REQUEST, error_content("VERIFICATION_FAILED", "Лицата не съвпадат или не са открити."))
+        return {"distance": calculated_distance, "threshold": model_threshold}
+
+    async def duplicate_search_stage(results):
+        # Не отхвърля заявката – само маркира съвпадения с други верифицирани потребители.
+        selfie = results["embed_selfie"]
+        try:
+            duplicates = await job.run(verification_tasks.duplicate_search_task, selfie["embeddings"], user_identifier, selfie["threshold"])
+        except Exception as e_search:
+            logger.error(f"Грешка при търсене в индекса на лицата: {e_search}", exc_info=True)
+            return {"flagged": False, "matches": [], "search_error": True}
+        if duplicates["flagged"]:
+            logger.warning(f"Възможна дублирана самоличност за user_identifier '{user_identifier}': {duplicates['matches']}")
+        return duplicates
+
+    def index_selfie(embeddings, folder_paths: dict):
+        selfie_path = folder_paths["photos"].get("selfie")
+        meta = {"user_identifier": str(user_identifier), "user_folder": selfie_path.split("/", 1)[0] if selfie_path else None,
+                "source": selfie_path, "added_at": int(time.time())}
+        face_index_writer.append(embeddings[:1], [meta])
+
+    async def persist_stage(results):
+        logger.info("Верификацията е успешна. Запис на файловете на постоянно място...")
+        # Както преди: пазят се умалените версии на ЛК (предна) и селфито, а ЛК (задна) – в оригинал.
+        # JPEG-ът идва от декодирането при embedding; снимка отново се декодира само ако embedding-ът ѝ е от кеша.
+        encoded = {field: results[f"embed_{field}"]["jpeg"] for field in ("idCardFront", "selfie")}
+        missing = [field for field, data in encoded.items() if data is None]
+        if missing:
+            with tracker.step("jpeg_encode"):
+                encoded.update(zip(missing, await asyncio.gather(*(job.run(verification_tasks.encode_for_persist_task, images[field][1]) for field in missing))))
+        images_to_persist = dict(images)
+        for field, data in encoded.items():
+            # Умалената версия винаги е JPEG – разширението следва съдържанието, а не каченото име (напр. .png)
+            if data: images_to_persist[field] = (f"{os.path.splitext(images[field][0])[0]}.jpg", data)
+        with tracker.step("persist_files"):
+            final_saved_paths_for_db = await run_in_threadpool(persist_verified_files, user_identifier, firstName, lastName, images_to_persist, temp_video_paths)
+        try:
+            with tracker.step("face_index_append"): await run_in_threadpool(index_selfie, results["embed_selfie"]["embeddings"], final_saved_paths_for_db)
+        except Exception as e_index: logger.error(f"Грешка при добавяне в индекса на лицата: {e_index}", exc_info=True)
+        return final_saved_paths_for_db
+
+    graph = StageGraph(tracker, on_cancel=job.cancel_token.cancel)
+    graph.add("embed_idCardFront", embed_stage("idCardFront"))
+    graph.add("embed_selfie", embed_stage("selfie"))
+    persist_depends_on = ["match"]
+    if temp_video_paths.get("video_selfie"):
+        graph.add("liveness", liveness_stage)
+        persist_depends_on.append("liveness")
+    else:
+        tracker.skip("liveness")
+        logger.warning("Селфи видео не е предоставено. Liveness пропуснат (симулиран успех).")
+    graph.add("match", match_stage, depends_on=("embed_idCardFront", "embed_selfie"))
+    graph.add("duplicate_search", duplicate_search_stage, depends_on=("embed_selfie",))
+    graph.add("persist", persist_stage, depends_on=persist_depends_on + ["duplicate_search"])
+
+    try:
+        results = await graph.run()
+    except StageFailed as e_stage:
+        return e_stage.status_code, e_stage.content
+
+    # Връщаме пътищата към Next.js проксито, за да може то да ги запише в Prisma
+    return status.HTTP_200_OK, {
+        "status": "success",
+        "verified": True,
+        "distance": round(results["match"]["distance"], 4),
+        "threshold": round(results["match"]["threshold"], 4),
+        "model": MODEL_NAME,
+        "detector": DETECTOR_BACKEND,
+        "detector_cascade": {field: detector_cascade_name(field) for field in ("idCardFront", "selfie")},
+        # Кой детектор от каскадата е открил лицето (при попадение в кеша – записаният с embedding-а)
+        "detector_tier": {field: results[f"embed_{field}"]["detector"] for field in ("idCardFront", "selfie")},
+        "saved_file_paths": results["persist"],
+        "duplicate_identity": results["duplicate_search"]
+    }
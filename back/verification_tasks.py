@@ -0,0 +1,256 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+
+import numpy as np
+
+from config import (
+    MODEL_NAME, DISTANCE_METRIC, WARMUP_IMAGE_PATH,
+    LIVENESS_MIN_BLINKS_REQUIRED, REQUIRE_AUDIO_FOR_LIVENESS,
+    EMBEDDING_CACHE_MAX_ENTRIES, EMBEDDING_CACHE_TTL_SEC, EMBEDDING_CACHE_DIR,
+)
+from embedding_cache import EmbeddingCache, content_key
+from face_index import FaceIndexReader
+from logging_config import setup_logging
+from face_detection import detector_tiers, detector_cascade_name, represent_faces
+
+# Този модул се изпълнява в работните процеси на VerificationPool (worker_pool.py).
+# Всеки процес зарежда моделите веднъж в init_worker() и ги преизползва за всички задачи.
+#
+# Сървърният процес също импортира модула (задачите се изпращат към пула по име), затова тежките
+# библиотеки – DeepFace/TensorFlow, MediaPipe, cv2, PyAV/MoviePy – се импортират едва в worker-а.
+
+logger = logging.getLogger(__name__)
+
+face_mesh_detector = None
+mediapipe_available = None
+embedding_cache = None
+face_index_reader = None
+CACHED_FACE_NOT_FOUND = "Face could not be detected (cached result)."
+# Продължителност (s) на всяка фаза от init_worker() и дали моделите са заредени успешно
+startup_phases = {}
+worker_ready = False
+
+
+@contextmanager
+def _startup_phase(name: str):
+    started = time.perf_counter()
+    try: yield
+    finally: startup_phases[name] = round(time.perf_counter() - started, 3)
+
+
+def _load_face_mesh():
+    global mediapipe_available
+    try:
+        import mediapipe as mp
+        mediapipe_available = True
+    except ImportError as e_import:
+        mediapipe_available = False
+        logger.warning(f"MediaPipe не е намерена ({e_import}). Liveness detection features will be disabled.")
+        return None
+    model_file_to_check = os.path.join(os.path.dirname(mp.__file__), 'modules', 'face_landmark', 'face_landmark_front_cpu.binarypb')
+    if not os.path.exists(model_file_to_check):
+        logger.error(f"MediaPipe модел файл НЕ Е НАМЕРЕН: {model_file_to_check}")
+        return None
+    try:
+        with open(model_file_to_check, 'rb') as f_model_check: f_model_check.read(16)
+        detector = mp.solutions.face_mesh.FaceMesh(
+            static_image_mode=False, max_num_faces=1,
+            min_detection_confidence=0.5, min_tracking_confidence=0.5)
+        logger.info("MediaPipe Face Mesh detector loaded successfully.")
+        return detector
+    except Exception as e_mp_init:
+        logger.error(f"Грешка при инициализация на MediaPipe FaceMesh: {e_mp_init}", exc_info=True)
+        return None
+
+
+def _warmup_image():
+    import image_pipeline
+    if WARMUP_IMAGE_PATH:
+        try:
+            with open(WARMUP_IMAGE_PATH, "rb") as f: img = image_pipeline.load_image(f.read())
+        except OSError:
+            img = None
+        if img is not None: return img
+        logger.warning(f"WARMUP_IMAGE_PATH ({WARMUP_IMAGE_PATH}) липсва или не е валидно изображение – използва се вградената снимка.")
+    return image_pipeline.synthetic_face_image()
+
+
+def init_worker():
+    """Initializer на всеки работен процес: зарежда SFace, детекторите от каскадата и собствен FaceMesh.
+
+    Всеки модел се загрява с едно изпълнение върху вградена синтетична снимка, така че първата
+    реална заявка към worker-а не плаща зареждането на тежестите и инициализацията на графите.
+    """
+    global face_mesh_detector, embedding_cache, face_index_reader, worker_ready
+    setup_logging()
+    started = time.perf_counter()
+    with _startup_phase("face_mesh_load"): face_mesh_detector = _load_face_mesh()
+    with _startup_phase("liveness_import"): import media_decode  # noqa: F401 – PyAV/MoviePy/cv2 преди първото видео
+    embedding_cache = EmbeddingCache(EMBEDDING_CACHE_MAX_ENTRIES, EMBEDDING_CACHE_TTL_SEC, EMBEDDING_CACHE_DIR)
+    face_index_reader = FaceIndexReader()
+    try:
+        with _startup_phase("deepface_import"): from deepface import DeepFace
+        with _startup_phase("model_build"): DeepFace.build_model(MODEL_NAME)
+        # Прагът е част от всеки отговор – грешка тук трябва да остави worker-а "неготов", а не да чупи заявките
+        model_threshold()
+        img = _warmup_image()
+        backends = list(dict.fromkeys(detector_tiers("idCardFront") + detector_tiers("selfie")))
+        for backend in backends:
+            with _startup_phase(f"warmup_{backend}"):
+                DeepFace.represent(img_path=img, model_name=MODEL_NAME, detector_backend=backend, enforce_detection=False, align=True)
+        if face_mesh_detector is not None:
+            with _startup_phase("warmup_face_mesh"):
+                face_mesh_detector.process(np.ascontiguousarray(img[:, :, ::-1]))
+                face_mesh_detector.reset()  # синтетичното лице не трябва да остава като следено лице за първото видео
+        worker_ready = True
+        logger.info(f"Worker {os.getpid()}: DeepFace model '{MODEL_NAME}' and detectors {backends} pre-loaded and warmed up.")
+    except Exception as e: logger.error(f"Error pre-loading DeepFace: {e}", exc_info=True)
+    logger.info(f"Worker {os.getpid()}: старт за {time.perf_counter() - started:.2f} s, фази: {startup_phases}, готов={worker_ready}")
+
+
+def warmup_task(hold_sec: float = 0.0) -> dict:
+    # hold_sec задържа worker-а, за да вземат следващите задачи за загряване другите процеси (вж. VerificationPool._warm)
+    if hold_sec: time.sleep(hold_sec)
+    return {"pid": os.getpid(), "ready": worker_ready, "startup_phases": startup_phases}
+
+
+def model_threshold() -> float:
+    from deepface import DeepFace
+    return DeepFace.verification.find_threshold(MODEL_NAME, DISTANCE_METRIC)
+
+
+def liveness_task(video_path: str, cancel_token=None) -> dict:
+    """Blink/движение на главата/аудио анализ на селфи видеото. Връща речник с резултатите."""
+    if face_mesh_detector is None:
+        reason = "MediaPipe не е зареден" if mediapipe_available else "MediaPipe не е налична"
+        logger.warning(f"{reason}. Liveness пропуснат (симулиран успех).")
+        return {"passed": True, "skipped": True, "blinks": 0, "head_moved": False, "audio_present": False}
+
+    import media_decode
+    logger.info(f"Извършване на Liveness детекция върху: {video_path}")
+    should_stop = cancel_token.cancelled if cancel_token is not None else None
+    video_result, audio_present_in_selfie_video = media_decode.analyze_selfie_video(face_mesh_detector, video_path, require_audio=REQUIRE_AUDIO_FOR_LIVENESS, should_stop=should_stop)
+    if video_result is None: video_result = {"blinks": 0, "head_moved": False}
+
+    blinks_counted = video_result["blinks"]; head_moved_significantly = video_result["head_moved"]
+    liveness_check_passed = bool(blinks_counted >= LIVENESS_MIN_BLINKS_REQUIRED and head_moved_significantly and (audio_present_in_selfie_video or not REQUIRE_AUDIO_FOR_LIVENESS))
+    logger.info(f"Liveness Резултати: Мигания={blinks_counted}, Движение на главата={head_moved_significantly}, Аудио засечено={audio_present_in_selfie_video} => Liveness Преминал={liveness_check_passed} ({video_result})")
+    return {**video_result, "passed": liveness_check_passed, "skipped": False, "audio_present": bool(audio_present_in_selfie_video)}
+
+
+def face_embeddings(key: str, load_image, tiers: tuple, timings: dict = None):
+    """Детекция (през каскадата tiers) + SFace embedding за всички лица на снимката, през кеша.
+
+    Връща (матрица (n, dim), детектор, cache_hit, грешка); при попадение в кеша детекторът е записаният с embedding-а.
+    load_image() се извиква само при пропуск в кеша; ако върне None (невалидна снимка), матрицата е None.
+    """
+    cached = embedding_cache.get(key) if embedding_cache is not None else None
+    if cached is not None:
+        embeddings, detector = cached
+        return embeddings, detector, True, None if len(embeddings) else CACHED_FACE_NOT_FOUND
+    img = load_image()
+    if img is None: return None, None, False, None
+    embeddings, detector, error = represent_faces(img, tiers, timings=timings)
+    if embedding_cache is not None: embedding_cache.put(key, embeddings, detector)
+    return embeddings, detector, False, error
+
+
+def min_cosine_distance(embeddings1, embeddings2) -> float:
+    # Както DeepFace.verify: при няколко лица се взема двойката с най-малко разстояние.
+    a = embeddings1 / np.linalg.norm(embeddings1, axis=1, keepdims=True)
+    b = embeddings2 / np.linalg.norm(embeddings2, axis=1, keepdims=True)
+    return float((1.0 - a @ b.T).min())
+
+
+def embed_image_task(data: bytes, field: str = "selfie", keep_jpeg: bool = False) -> dict:
+    """Декодиране (само при пропуск в кеша), детекция и embedding на една качена снимка.
+
+    Евтината проверка (снимката се декодира) е първа; липсващо лице се връща като face_not_found.
+    "detector" е детекторът от каскадата, открил лицето (и при попадение в кеша; None без лице).
+    С keep_jpeg "jpeg" е умалената JPEG версия за постоянния запис от същото декодиране (None при попадение
+    в кеша или без лице). "timings" – секунди за image_decode, detect_embed_<детектор> и jpeg_encode.
+    """
+    import image_pipeline
+    timings = {}
+    decoded = []
+
+    def load_image():
+        started = time.perf_counter()
+        try:
+            img = image_pipeline.load_image(data)
+            decoded.append(img)
+            return img
+        finally: timings["image_decode"] = round(time.perf_counter() - started, 4)
+
+    key = content_key(data, MODEL_NAME, detector_cascade_name(field))
+    embeddings, detector, hit, error = face_embeddings(key, load_image, detector_tiers(field), timings)
+    if embeddings is None: return {"image_error": True, "timings": timings}
+    jpeg = None
+    if keep_jpeg and decoded and len(embeddings):
+        started = time.perf_counter()
+        jpeg = image_pipeline.encode_jpeg(decoded[0])
+        timings["jpeg_encode"] = round(time.perf_counter() - started, 4)
+    return {"image_error": False, "face_not_found": not len(embeddings), "error": error, "embeddings": embeddings,
+            "detector": detector, "cache_hit": hit, "threshold": model_threshold(), "jpeg": jpeg, "timings": timings}
+
+
+def cached_embed_result(cached: tuple, threshold: float) -> dict:
+    """Резултат във формата на embed_image_task от (embeddings, детектор), намерени в кеша на сървърния процес."""
+    embeddings, detector = cached
+    return {"image_error": False, "face_not_found": not len(embeddings), "error": None if len(embeddings) else CACHED_FACE_NOT_FOUND,
+            "embeddings": embeddings, "detector": detector, "cache_hit": True, "threshold": threshold, "jpeg": None, "timings": {}}
+
+
+def embed_image_file_task(path: str, field: str = "selfie") -> dict:
+    with open(path, "rb") as f: return embed_image_task(f.read(), field)
+
+
+def reverify_user(user: dict, threshold: float) -> dict:
+    """Сравнява записаните ЛК (предна) и селфи на един верифициран потребител с текущия модел и праг."""
+    result = {"user_folder": user["user_folder"], "user_identifier": user["user_identifier"],
+              "photos": {field: os.path.basename(path) if path else None for field, path in user["photos"].items()}}
+    embedded = {}
+    for field in ("idCardFront", "selfie"):
+        path = user["photos"].get(field)
+        if not path: return {**result, "status": "missing_file", "field": field}
+        try: embedded[field] = embed_image_file_task(path, field)
+        except OSError as e_read:
+            logger.warning(f"Файлът {path} не може да бъде прочетен: {e_read}")
+            return {**result, "status": "missing_file", "field": field}
+        if embedded[field]["image_error"]: return {**result, "status": "image_error", "field": field}
+        if embedded[field]["face_not_found"]: return {**result, "status": "face_not_found", "field": field}
+    distance = min_cosine_distance(embedded["idCardFront"]["embeddings"], embedded["selfie"]["embeddings"])
+    return {**result, "status": "verified" if distance <= threshold else "not_verified",
+            "distance": round(distance, 4), "threshold": round(threshold, 4),
+            "detector_tier": {field: embedded[field]["detector"] for field in embedded}}
+
+
+def reverify_batch_task(users: list, threshold: float = None) -> list:
+    """Повторна проверка на партида потребители в един worker (моделите и кешът се преизползват за цялата партида).
+
+    threshold=None – прагът на текущия MODEL_NAME. Грешка при един потребител не прекъсва останалите.
+    """
+    if threshold is None: threshold = model_threshold()
+    results = []
+    for user in users:
+        try: results.append(reverify_user(user, threshold))
+        except Exception as e_user:
+            logger.error(f"Грешка при повторна проверка на '{user['user_folder']}': {e_user}", exc_info=True)
+            results.append({"user_folder": user["user_folder"], "user_identifier": user["user_identifier"], "status": "error", "error": str(e_user)})
+    return results
+
+
+def duplicate_search_task(embeddings, user_identifier: str, threshold: float) -> dict:
+    """1:N търсене на селфито сред верифицираните потребители. Съвпадения под прага на модела се маркират."""
+    matches = face_index_reader.search(embeddings, exclude_user_identifier=user_identifier)
+    duplicates = [match for match in matches if match["distance"] <= threshold]
+    return {"flagged": bool(duplicates), "matches": duplicates}
+
+
+def encode_for_persist_task(data: bytes):
+    """Умалена JPEG версия на снимката за постоянен запис – само ако embed_image_task не я е върнал (попадение в кеша)."""
+    import image_pipeline
+    img = image_pipeline.load_image(data)
+    return image_pipeline.encode_jpeg(img) if img is not None else None
@@ -0,0 +1,196 @@
+import os
+import uuid
+import asyncio
+import logging
+import time
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+WARMUP_POLL_SEC = 0.5
+WARMUP_HOLD_SEC = 0.2
+
+
+class PoolSaturatedError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Verification pool is saturated")
+        self.retry_after = retry_after
+
+
+class JobTimeoutError(Exception):
+    pass
+
+
+class CancelToken:
+    """Сигнал за отмяна, видим от worker процесите (файл-маркер; pickle-ва се като път).
+
+    Задачите, които работят дълго (liveness), проверяват cancelled() периодично и спират сами,
+    тъй като ProcessPoolExecutor не може да прекъсне вече стартирала задача.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(tempfile.gettempdir(), f"verification_cancel_{uuid.uuid4().hex}")
+
+    def cancel(self):
+        try: open(self.path, "a").close()
+        except OSError as e_cancel: logger.warning(f"Неуспешно задаване на сигнал за отмяна: {e_cancel}")
+
+    def cancelled(self) -> bool:
+        return os.path.exists(self.path)
+
+    def cleanup(self):
+        try: os.remove(self.path)
+        except FileNotFoundError: pass
+
+
+class PoolJob:
+    """Една приета заявка. Задачите ѝ се изпращат към пула чрез run()."""
+
+    def __init__(self, pool: "VerificationPool", timeout: float):
+        self._pool = pool
+        self.timeout = timeout
+        self.pending = set()
+        self.cancel_token = CancelToken()
+
+    async def run(self, fn, *args, timeout: float = None):
+        executor = self._pool.executor
+        if executor is None: raise RuntimeError("Verification pool is not started")
+        try:
+            # submit() също вдига BrokenProcessPool, ако worker е умрял, докато пулът е бил свободен
+            cf = executor.submit(fn, *args)
+            self.pending.add(cf)
+            cf.add_done_callback(self.pending.discard)
+            # При timeout wait_for отменя и cf: ако задачата още чака в опашката, тя се премахва; ако вече
+            # се изпълнява, worker-ът ще я довърши, а слотът за допускане се освобождава чак тогава (вж. release()).
+            return await asyncio.wait_for(asyncio.wrap_future(cf), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise JobTimeoutError(f"{getattr(fn, '__name__', fn)} exceeded {timeout or self.timeout}s")
+        except BrokenProcessPool:
+            self._pool.restart(executor)
+            raise
+
+    def release(self):
+        pool = self._pool
+        orphaned = [cf for cf in self.pending if not cf.done()]
+        if not orphaned:
+            self.cancel_token.cleanup()
+            pool._release()
+            return
+        # Задачи след timeout/отмяна продължават да заемат worker; слотът се връща след последната от тях.
+        # Сигналът за отмяна остава зададен дотогава, за да могат те да спрат по-рано.
+        self.cancel_token.cancel()
+        remaining = [len(orphaned)]
+        def _on_orphan_done():
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                self.cancel_token.cleanup()
+                pool._release()
+        for cf in orphaned: cf.add_done_callback(lambda _cf: pool._call_in_loop(_on_orphan_done))
+
+
+class VerificationPool:
+    """Пул от предварително загрети процеси с ограничена опашка за допускане.
+
+    Допускането е на ниво заявка: най-много size + queue_size заявки могат да бъдат в процес на
+    обработка едновременно; следващите получават PoolSaturatedError (429 + Retry-After).
+    warmup(hold_sec) се изпълнява във всеки worker при старт и рестарт и връща {"pid", "ready", ...};
+    ready става True едва когато всички size процеса са отговорили.
+    """
+
+    def __init__(self, size: int, queue_size: int, job_timeout: float, retry_after: int, initializer=None, warmup=None):
+        self.size = max(1, size)
+        self.capacity = self.size + max(0, queue_size)
+        self.job_timeout = job_timeout
+        self.retry_after = retry_after
+        self._initializer = initializer
+        self._warmup = warmup
+        self._in_flight = 0
+        self.executor = None
+        self._loop = None
+        self._warmup_task = None
+        # Резултатът на warmup() от всеки worker (по pid) и дали всички са заредили моделите си
+        self.workers = {}
+        self.ready = False
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _create_executor(self):
+        # "spawn": TensorFlow и MediaPipe не са fork-safe, а всеки worker трябва да има собствени модели.
+        return ProcessPoolExecutor(max_workers=self.size, mp_context=multiprocessing.get_context("spawn"), initializer=self._initializer)
+
+    def start(self):
+        """Създава процесите и пуска загряването им във фонов режим; self.ready става True след него."""
+        self._loop = asyncio.get_running_loop()
+        self.executor = self._create_executor()
+        self._warmup_task = self._loop.create_task(self._warm(self.executor))
+
+    async def _warm(self, executor):
+        started = time.perf_counter()
+        if self._warmup is None:
+            self.ready = True
+            return
+        # Изпращаме size задачи наведнъж: докато initializer-ът зарежда моделите, няма свободен
+        # worker, така че executor-ът стартира всички процеси веднага, а не при първите заявки.
+        # Опашката е обща – worker, загрял пръв, може да вземе няколко задачи, докато друг още зарежда
+        # моделите. Затова изпращаме нови кръгове, докато не отговорят size различни процеса; в тях всяка
+        # задача задържа worker-а си за WARMUP_HOLD_SEC, за да остане задача и за още незагрелите.
+        workers = {}; hold_sec = 0.0
+        while len(workers) < self.size:
+            try:
+                results = await asyncio.gather(*(asyncio.wrap_future(executor.submit(self._warmup, hold_sec)) for _ in range(self.size)))
+            except BrokenProcessPool:
+                self.restart(executor)
+                return
+            if executor is not self.executor: return
+            workers.update((result["pid"], result) for result in results)
+            if len(workers) < self.size:
+                hold_sec = WARMUP_HOLD_SEC
+                await asyncio.sleep(WARMUP_POLL_SEC)
+        self.workers = workers
+        self.ready = all(result["ready"] for result in workers.values())
+        log = logger.info if self.ready else logger.error
+        log(f"Verification pool загрят за {time.perf_counter() - started:.2f} s: {len(self.workers)} worker процеса, "
+            f"готов={self.ready}, капацитет на опашката {self.capacity}.")
+
+    def restart(self, broken_executor):
+        # Няколко заявки може да открият един и същ повреден executor; рестартираме само веднъж.
+        if broken_executor is not self.executor: return
+        logger.error("Verification pool е повреден (worker процес е прекратен). Рестартиране...")
+        self.ready = False; self.workers = {}
+        self.executor = self._create_executor()
+        broken_executor.shutdown(wait=False, cancel_futures=True)
+        self._warmup_task = self._loop.create_task(self._warm(self.executor))
+
+    def shutdown(self):
+        self.ready = False
+        if self._warmup_task is not None: self._warmup_task.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def _release(self):
+        self._in_flight -= 1
+
+    def _call_in_loop(self, callback):
+        if self._loop is not None and not self._loop.is_closed(): self._loop.call_soon_threadsafe(callback)
+
+    def acquire(self, timeout: float = None) -> PoolJob:
+        """Заема слот без контекстен мениджър (напр. от синхронен callback); слотът се връща с job.release()."""
+        if self._in_flight >= self.capacity:
+            raise PoolSaturatedError(self.retry_after)
+        self._in_flight += 1
+        return PoolJob(self, timeout or self.job_timeout)
+
+    @asynccontextmanager
+    async def admit(self, timeout: float = None):
+        job = self.acquire(timeout)
+        try:
+            yield job
+        finally:
+            job.release()